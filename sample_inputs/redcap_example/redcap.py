@@ -1,4 +1,4 @@
-import mappings
+from clinical_etl import mappings
 import re
 
 
@@ -4,15 +4,19 @@
 import sys
 import os
 from copy import deepcopy
+import hashlib
 import importlib.util
 import json
-import pandas
 import csv
 import re
-import yaml
+import time
+import traceback
 import argparse
-from tqdm import tqdm
+# pandas, numpy, tqdm and yaml are slow to import, so they are imported by the functions that need them:
+# this keeps --help, and importing this module for its helpers, fast
 from clinical_etl import mappings
+from clinical_etl import metrics as etl_metrics
+from clinical_etl.metrics import Metrics, MappingProfile, MemoryProfile, Tracer
 # Include clinical_etl parent directory in the module search path.
 current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
@@ -24,9 +28,16 @@ def verbose_print(message):
         print(message)
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
-    parser.add_argument('--input', type=str, required=True, help="Path to either an xlsx file or a directory of csv files for ingest")
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    return args
+
+
+def add_arguments(parser, input_required=True):
+    """Add the arguments of CSVConvert to parser, which is also used by the convert command of the clinical_etl cli."""
+    parser.add_argument('--input', type=str, required=input_required, help="Path to either an xlsx file or a directory of csv files for ingest")
     # parser.add_argument('--api_key', type=str, help="BioPortal API key found in BioPortal personal account settings")
     # parser.add_argument('--email', type=str, help="Contact email to access NCBI clinvar API. Required by Entrez")
     # parser.add_argument('--schema', type=str, help="Schema to use for template; default is mCodePacket")
@@ -35,8 +46,39 @@ def parse_args():
     parser.add_argument('--verbose', '--v', action="store_true", help="Print extra information, useful for debugging and understanding how the code runs.")
     parser.add_argument('--index', '--i', action="store_true", help="Output 'indexed' file, useful for debugging and seeing relationships.")
     parser.add_argument('--minify', action="store_true", help="Remove white space and line breaks from json outputs to reduce file size. Less readable for humans.")
-    args = parser.parse_args()
-    return args
+    parser.add_argument('--typed', action="store_true", help="Convert columns that are only read by integer, floating or boolean mappings to typed columns once, when the data is ingested.")
+    parser.add_argument('--categorical', action="store_true", help=f"Store string columns with at most {CATEGORICAL_MAX_VALUES} distinct values as categoricals, so that repeated values share memory. Columns listed under 'categorical' in the manifest always are.")
+    parser.add_argument('--incremental', action="store_true", help="Reuse the packets and validation results of donors whose input data has not changed since the last incremental run.")
+    parser.add_argument('--checkpoint', type=int, help="Save the packets of completed donors to a checkpoint file every CHECKPOINT donors, so that an interrupted run can be resumed.")
+    parser.add_argument('--continue-on-error', action="store_true", help="If mapping a donor fails, record the error in <INPUT>_errors.json and continue with the next donor.")
+    parser.add_argument('--metrics', action="store_true", help="Write the time, CPU time and peak memory of each stage of the conversion, and the donors and rows processed per second, to <INPUT>_metrics.json.")
+    parser.add_argument('--profile', action="store_true", help=f"Report the calls, time and null results of each mapping function and template line: the slowest {PROFILE_TOP_N} are printed and all are written to <INPUT>_profile.csv.")
+    parser.add_argument('--trace', action="store_true", help="Write a timeline of the conversion to <INPUT>_trace.json in the Chrome trace event format, which can be viewed in Perfetto.")
+    parser.add_argument('--trace-sample', type=int, default=1, help="With --trace, only keep the mapping and validation spans of every TRACE_SAMPLE donors.")
+    parser.add_argument('--memprofile', type=int, nargs="?", const=DEFAULT_MEMPROFILE_EVERY, help=f"Take tracemalloc snapshots after each stage and every MEMPROFILE donors (default {DEFAULT_MEMPROFILE_EVERY}), and write the top allocation sites and the size of the indexed data and packets to <INPUT>_memprofile.json.")
+    parser.add_argument('--fast-validation', action="store_true", help="Validate packets against the json schema with a validator generated from it and cached with the schema, instead of with jsonschema. The errors are the same.")
+    parser.add_argument('--resume', action="store_true", help=f"Skip the donors completed in the checkpoint of an interrupted run, if the inputs, template and schema have not changed. Checkpoints every {DEFAULT_CHECKPOINT_EVERY} donors unless --checkpoint is given.")
+
+
+# Columns that are only ever read through one of these mapping functions can be converted once at ingest
+TYPED_MAPPING_FUNCTIONS = {
+    "integer": "Int64",
+    "floating": "Float64",
+    "boolean": "boolean"
+}
+
+# With --categorical, columns with at most this many distinct values, each occurring at least twice on average,
+# are stored as categoricals so that every occurrence of a value shares a single string
+CATEGORICAL_MAX_VALUES = 100
+
+# Number of donors between checkpoint writes when --resume is used without --checkpoint
+DEFAULT_CHECKPOINT_EVERY = 100
+
+# Number of mapping functions and template lines printed by --profile
+PROFILE_TOP_N = 20
+
+# Number of donors between memory snapshots when --memprofile is used without a number
+DEFAULT_MEMPROFILE_EVERY = 100
 
 
 class Bcolors:
@@ -51,6 +93,16 @@ class Bcolors:
     UNDERLINE = '\033[4m'
 
 
+class ConversionError(Exception):
+    """A problem with the manifest, mapping template or input sheets that stops a conversion. convert() raises
+    it for the caller to handle; csv_convert reports it and exits."""
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return self.value
+
+
 def map_data_to_scaffold(node, line, rownum):
     """
     Given a particular individual's data, and a node in the schema, return the node with mapped data. Recursive.
@@ -65,7 +117,10 @@ def map_data_to_scaffold(node, line, rownum):
             return None
         return result
     if "str" in str(type(node)) and node != "":
-        result = eval_mapping(node, rownum)
+        if mappings.PROFILE is not None:
+            result = mappings._intern(profile_mapping(node, rownum))
+        else:
+            result = mappings._intern(eval_mapping(node, rownum))
         verbose_print(f"Evaluated result is {result}, {node}, {rownum}")
         return result
     if "dict" in str(type(node)):
@@ -106,7 +161,10 @@ def map_indexed_scaffold(node, line):
         if index_field is None:
             return None
         # evaluate INDEX, using None as rownum to indicate that we're calculating an index and not a specific row
-        index_values = eval_mapping(node["INDEX"], None)
+        if mappings.PROFILE is not None:
+            index_values = profile_mapping(node["INDEX"], None, f"{line}.INDEX")
+        else:
+            index_values = eval_mapping(node["INDEX"], None)
         verbose_print(f"  Indexing on  {index_values}")
         if index_values is None:
             return None
@@ -159,13 +217,11 @@ def map_indexed_scaffold(node, line):
     return result
 
 
-def parse_sheet_from_field(param):
+def split_sheet_from_field(param):
     """
-    If the parameter specifies a sheet, return just that sheet and the parameter's base name.
-    Returns None, None if the parameter is not found.
+    Split a parameter into its base name and the sheet it specifies, without checking the input data.
+    The sheet is None if the parameter does not specify one.
     """
-    if param is None:
-        return None, None
     param = param.strip()
 
     sheet = None
@@ -187,6 +243,17 @@ def parse_sheet_from_field(param):
         if sheet_match is not None:
             sheet = sheet_match.group(1)
             param = sheet_match.group(2)
+    return param, sheet
+
+
+def parse_sheet_from_field(param):
+    """
+    If the parameter specifies a sheet, return just that sheet and the parameter's base name.
+    Returns None, None if the parameter is not found.
+    """
+    if param is None:
+        return None, None
+    param, sheet = split_sheet_from_field(param)
     if sheet is not None:
         if param in mappings.INDEXED_DATA["columns"]:
             if sheet in mappings.INDEXED_DATA["columns"][param]:
@@ -296,92 +363,192 @@ def eval_mapping(node_name, rownum):
                 module = mappings.MODULES[modulename]
                 return eval(f'module.{method}({data_values})')
         except mappings.MappingError as e:
-            print(f"Error evaluating {method}")
+            mappings._report(f"Error evaluating {method}")
             raise e
     return None
 
 
+def profile_mapping(node_name, rownum, line=None):
+    """Evaluate a mapping, recording the time it took and whether it was null in mappings.PROFILE, under the
+    template line being mapped, or line if it is given."""
+    if node_name not in mappings.PROFILE.function_names:
+        method, parameters = parse_mapping_function(node_name)
+        if method is not None and re.match(r"(.+)\.(.+)", method) is None:
+            method = f"mappings.{method}"
+        mappings.PROFILE.function_names[node_name] = str(method)
+    start = time.perf_counter()
+    result = eval_mapping(node_name, rownum)
+    mappings.PROFILE.record(line or mappings.CURRENT_LINE, mappings.PROFILE.function_names[node_name],
+                            time.perf_counter() - start, result)
+    return result
+
+
 def ingest_raw_data(input_path):
     """Ingest the csvs or xlsx and create dataframes for processing."""
     raw_csv_dfs = {}
     output_file = "mCodePacket"
+    import pandas
     # input can either be an excel file or a directory of csvs
     if os.path.isfile(input_path):
         file_match = re.match(r"(.+)\.xlsx$", input_path)
         if file_match is not None:
             output_file = file_match.group(1)
+            start = time.perf_counter()
             df = pandas.read_excel(input_path, sheet_name=None, dtype=str)
             for page in df:
                 raw_csv_dfs[page] = df[page]  # append all processed mcode dataframes to a list
+            if etl_metrics.TRACER is not None:
+                etl_metrics.TRACER.add("read_excel", "ingest", start, {"file": input_path})
     elif os.path.isdir(input_path):
         output_file = os.path.normpath(input_path)
         files = os.listdir(input_path)
         for file in files:
             file_match = re.match(r"(.+)\.csv$", file)
             if file_match is not None:
+                start = time.perf_counter()
                 df = pandas.read_csv(os.path.join(input_path, file), dtype=str)
                 raw_csv_dfs[file_match.group(1)] = df
+                if etl_metrics.TRACER is not None:
+                    etl_metrics.TRACER.add(f"read_csv {file_match.group(1)}", "ingest", start,
+                                           {"file": file, "rows": len(df)})
     return raw_csv_dfs, output_file
 
 
-def process_data(raw_csv_dfs, verbose):
-    """Takes a set of raw dataframes with a common identifier and merges into a JSON data structure."""
+def infer_column_uses(template_lines):
+    """Given the lines of a mapping template, return a dict of the mapping functions that read each column:
+    {column: {sheet: set(functions)}}. The sheet is None if the template line does not specify one; the
+    function is None for any use other than as the single parameter of one of the TYPED_MAPPING_FUNCTIONS."""
+    column_uses = {}
+    for line in template_lines:
+        value, elems = process_mapping(line)
+        if elems is None:
+            continue
+        method, parameters = parse_mapping_function(value)
+        if parameters is None:
+            continue
+        if method is not None:
+            method = re.sub(r"^mappings\.", "", method)
+        if method not in TYPED_MAPPING_FUNCTIONS or len(parameters) != 1:
+            method = None
+        for param in parameters:
+            col, sheet = split_sheet_from_field(param)
+            if col not in column_uses:
+                column_uses[col] = {}
+            if sheet not in column_uses[col]:
+                column_uses[col][sheet] = set()
+            column_uses[col][sheet].add(method)
+    return column_uses
+
+
+def typed_mapping_function(column_uses, sheet, col):
+    """Return the typed mapping function that is the only reader of sheet.col, or None."""
+    if col == mappings.IDENTIFIER_FIELD or col not in column_uses:
+        return None
+    methods = column_uses[col].get(sheet, set()) | column_uses[col].get(None, set())
+    if len(methods) == 1:
+        return methods.pop()
+    return None
+
+
+def convert_typed_column(series, method):
+    """Convert a column of strings to the nullable dtype for the typed mapping function method.
+    Returns the converted column and the values that could not be converted. An integer column with a value
+    that doesn't fit in an Int64 is returned unchanged, so that mappings.integer converts it."""
+    import numpy
+    import pandas
+    if method == "boolean":
+        # same rules as mappings.boolean: only the first letter matters
+        first_letters = series.str.strip().str.lower().str[0]
+        converted = first_letters.map({"y": True, "t": True, "n": False, "f": False}).astype("boolean")
+        failed = series[series.notna() & converted.isna()]
+        return converted, list(failed.unique())
+    numeric = pandas.to_numeric(series, errors="coerce")
+    numeric = numeric.mask(numeric.isin([numpy.inf, -numpy.inf]))
+    failed = series[series.notna() & numeric.isna()]
+    if method == "integer":
+        if (numeric.notna() & ~numeric.between(-2 ** 63, 2 ** 63, inclusive="left")).any():
+            return series, []
+        # same rules as mappings.integer: int(float(cell)) truncates
+        converted = numpy.trunc(numeric).astype(TYPED_MAPPING_FUNCTIONS[method])
+    else:
+        converted = numeric.astype(TYPED_MAPPING_FUNCTIONS[method])
+    return converted, list(failed.unique())
+
+
+def is_categorical_column(series, sheet, col, categorical_columns=None, detect=False):
+    """Return True if sheet.col should be stored as a categorical: either it is listed in categorical_columns
+    (as col or sheet.col) or, with detect, it is a string column with few distinct values."""
+    if series.dtype != "string":
+        return False
+    if categorical_columns is not None and (col in categorical_columns or f"{sheet}.{col}" in categorical_columns):
+        return True
+    if not detect:
+        return False
+    distinct = series.nunique()
+    return distinct <= CATEGORICAL_MAX_VALUES and distinct * 2 <= series.count()
+
+
+def process_data(raw_csv_dfs, verbose, column_uses=None, categorical_columns=None, categorical=False, quiet=False):
+    """Takes a set of raw dataframes with a common identifier and merges into a JSON data structure.
+    If column_uses is specified (see infer_column_uses), columns that are only read by one typed mapping
+    function are converted to that type here instead of on every access.
+    Columns listed in categorical_columns and, with categorical, low-cardinality columns are stored as
+    categoricals."""
     final_merged = {}
     cols_index = {}
     individuals = []
-    print(f"\n{Bcolors.OKBLUE}Processing sheets: {Bcolors.ENDC}")
+    seen_individuals = set()
+    if not quiet:
+        print(f"\n{Bcolors.OKBLUE}Processing sheets: {Bcolors.ENDC}")
     for page in raw_csv_dfs.keys():
-        print(f"{Bcolors.OKBLUE}{page}  {Bcolors.ENDC}", end="")
+        if not quiet:
+            print(f"{Bcolors.OKBLUE}{page}  {Bcolors.ENDC}", end="")
         df = raw_csv_dfs[page].dropna(axis='index', how='all') \
             .dropna(axis='columns', how='all') \
-            .map(str) \
-            .map(lambda x: x.strip()) \
+            .astype("string")
+        # strip whitespace column by column; missing cells stay as real nulls instead of becoming 'nan'
+        df = df.apply(lambda col: col.str.strip()) \
             .drop_duplicates()  # drop absolutely identical lines
 
-        # Sort by identifier and then tag any dups
+        # Sort by identifier so that all rows for an identifier are adjacent
         df.set_index(mappings.IDENTIFIER_FIELD, inplace=True)
         df.sort_index(inplace=True)
         df.reset_index(inplace=True)
-        dups = df.duplicated(subset=[mappings.IDENTIFIER_FIELD], keep='first')
+        df.columns = [col.strip() for col in df.columns]
 
         for col in list(df.columns):
-            col = col.strip()
             if col not in cols_index:
                 cols_index[col] = [page]
             else:
                 cols_index[col].append(page)
+            if column_uses is not None:
+                method = typed_mapping_function(column_uses, page, col)
+                if method is not None:
+                    df[col], failed = convert_typed_column(df[col], method)
+                    if len(failed) > 0:
+                        examples = ", ".join(map(repr, failed[0:5]))
+                        mappings._warn(f"{len(failed)} distinct value(s) in {page}.{col} could not be converted by "
+                                       f"{method}() and were treated as null: {examples}")
+            if is_categorical_column(df[col], page, col, categorical_columns, detect=categorical):
+                df[col] = df[col].astype("category")
 
         # For all rows with the same identifier, merge all of the occurrences into an array
-        rows_to_merge = {}  # this is going to hold all of the rows that will need to be merged...
-        df_dict = df.to_dict(orient="index")
-        for index in range(0, len(dups)):
-            if not dups[index]:  # this is the first occurrence
-                rows_to_merge[df_dict[index][mappings.IDENTIFIER_FIELD]] = [df_dict[index]]
-            else:
-                rows_to_merge[df_dict[index][mappings.IDENTIFIER_FIELD]].append(df_dict[index])
-        merged_dict = {}  # this is going to be the dict with arrays:
-        for i in range(0, len(rows_to_merge)):
-            merged_dict[i] = {}
-            row_to_merge = rows_to_merge[list(rows_to_merge.keys())[i]]
-            while len(row_to_merge) > 0:  # there are still entries to merge
-                row = row_to_merge.pop(0)
-                for k in row.keys():
-                    if k.strip() not in merged_dict[i]:
-                        merged_dict[i][k.strip()] = []
-                    val = row[k]
-                    if val == 'nan':
-                        val = None
-                    merged_dict[i][k.strip()].append(val)
-                if len(row_to_merge) > 0 and verbose:
-                    mappings._info(f"Duplicate row for {merged_dict[i][mappings.IDENTIFIER_FIELD][0]} in {page}")
-
-        # Now we can clean up the dicts: index them by identifier instead of int
+        columns = df.astype(object).where(df.notna(), None).to_dict(orient="list")
+        identifiers = columns[mappings.IDENTIFIER_FIELD]
         indexed_merged_dict = {}
-        for i in range(0, len(merged_dict.keys())):
-            indiv = merged_dict[i][mappings.IDENTIFIER_FIELD][0]
-            indexed_merged_dict[indiv] = merged_dict[i]
-            if indiv not in individuals:
+        start = 0
+        for end in range(1, len(identifiers) + 1):
+            if end < len(identifiers) and identifiers[end] == identifiers[start]:
+                continue
+            indiv = identifiers[start]
+            if verbose:
+                for i in range(start + 1, end):
+                    mappings._info(f"Duplicate row for {indiv} in {page}")
+            indexed_merged_dict[indiv] = {col: values[start:end] for col, values in columns.items()}
+            if indiv not in seen_individuals:
+                seen_individuals.add(indiv)
                 individuals.append(indiv)
+            start = end
         final_merged[page] = indexed_merged_dict
 
     return {
@@ -553,29 +720,32 @@ def scan_template_for_duplicate_mappings(template_lines):
     # print(json.dumps(field_map, indent=4))
 
 
-def check_for_sheet_inconsistencies(template_sheets, csv_sheets):
+def sheets_in_template(template_lines):
+    """Return the set of sheet names that the mapping template reads from."""
+    return set([re.findall(r"\(([\w\" ]+)", x)[0].replace('"', "") for x in template_lines])
+
+
+def check_for_sheet_inconsistencies(template_sheets, csv_sheets, quiet=False):
     nl = "\n"
     verbose_print(f"Expected sheet/csv names based on template_csv: {nl}{nl.join(template_sheets)}{nl}")
     verbose_print(f"Expected sheet/csv names based on input files:{nl}{nl.join(csv_sheets)}{nl}")
     template_csv_diff = template_sheets.difference(csv_sheets)
     csv_template_diff = csv_sheets.difference(template_sheets)
-    if len(template_csv_diff) > 0:
+    if len(template_csv_diff) > 0 and not quiet:
         # Print a warning if verbose enabled, it is possible that the template sheet has more than is required
         print(nl + f"{Bcolors.WARNING}WARNING: The following csv/sheet names are in the mapping template but were not found in the input sheets/csvs:{Bcolors.ENDC}"
               + nl + nl.join(template_csv_diff) + nl +
               f"{Bcolors.WARNING}If this is an error please correct it as it may result in errors with mapping your data.{Bcolors.ENDC}")
     if len(csv_template_diff) > 0:
         # Exit here because if we can't find a mapping for a field we can't properly map the inputs
-        sys.exit("The following sheet names are in the input csvs but not found in the mapping template:" + nl +
-                 nl.join(csv_template_diff) + nl + "Please correct the sheets above and try again.")
+        raise ConversionError("The following sheet names are in the input csvs but not found in the mapping template:"
+                              + nl + nl.join(csv_template_diff) + nl + "Please correct the sheets above and try again.")
 
 
-def load_manifest(manifest_file):
-    """Given a manifest file's path, return the data inside it."""
-    identifier = None
-    schema_class = "MoHSchemaV2"
-    mapping_path = None
-    result = {}
+def load_manifest(manifest_file, schema=None):
+    """Given a manifest file's path, return the data inside it. A loaded schema object can be given to use
+    instead of loading the manifest's schema again."""
+    import yaml
     try:
         with open(manifest_file, 'r') as f:
             manifest = yaml.safe_load(f)
@@ -585,30 +755,46 @@ def load_manifest(manifest_file):
     except FileNotFoundError as e:
         print(e)
         sys.exit(f"Manifest file not found at provided path: {manifest_file}")
+    if schema is not None:
+        manifest["schema"] = schema
+    try:
+        return parse_manifest(manifest, os.path.dirname(os.path.abspath(manifest_file)))
+    except ConversionError as e:
+        sys.exit(str(e))
+
+
+def parse_manifest(manifest, manifest_dir):
+    """Given the contents of a manifest, load its schema and mapping function modules and return the data
+    inside it. Paths in the manifest are relative to manifest_dir. The schema can be a url or path to an
+    openapi schema, or an already loaded schema object; functions can be paths to modules or modules."""
+    schema_class = "MoHSchemaV2"
+    result = {}
 
     if "identifier" in manifest:
         result["identifier"] = manifest["identifier"]
     if "schema" not in manifest:
-        sys.exit("Need to specify an OpenAPI schema as 'schema' in the manifest file, "
-                 "see README for more details.")
+        raise ConversionError("Need to specify an OpenAPI schema as 'schema' in the manifest file, "
+                              "see README for more details.")
     if "schema_class" in manifest:
         schema_class = manifest["schema_class"]
 
-    # programatically load schema class based on manifest value:
-    # schema class definition will be in a file named schema_class.lower()
-    schema_mod = importlib.import_module(f"clinical_etl.{schema_class.lower()}")
-    schema = getattr(schema_mod, schema_class)(manifest["schema"])
+    if isinstance(manifest["schema"], str):
+        # programatically load schema class based on manifest value:
+        # schema class definition will be in a file named schema_class.lower()
+        schema_mod = importlib.import_module(f"clinical_etl.{schema_class.lower()}")
+        schema = getattr(schema_mod, schema_class)(manifest["schema"])
+    else:
+        schema = manifest["schema"]
     if schema.json_schema is None:
-        sys.exit(f"Could not read an openapi schema at {manifest['schema']};\n"
-              f"please check the url in the manifest file links to a valid openAPI schema.")
+        raise ConversionError(f"Could not read an openapi schema at {manifest['schema']};\n"
+                              f"please check the url in the manifest file links to a valid openAPI schema.")
     result["schema"] = schema
 
     if "mapping" in manifest:
         mapping_file = manifest["mapping"]
-        manifest_dir = os.path.dirname(os.path.abspath(manifest_file))
         mapping_path = os.path.join(manifest_dir, mapping_file)
         if os.path.isabs(mapping_file):
-            mapping_path = manifest_file
+            mapping_path = mapping_file
         result["mapping"] = mapping_path
 
     if "reference_date" in manifest:
@@ -617,74 +803,328 @@ def load_manifest(manifest_file):
     if "date_format" in manifest:
         result["date_format"] = manifest["date_format"]
 
+    if "categorical" in manifest:
+        result["categorical"] = manifest["categorical"]
+
+    if "date_languages" in manifest:
+        result["date_languages"] = manifest["date_languages"]
+
     if "functions" in manifest:
         for mod in manifest["functions"]:
+            if not isinstance(mod, str):
+                mappings.MODULES[mod.__name__] = mod
+                continue
+            # the module is named after its file, which is how the template refers to it
+            mod_name = os.path.splitext(os.path.basename(mod))[0]
             try:
                 mod_path = os.path.join(manifest_dir, mod)
                 if not mod_path.endswith(".py"):
                     mod_path += ".py"
-                spec = importlib.util.spec_from_file_location(mod, mod_path)
-                mappings.MODULES[mod] = importlib.util.module_from_spec(spec)
-                sys.modules[mod] = mappings.MODULES[mod]
-                spec.loader.exec_module(mappings.MODULES[mod])
+                spec = importlib.util.spec_from_file_location(mod_name, mod_path)
+                mappings.MODULES[mod_name] = importlib.util.module_from_spec(spec)
+                sys.modules[mod_name] = mappings.MODULES[mod_name]
+                spec.loader.exec_module(mappings.MODULES[mod_name])
             except Exception as e:
-                print(
+                raise ConversionError(
                     f"---\nCould not find appropriate mapping functions at {mod_path}, ensure your mapping file is in "
-                    f"{manifest_dir} and has the correct name.\n---")
-                sys.exit(e)
+                    f"{manifest_dir} and has the correct name.\n---\n{e}")
     # mappings is a standard module: add it
     mappings.MODULES["mappings"] = importlib.import_module("clinical_etl.mappings")
     return result
 
 
-def csv_convert(input_path, manifest_file, minify=False, index_output=False, verbose=False):
-    mappings.VERBOSE = verbose
-    # read manifest data
-    print(f"{Bcolors.OKGREEN}Starting conversion...{Bcolors.ENDC}", end="")
-    manifest = load_manifest(manifest_file)
+def check_manifest(manifest):
+    """Check that the manifest specifies the identifier and a valid date format."""
     try:
-        mappings.IDENTIFIER_FIELD = manifest["identifier"]
         if manifest["identifier"] is None:
             raise TypeError
     except KeyError as e:
-        sys.exit("Need to specify what the main identifier column name is as 'identifier' in the manifest file, "
-                 "see README for more details.")
+        raise ConversionError("Need to specify what the main identifier column name is as 'identifier' in the "
+                              "manifest file, see README for more details.")
     except TypeError as e:
-        sys.exit("'identifier' in the manifest file cannot be blank, see README for more details.")
+        raise ConversionError("'identifier' in the manifest file cannot be blank, see README for more details.")
     try:
-        mappings.DATE_FORMAT = manifest["date_format"]
         if manifest["date_format"] is None:
             raise TypeError
         if sorted(manifest["date_format"]) != sorted("DMY"):
             raise TypeError
     except KeyError as e:
-        sys.exit("'date_format' must be specified in the manifest file, see README for more details.")
+        raise ConversionError("'date_format' must be specified in the manifest file, see README for more details.")
     except TypeError as e:
-        sys.exit("Need to specify a valid value for the date format in the manifest file, "
-                 "see README for more details.")
+        raise ConversionError("Need to specify a valid value for the date format in the manifest file, "
+                              "see README for more details.")
+
+
+def hash_file(path):
+    """Return the sha256 hex digest of the file at path."""
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def fingerprint_conversion(manifest_file, manifest):
+    """Return a hash of everything besides an individual's own data that their packets depend on: the manifest,
+    the mapping template, the mapping function modules, the schema and the columns of the input sheets."""
+    fingerprint = hashlib.sha256()
+    fingerprint.update(hash_file(manifest_file).encode())
+    fingerprint.update(hash_file(manifest["mapping"]).encode())
+    for mod in sorted(mappings.MODULES.keys()):
+        fingerprint.update(mod.encode())
+        fingerprint.update(hash_file(mappings.MODULES[mod].__file__).encode())
+    schema = manifest["schema"]
+    fingerprint.update(type(schema).__name__.encode())
+    fingerprint.update(json.dumps(schema.json_schema, sort_keys=True).encode())
+    fingerprint.update(json.dumps(mappings.INDEXED_DATA["columns"], sort_keys=True).encode())
+    return fingerprint.hexdigest()
+
+
+def hash_donor_data(indiv):
+    """Return a hash of all of the input rows for indiv, across all sheets."""
+    rows = {}
+    for sheet in mappings.INDEXED_DATA["data"]:
+        if sheet != "CALCULATED" and indiv in mappings.INDEXED_DATA["data"][sheet]:
+            rows[sheet] = mappings.INDEXED_DATA["data"][sheet][indiv]
+    return hashlib.sha256(json.dumps(rows, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def read_incremental_state(state_file, fingerprint):
+    """Read the per-donor results saved by a previous incremental run, as long as it used the same fingerprint."""
+    try:
+        with open(state_file) as f:
+            state = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    if state.get("fingerprint") != fingerprint:
+        print(f"{Bcolors.WARNING}The manifest, template, mapping functions, schema or input columns have changed "
+              f"since {state_file} was written: all donors will be converted.{Bcolors.ENDC}")
+        return {}
+    return state["donors"]
+
+
+def write_incremental_state(state_file, fingerprint, donor_hashes, packets, packet_donors, donor_results):
+    """Save each donor's input hash, packets and validation results for the next incremental run."""
+    donors = {}
+    for indiv in donor_hashes:
+        donors[indiv] = {
+            "hash": donor_hashes[indiv],
+            "packets": [],
+            "validation": []
+        }
+    for i in range(0, len(packets)):
+        donors[packet_donors[i]]["packets"].append(packets[i])
+        donors[packet_donors[i]]["validation"].append(donor_results[i])
+    with open(state_file, 'w') as f:
+        json.dump({"fingerprint": fingerprint, "donors": donors}, f)
+
+
+def fingerprint_inputs(input_path):
+    """Return a hash of the input xlsx file, or of all of the csv files in the input directory."""
+    fingerprint = hashlib.sha256()
+    if os.path.isdir(input_path):
+        for file in sorted(os.listdir(input_path)):
+            if re.match(r"(.+)\.csv$", file) is not None:
+                fingerprint.update(file.encode())
+                fingerprint.update(hash_file(os.path.join(input_path, file)).encode())
+    else:
+        fingerprint.update(hash_file(input_path).encode())
+    return fingerprint.hexdigest()
+
+
+def read_checkpoint(checkpoint_file, fingerprint):
+    """Return a dict of {individual: packets} for the donors completed in the checkpoint file of an interrupted
+    run, as long as it was written with the same fingerprint."""
+    completed = {}
+    try:
+        with open(checkpoint_file) as f:
+            header = json.loads(f.readline())
+            if header.get("fingerprint") != fingerprint:
+                print(f"{Bcolors.WARNING}The inputs, manifest, template or schema have changed since {checkpoint_file} "
+                      f"was written: all donors will be converted.{Bcolors.ENDC}")
+                return {}
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line is incomplete if the run was killed while writing it
+                    break
+                completed[entry["donor"]] = entry["packets"]
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    return completed
+
+
+class Checkpoint:
+    """
+    Saves the packets of completed donors to an NDJSON file: a header line with the fingerprint of the run,
+    followed by one line per donor. Donors are written every `every` donors.
+    """
+    def __init__(self, checkpoint_file, fingerprint, every, completed=None):
+        self.checkpoint_file = checkpoint_file
+        self.every = every
+        self.pending = []
+        # start a fresh file, carrying over the donors completed by the interrupted run
+        with open(self.checkpoint_file, 'w') as f:
+            f.write(json.dumps({"fingerprint": fingerprint}) + "\n")
+        if completed is not None:
+            for indiv in completed:
+                self.pending.append({"donor": indiv, "packets": completed[indiv]})
+            self.flush()
+
+    def add(self, indiv, packets):
+        self.pending.append({"donor": indiv, "packets": packets})
+        if len(self.pending) >= self.every:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        with open(self.checkpoint_file, 'a') as f:
+            for entry in self.pending:
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.pending = []
+
+    def remove(self):
+        """Remove the checkpoint file once the run has completed."""
+        self.pending = []
+        if os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+
+
+def map_donor(indiv, mapping_scaffold, reference_date=None):
+    """Map all of the data for a single individual onto the mapping scaffold and return the resulting packets."""
+    mappings.IDENTIFIER = indiv
+
+    # If there is a reference_date in the manifest, we need to calculate that and add CALCULATED.REFERENCE_DATE to the INDEXED_DATA
+    if reference_date is not None:
+        ref_temp = f"REFERENCE_DATE, {{{reference_date}}}"
+        reference_date_scaffold = create_scaffold_from_template([ref_temp])
+        func, params = parse_mapping_function(reference_date_scaffold['REFERENCE_DATE'])
+        sheet = params[0].split('.')[0]
+        mappings._push_to_stack(sheet, mappings.IDENTIFIER_FIELD, 0)
+        map_data_to_scaffold(reference_date_scaffold, None, 0)
+        mappings.INDEX_STACK = []
+    mappings._push_to_stack(None, None, 0)
+    packet = map_data_to_scaffold(deepcopy(mapping_scaffold), None, 0)
+    result = []
+    if packet is not None:
+        main_key = list(packet.keys())[0]
+        result = packet[main_key]
+    if mappings._pop_from_stack() is None:
+        raise Exception(f"Stack popped too far!\n{mappings.IDENTIFIER_FIELD}: {mappings.IDENTIFIER}")
+    if mappings._pop_from_stack() is not None:
+        raise Exception(
+            f"Stack not empty\n{mappings.IDENTIFIER_FIELD}: {mappings.IDENTIFIER}\n {mappings.INDEX_STACK}")
+    return result
 
-    # read the schema (from the url specified in the manifest) and generate
-    # a scaffold
+
+def donor_error(indiv, e):
+    """Describe an exception raised while mapping an individual, for the errors file."""
+    if isinstance(e, mappings.MappingError):
+        message = e.value
+    else:
+        message = str(e)
+    frame = traceback.extract_tb(e.__traceback__)[-1]
+    return {
+        "donor": indiv,
+        "error": f"{type(e).__name__}: {message}",
+        "location": f"{frame.filename}:{frame.lineno} in {frame.name}",
+        "template_line": mappings.CURRENT_LINE,
+        "index_stack": deepcopy(mappings.INDEX_STACK)
+    }
+
+
+def csv_convert(input_path, manifest_file, minify=False, index_output=False, verbose=False, typed=False, categorical=False,
+                incremental=False, checkpoint_every=None, resume=False, continue_on_error=False, metrics=False, profile=False, trace=False, trace_sample=1,
+                memprofile=None, fast_validation=False, schema=None):
+    memory = None
+    if memprofile:
+        memory = MemoryProfile()
+    try:
+        return convert_files(input_path, manifest_file, minify=minify, index_output=index_output, verbose=verbose,
+                             typed=typed, categorical=categorical, incremental=incremental,
+                             checkpoint_every=checkpoint_every, resume=resume, continue_on_error=continue_on_error,
+                             metrics=metrics, profile=profile, trace=trace, trace_sample=trace_sample,
+                             memprofile=memprofile, fast_validation=fast_validation, schema=schema, memory=memory)
+    finally:
+        # tracemalloc is stopped even if the conversion fails
+        if memory is not None:
+            memory.stop()
+
+
+def convert_files(input_path, manifest_file, minify=False, index_output=False, verbose=False, typed=False,
+                  categorical=False, incremental=False, checkpoint_every=None, resume=False, continue_on_error=False,
+                  metrics=False, profile=False, trace=False, trace_sample=1, memprofile=None, fast_validation=False,
+                  schema=None, memory=None):
+    """The conversion of csv_convert, which takes the snapshots of --memprofile in memory."""
+    mappings.VERBOSE = verbose
+    etl_metrics.TRACER = None
+    if trace:
+        etl_metrics.TRACER = Tracer(trace_sample)
+    mappings.PROFILE = None
+    if profile:
+        mappings.PROFILE = MappingProfile()
+    run_metrics = Metrics()
+    run_metrics.start("load_manifest")
+    # read manifest data
+    print(f"{Bcolors.OKGREEN}Starting conversion...{Bcolors.ENDC}", end="")
+    manifest = load_manifest(manifest_file, schema)
+    try:
+        check_manifest(manifest)
+    except ConversionError as e:
+        sys.exit(str(e))
+    mappings.IDENTIFIER_FIELD = manifest["identifier"]
+    mappings.DATE_FORMAT = manifest["date_format"]
+    mappings.DATE_LANGUAGES = manifest.get("date_languages", mappings.DEFAULT_DATE_LANGUAGES)
+
+    # the schema (from the url specified in the manifest) was loaded with the manifest
     print(f"{Bcolors.OKGREEN}loading schema...{Bcolors.ENDC}", end="")
     schema = manifest["schema"]
-    if schema.json_schema is None:
-        sys.exit(f"Could not read an openapi schema at {manifest['schema']};\n"
-              f"please check the url in the manifest file links to a valid openAPI schema.")
+    schema.fast_validation = fast_validation
 
     # read the mapping template (contains the mapping function for each
     # field)
     template_lines = read_mapping_template(manifest["mapping"])
+    run_metrics.end("load_manifest")
+    if memory is not None:
+        memory.snapshot("load_manifest")
 
     # read the raw data
     print(f"{Bcolors.OKGREEN}reading raw data...{Bcolors.ENDC}", end="")
+    run_metrics.start("ingest")
+    stage_start = time.perf_counter()
     raw_csv_dfs, mappings.OUTPUT_FILE = ingest_raw_data(input_path)
+    if trace:
+        etl_metrics.TRACER.add("ingest_raw_data", "stage", stage_start)
+    run_metrics.end("ingest")
+    if memory is not None:
+        memory.snapshot("ingest")
     if not raw_csv_dfs:
         sys.exit(f"No ingestable files (csv or xlsx) were found at {input_path}. Check path and try again.")
-    check_for_sheet_inconsistencies(set([re.findall(r"\(([\w\" ]+)", x)[0].replace('"',"") for x in template_lines]),
-                                    set(raw_csv_dfs.keys()))
+    try:
+        check_for_sheet_inconsistencies(sheets_in_template(template_lines), set(raw_csv_dfs.keys()))
+    except ConversionError as e:
+        sys.exit(str(e))
+
+    run_metrics.count("rows", sum(len(raw_csv_dfs[page]) for page in raw_csv_dfs))
+    run_metrics.start("process_data")
+    stage_start = time.perf_counter()
+    column_uses = None
+    if typed:
+        typed_lines = list(template_lines)
+        if "reference_date" in manifest:
+            typed_lines.append(f"REFERENCE_DATE, {{{manifest['reference_date']}}}")
+        column_uses = infer_column_uses(typed_lines)
 
     print(f"{Bcolors.OKGREEN}indexing data{Bcolors.ENDC}")
-    mappings.INDEXED_DATA = process_data(raw_csv_dfs, verbose)
+    mappings.INDEXED_DATA = process_data(raw_csv_dfs, verbose, column_uses=column_uses,
+                                         categorical_columns=manifest.get("categorical"), categorical=categorical)
+    if trace:
+        etl_metrics.TRACER.add("process_data", "stage", stage_start)
+    run_metrics.end("process_data")
+    if memory is not None:
+        memory.snapshot("process_data", mappings.INDEXED_DATA)
+    run_metrics.count("donors", len(mappings.INDEXED_DATA["individuals"]))
     if index_output:
         with open(f"{mappings.OUTPUT_FILE}_indexed.json", 'w') as f:
             if minify:
@@ -700,41 +1140,111 @@ def csv_convert(input_path, manifest_file, minify=False, index_output=False, ver
                     f"Column name {col} present in multiple sheets: {', '.join(mappings.INDEXED_DATA['columns'][col])}")
 
     # warn if any template lines map the same column to multiple lines:
+    run_metrics.start("create_scaffold")
     scan_template_for_duplicate_mappings(template_lines)
 
     mapping_scaffold = create_scaffold_from_template(template_lines)
+    run_metrics.end("create_scaffold")
+    if memory is not None:
+        memory.snapshot("create_scaffold", mappings.INDEXED_DATA)
 
     if mapping_scaffold is None:
         sys.exit("Could not create mapping scaffold. Make sure that the manifest specifies a valid csv template.")
 
+    run_metrics.start("map_donors")
+    # in incremental mode, donors whose input data is unchanged since the last run reuse their previous results
+    state_file = f"{mappings.OUTPUT_FILE}_incremental.json"
+    previous = {}
+    donor_hashes = {}
+    reuse = None
+    reused_donors = 0
+    if incremental or checkpoint_every or resume:
+        fingerprint = fingerprint_conversion(manifest_file, manifest)
+    if incremental:
+        previous = read_incremental_state(state_file, fingerprint)
+        reuse = {}
+
+    # the packets of completed donors are checkpointed so that an interrupted run can be resumed
+    checkpoint = None
+    completed = {}
+    if checkpoint_every or resume:
+        checkpoint_file = f"{mappings.OUTPUT_FILE}_checkpoint.ndjson"
+        checkpoint_fingerprint = hashlib.sha256(f"{fingerprint}{fingerprint_inputs(input_path)}".encode()).hexdigest()
+        if resume:
+            completed = read_checkpoint(checkpoint_file, checkpoint_fingerprint)
+            print(f"{Bcolors.OKGREEN}Resuming: {len(completed)} donors were already completed.{Bcolors.ENDC}")
+        checkpoint = Checkpoint(checkpoint_file, checkpoint_fingerprint, checkpoint_every or DEFAULT_CHECKPOINT_EVERY,
+                                completed)
+
     packets = []
+    packet_donors = []  # the individual that each packet was mapped from
+    donor_errors = []
     # for each identifier's row, make a packet
     print(f"\n{Bcolors.OKGREEN}Creating packets: {Bcolors.ENDC}")
+    stage_start = time.perf_counter()
+    from tqdm import tqdm
     progress = tqdm(mappings.INDEXED_DATA["individuals"])
-    for indiv in progress:
-        progress.set_postfix_str(indiv)
-        # print(f"{Bcolors.OKGREEN}{indiv}  {Bcolors.ENDC}", end="\r")
-        mappings.IDENTIFIER = indiv
-
-        # If there is a reference_date in the manifest, we need to calculate that and add CALCULATED.REFERENCE_DATE to the INDEXED_DATA
-        if "reference_date" in manifest:
-            ref_temp = f"REFERENCE_DATE, {{{manifest['reference_date']}}}"
-            reference_date_scaffold = create_scaffold_from_template([ref_temp])
-            func, params = parse_mapping_function(reference_date_scaffold['REFERENCE_DATE'])
-            sheet = params[0].split('.')[0]
-            mappings._push_to_stack(sheet, mappings.IDENTIFIER_FIELD, 0)
-            map_data_to_scaffold(reference_date_scaffold, None, 0)
-            mappings.INDEX_STACK = []
-        mappings._push_to_stack(None, None, 0)
-        packet = map_data_to_scaffold(deepcopy(mapping_scaffold), None, 0)
-        if packet is not None:
-            main_key = list(packet.keys())[0]
-            packets.extend(packet[main_key])
-        if mappings._pop_from_stack() is None:
-            raise Exception(f"Stack popped too far!\n{mappings.IDENTIFIER_FIELD}: {mappings.IDENTIFIER}")
-        if mappings._pop_from_stack() is not None:
-            raise Exception(
-                f"Stack not empty\n{mappings.IDENTIFIER_FIELD}: {mappings.IDENTIFIER}\n {mappings.INDEX_STACK}")
+    try:
+        for donor_index, indiv in enumerate(progress):
+            progress.set_postfix_str(indiv)
+            if memory is not None and donor_index > 0 and donor_index % memprofile == 0:
+                memory.snapshot(f"{donor_index} donors", mappings.INDEXED_DATA, packets, donor_index)
+            # print(f"{Bcolors.OKGREEN}{indiv}  {Bcolors.ENDC}", end="\r")
+            if incremental:
+                donor_hashes[indiv] = hash_donor_data(indiv)
+            if indiv in completed:
+                packets.extend(completed[indiv])
+                packet_donors.extend([indiv] * len(completed[indiv]))
+                continue
+            if incremental and indiv in previous and previous[indiv]["hash"] == donor_hashes[indiv]:
+                for i in range(0, len(previous[indiv]["packets"])):
+                    reuse[len(packets)] = previous[indiv]["validation"][i]
+                    packets.append(previous[indiv]["packets"][i])
+                    packet_donors.append(indiv)
+                reused_donors += 1
+                donor_packets = previous[indiv]["packets"]
+            else:
+                donor_start = time.perf_counter()
+                try:
+                    donor_packets = map_donor(indiv, mapping_scaffold, manifest.get("reference_date"))
+                except Exception as e:
+                    if not continue_on_error:
+                        raise e
+                    donor_errors.append(donor_error(indiv, e))
+                    mappings.INDEX_STACK = []
+                    # a failed donor has no results to reuse in the next incremental run
+                    donor_hashes.pop(indiv, None)
+                    continue
+                packets.extend(donor_packets)
+                packet_donors.extend([indiv] * len(donor_packets))
+                if trace and etl_metrics.TRACER.sampled(donor_index):
+                    etl_metrics.TRACER.add("map_donor", "donor", donor_start, {"donor": indiv})
+            if checkpoint is not None:
+                checkpoint.add(indiv, donor_packets)
+    finally:
+        # the donors completed before an error are kept, so that they are skipped by --resume
+        if checkpoint is not None:
+            checkpoint.flush()
+    if trace:
+        etl_metrics.TRACER.add("map_donors", "stage", stage_start, {"donors": len(mappings.INDEXED_DATA["individuals"])})
+    run_metrics.end("map_donors")
+    if memory is not None:
+        memory.snapshot("map_donors", mappings.INDEXED_DATA, packets, len(mappings.INDEXED_DATA["individuals"]))
+    run_metrics.count("packets", len(packets))
+    if profile:
+        mappings.PROFILE.print_top(PROFILE_TOP_N)
+        mappings.PROFILE.write_csv(f"{mappings.OUTPUT_FILE}_profile.csv")
+        print(f"Mapping profile written to {mappings.OUTPUT_FILE}_profile.csv.")
+        mappings.PROFILE = None
+    if continue_on_error:
+        with open(f"{mappings.OUTPUT_FILE}_errors.json", 'w') as f:
+            json.dump({"errors": donor_errors}, f, indent=4)
+        if len(donor_errors) > 0:
+            print(f"\n{Bcolors.FAIL}FAILURE: {len(donor_errors)} of {len(mappings.INDEXED_DATA['individuals'])} donors "
+                  f"could not be mapped and were left out of the packets, see {mappings.OUTPUT_FILE}_errors.json "
+                  f"for details.{Bcolors.ENDC}")
+    if incremental:
+        print(f"{Bcolors.OKGREEN}Reused the previous results for {reused_donors} of {len(donor_hashes)} donors.{Bcolors.ENDC}")
     if index_output:
         with open(f"{mappings.OUTPUT_FILE}_indexed.json", 'w') as f:
             if minify:
@@ -742,33 +1252,49 @@ def csv_convert(input_path, manifest_file, minify=False, index_output=False, ver
             else:
                 json.dump(mappings.INDEXED_DATA, f, indent=4)
 
-    result_key = list(schema.validation_schema.keys()).pop(0)
-
-    result = {
-        "openapi_url": schema.openapi_url,
-        "schema_class": type(schema).__name__,
-        result_key: packets
-    }
-    if schema.katsu_sha is not None:
-        result["katsu_sha"] = schema.katsu_sha
+    result = build_map(schema, packets)
     print(f"{Bcolors.OKGREEN}Saving packets to file.{Bcolors.ENDC}")
+    run_metrics.start("write_map")
     with open(f"{mappings.OUTPUT_FILE}_map.json", 'w') as f:  # write to json file for ingestion
         if minify:
             json.dump(result, f)
         else:
             json.dump(result, f, indent=4)
+    run_metrics.end("write_map")
 
     # add validation data:
     print(f"\n{Bcolors.OKGREEN}Starting validation...{Bcolors.ENDC}")
-    schema.validate_ingest_map(result)
+    run_metrics.start("validation")
+    schema.reset_validation()
+    schema.validate_ingest_map(result, reuse=reuse)
+    run_metrics.end("validation")
+    if memory is not None:
+        memory.snapshot("validation", mappings.INDEXED_DATA, packets)
+        memory.stop()
+        memory.print_summary()
+        memory.write(f"{mappings.OUTPUT_FILE}_memprofile.json")
+        print(f"Memory profile written to {mappings.OUTPUT_FILE}_memprofile.json.")
+    if incremental:
+        write_incremental_state(state_file, fingerprint, donor_hashes, packets, packet_donors, schema.donor_results)
     validation_results = {"validation_errors": schema.validation_errors,
                           "validation_warnings": schema.validation_warnings}
     result["statistics"] = schema.statistics
+    run_metrics.start("write_map")
     with open(f"{mappings.OUTPUT_FILE}_map.json", 'w') as f:  # write to json file for ingestion
         if minify:
             json.dump(result, f)
         else:
             json.dump(result, f, indent=4)
+    run_metrics.end("write_map")
+    if metrics:
+        run_metrics.write(f"{mappings.OUTPUT_FILE}_metrics.json")
+        print(f"Metrics written to {mappings.OUTPUT_FILE}_metrics.json.")
+    if trace:
+        etl_metrics.TRACER.write(f"{mappings.OUTPUT_FILE}_trace.json")
+        print(f"Trace written to {mappings.OUTPUT_FILE}_trace.json.")
+        etl_metrics.TRACER = None
+    if checkpoint is not None:
+        checkpoint.remove()
     errors_present = False
     with open(f"{input_path}_validation_results.json", 'w') as f:
         json.dump(validation_results, f, indent=4)
@@ -793,21 +1319,168 @@ def csv_convert(input_path, manifest_file, minify=False, index_output=False, ver
                   f"be ingested until the following errors are fixed:{Bcolors.ENDC}")
             print("\n".join(validation_results["validation_errors"]))
 
+        errors_present = True
+    if len(donor_errors) > 0:
         errors_present = True
     return packets, errors_present
 
 
-def main():
-    args = parse_args()
-    input_path = args.input
-    manifest_file = args.manifest
-    packets, errors = csv_convert(input_path, manifest_file, minify=args.minify, index_output=args.index,
-                                  verbose=args.verbose)
+def build_map(schema, packets):
+    """Return the map of packets that is written to _map.json, before the statistics are added."""
+    result_key = list(schema.validation_schema.keys()).pop(0)
+    result = {
+        "openapi_url": schema.openapi_url,
+        "schema_class": type(schema).__name__,
+        result_key: packets
+    }
+    if schema.katsu_sha is not None:
+        result["katsu_sha"] = schema.katsu_sha
+    return result
+
+
+def validate_map(schema, map_json):
+    """Validate the packets in map_json with a schema object that may have been used before, and return its
+    validation errors and warnings. The statistics are left in schema.statistics."""
+    # a schema object can be reused for many conversions: only report the results of this one
+    schema.reset_validation()
+    schema.validate_ingest_map(map_json)
+    return {"validation_errors": schema.validation_errors,
+            "validation_warnings": schema.validation_warnings}
+
+
+def convert(sheets, manifest, template=None, schema=None, typed=False, continue_on_error=False, output_file=None,
+            minify=False, categorical=False, on_packets=None):
+    """
+    Convert input data that is already in memory, without reading from or writing to disk, printing or exiting.
+    sheets is a dict of {sheet name: pandas DataFrame or list of row dicts}. manifest is a dict with the same
+    keys as a manifest file; paths in it are relative to the current directory. The mapping template can be given
+    as a list of lines in template instead of a path in manifest["mapping"], and a loaded schema object can be
+    given in schema instead of a url or path in manifest["schema"].
+
+    Returns a dict with the packets, the map (as written to _map.json), the validation errors and warnings, the
+    statistics, the donors that could not be mapped (only with continue_on_error) and the messages that the
+    mapping functions would have printed. If on_packets is specified, it is called with the packets of each donor
+    as soon as they are mapped. If output_file is specified, <output_file>_map.json and
+    <output_file>_validation_results.json are written as well.
+    Raises ConversionError if the manifest, template or sheets can't be converted.
+    """
+    manifest = dict(manifest)
+    if schema is not None:
+        manifest["schema"] = schema
+    manifest = parse_manifest(manifest, os.getcwd())
+    check_manifest(manifest)
+    if template is None:
+        if "mapping" not in manifest:
+            raise ConversionError("Need to specify a mapping template as 'mapping' in the manifest or as template.")
+        if not os.path.isfile(manifest["mapping"]):
+            raise ConversionError(f"Mapping template {manifest['mapping']} not found.")
+        template = read_mapping_template(manifest["mapping"])
+    template_lines = list(template)
+    try:
+        scan_template_for_duplicate_mappings(template_lines)
+    except Exception as e:
+        raise ConversionError(str(e))
+    schema = manifest["schema"]
+
+    mappings.IDENTIFIER_FIELD = manifest["identifier"]
+    mappings.DATE_FORMAT = manifest["date_format"]
+    mappings.DATE_LANGUAGES = manifest.get("date_languages", mappings.DEFAULT_DATE_LANGUAGES)
+    mappings.OUTPUT_FILE = output_file
+    mappings.INDEX_STACK = []
+    mappings.PROFILE = None
+    etl_metrics.TRACER = None
+
+    import pandas
+    raw_csv_dfs = {}
+    for sheet in sheets:
+        if isinstance(sheets[sheet], pandas.DataFrame):
+            df = sheets[sheet]
+        else:
+            # values are strings, as if they had been read from a csv
+            df = pandas.DataFrame([{k: None if v is None else str(v) for k, v in row.items()} for row in sheets[sheet]],
+                                  dtype=object)
+        if mappings.IDENTIFIER_FIELD not in df.columns:
+            raise ConversionError(f"Sheet {sheet} does not have the identifier column {mappings.IDENTIFIER_FIELD}.")
+        raw_csv_dfs[sheet] = df
+    if not raw_csv_dfs:
+        raise ConversionError("No sheets were given to convert.")
+    check_for_sheet_inconsistencies(sheets_in_template(template_lines), set(raw_csv_dfs.keys()), quiet=True)
+
+    column_uses = None
+    if typed:
+        typed_lines = list(template_lines)
+        if "reference_date" in manifest:
+            typed_lines.append(f"REFERENCE_DATE, {{{manifest['reference_date']}}}")
+        column_uses = infer_column_uses(typed_lines)
+    mappings.INDEXED_DATA = process_data(raw_csv_dfs, False, column_uses=column_uses,
+                                         categorical_columns=manifest.get("categorical"), categorical=categorical,
+                                         quiet=True)
+    mapping_scaffold = create_scaffold_from_template(template_lines)
+    if mapping_scaffold is None:
+        raise ConversionError("Could not create mapping scaffold. Make sure that the template is a valid csv template.")
+
+    packets = []
+    donor_errors = []
+    messages = []
+    mappings.MESSAGES = messages
+    try:
+        for indiv in mappings.INDEXED_DATA["individuals"]:
+            try:
+                donor_packets = map_donor(indiv, mapping_scaffold, manifest.get("reference_date"))
+            except Exception as e:
+                if not continue_on_error:
+                    raise e
+                donor_errors.append(donor_error(indiv, e))
+                mappings.INDEX_STACK = []
+                continue
+            packets.extend(donor_packets)
+            if on_packets is not None:
+                on_packets(donor_packets)
+    finally:
+        mappings.MESSAGES = None
+
+    result = build_map(schema, packets)
+    validation_results = validate_map(schema, result)
+    result["statistics"] = schema.statistics
+
+    if output_file is not None:
+        with open(f"{output_file}_map.json", 'w') as f:
+            if minify:
+                json.dump(result, f)
+            else:
+                json.dump(result, f, indent=4)
+        with open(f"{output_file}_validation_results.json", 'w') as f:
+            json.dump(validation_results, f, indent=4)
+    return {
+        "packets": packets,
+        "map": result,
+        "validation_errors": validation_results["validation_errors"],
+        "validation_warnings": validation_results["validation_warnings"],
+        "statistics": schema.statistics,
+        "donor_errors": donor_errors,
+        "mapping_messages": messages
+    }
+
+
+def run(args, schema=None):
+    """Convert args.input with the options from parse_args and report whether it can be ingested."""
+    packets, errors = csv_convert(args.input, args.manifest, minify=args.minify, index_output=args.index,
+                                  verbose=args.verbose, typed=args.typed, categorical=args.categorical,
+                                  incremental=args.incremental,
+                                  checkpoint_every=args.checkpoint, resume=args.resume,
+                                  continue_on_error=args.continue_on_error, metrics=args.metrics,
+                                  profile=args.profile, trace=args.trace, trace_sample=args.trace_sample,
+                                  memprofile=args.memprofile, fast_validation=args.fast_validation, schema=schema)
     print(f"{Bcolors.OKGREEN}\nConverted file written to {mappings.OUTPUT_FILE}_map.json{Bcolors.ENDC}")
     if errors:
         print(f"{Bcolors.WARNING}WARNING: this file cannot be ingested until all errors are fixed.{Bcolors.ENDC}")
     else:
         print(f"{Bcolors.OKGREEN}INFO: this file can be ingested.{Bcolors.ENDC}")
+    return packets, errors
+
+
+def main():
+    run(parse_args())
     sys.exit(0)
 
 
@@ -0,0 +1,3 @@
+from clinical_etl.cli import main
+
+main()
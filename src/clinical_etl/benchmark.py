@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import requests
+# Include clinical_etl parent directory in the module search path.
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+from clinical_etl import mappings
+from clinical_etl.CSVConvert import csv_convert, Bcolors
+from clinical_etl.generate_cohort import generate_cohort
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+# a stage is a regression if it is this fraction slower than the baseline...
+DEFAULT_THRESHOLD = 0.2
+# ...and at least this many seconds slower, so that very short stages don't fail on noise
+DEFAULT_MIN_SECONDS = 0.05
+
+# the stages of csv_convert that are compared against the baseline
+STAGES = ["ingest", "process_data", "create_scaffold", "map_donors", "write_map", "validation"]
+
+# modules that should import quickly, e.g. for --help, and the slow dependencies that they should not import
+IMPORT_MODULES = ["clinical_etl.CSVConvert", "clinical_etl.mappings", "clinical_etl.completeness_table"]
+HEAVY_MODULES = ["pandas", "numpy", "dateparser", "jsonschema", "requests", "openapi_spec_validator", "tqdm"]
+DEFAULT_IMPORT_BUDGET = 0.2
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Time each stage of CSVConvert on synthetic cohorts of "
+                                                 "increasing size and compare the results against a baseline.")
+    parser.add_argument('--schema', type=str, help="URL or path to the openAPI schema file. A URL is downloaded once and cached in the working directory")
+    parser.add_argument('--schema_class', type=str, default="MoHSchemaV3", help="Name of the schema class")
+    parser.add_argument('--sizes', type=int, nargs="*", default=DEFAULT_SIZES, help=f"Number of donors in each cohort. Default is {' '.join(str(s) for s in DEFAULT_SIZES)}")
+    parser.add_argument('--workdir', type=str, default="benchmark", help="Directory for the cached schema, the generated cohorts and their outputs")
+    parser.add_argument('--output', type=str, help="File to write the results to. Default is <WORKDIR>/results.json")
+    parser.add_argument('--baseline', type=str, help="Results file of an earlier run to compare against")
+    parser.add_argument('--save_baseline', action="store_true", help="Write the results to the --baseline file instead of comparing against it")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help=f"Fraction slower than the baseline at which a stage is a regression. Default is {DEFAULT_THRESHOLD}")
+    parser.add_argument('--stage_threshold', type=str, nargs="*", default=[], help="Threshold for specific stages, e.g. map_donors=0.1 validation=0.5")
+    parser.add_argument('--min_seconds', type=float, default=DEFAULT_MIN_SECONDS, help=f"Ignore regressions of less than this many seconds. Default is {DEFAULT_MIN_SECONDS}")
+    parser.add_argument('--repeat', type=int, default=1, help="Number of times to convert each cohort; the fastest time for each stage is kept")
+    parser.add_argument('--fanout', type=str, nargs="*", default=[], help="Mean number of objects per parent object for nested schemas, passed to generate_cohort")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the cohort generator")
+    parser.add_argument('--imports', action="store_true", help=f"Only time importing {', '.join(IMPORT_MODULES)}, and fail if any of them takes longer than --import_budget or imports {', '.join(HEAVY_MODULES)}")
+    parser.add_argument('--import_budget', type=float, default=DEFAULT_IMPORT_BUDGET, help=f"Seconds that importing each module may take. Default is {DEFAULT_IMPORT_BUDGET}")
+    args = parser.parse_args(argv)
+    return args
+
+
+def cache_schema(schema, workdir):
+    """Return the path to a local copy of the schema, downloading it into workdir the first time if it is a URL."""
+    if os.path.isfile(schema):
+        return os.path.abspath(schema)
+    cached = os.path.join(os.path.abspath(workdir), f"schema_{hashlib.sha256(schema.encode()).hexdigest()[:16]}.yml")
+    if not os.path.isfile(cached):
+        resp = requests.get(schema)
+        resp.raise_for_status()
+        os.makedirs(workdir, exist_ok=True)
+        with open(cached, 'w') as f:
+            f.write(resp.text)
+    return cached
+
+
+def prepare_cohort(schema_path, workdir, size, schema_class="MoHSchemaV3", fanout=None, seed=0):
+    """Generate a cohort of size donors in workdir, unless one with the same parameters is already there.
+    Returns the paths to the input and the manifest."""
+    params = {
+        "schema": schema_path,
+        "schema_class": schema_class,
+        "donors": size,
+        "fanout": fanout or {},
+        "seed": seed
+    }
+    cohort_dir = os.path.join(workdir, f"cohort_{size}")
+    params_file = os.path.join(cohort_dir, "params.json")
+    if os.path.isfile(params_file):
+        with open(params_file, 'r') as f:
+            if json.load(f) == params:
+                return os.path.join(cohort_dir, "raw_data"), os.path.join(cohort_dir, "manifest.yml")
+    print(f"{Bcolors.OKGREEN}Generating a cohort of {size} donors in {cohort_dir}{Bcolors.ENDC}")
+    input_path, manifest_file = generate_cohort(schema_path, cohort_dir, schema_class=schema_class, donors=size,
+                                                fanout=fanout, seed=seed)
+    with open(params_file, 'w') as f:
+        json.dump(params, f, indent=4)
+    return input_path, manifest_file
+
+
+def run_benchmark(schema, sizes=None, workdir="benchmark", schema_class="MoHSchemaV3", repeat=1, fanout=None,
+                  seed=0):
+    """Convert a generated cohort of each size with metrics enabled and return the fastest time for each stage."""
+    if sizes is None:
+        sizes = DEFAULT_SIZES
+    schema_path = cache_schema(schema, workdir)
+    results = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "schema": schema,
+        "schema_class": schema_class,
+        "repeat": repeat,
+        "sizes": {}
+    }
+    for size in sizes:
+        input_path, manifest_file = prepare_cohort(schema_path, workdir, size, schema_class=schema_class,
+                                                   fanout=fanout, seed=seed)
+        best = None
+        for i in range(0, max(1, repeat)):
+            print(f"{Bcolors.OKGREEN}Converting {size} donors ({i + 1}/{max(1, repeat)}){Bcolors.ENDC}")
+            mappings.INDEX_STACK = []
+            csv_convert(input_path, manifest_file, metrics=True)
+            with open(f"{mappings.OUTPUT_FILE}_metrics.json", 'r') as f:
+                report = json.load(f)
+            if best is None:
+                best = report
+                continue
+            for stage in report["stages"]:
+                for key in ["wall_seconds", "cpu_seconds"]:
+                    best["stages"][stage][key] = min(best["stages"][stage][key], report["stages"][stage][key])
+        best["total"]["wall_seconds"] = round(sum(best["stages"][s]["wall_seconds"] for s in best["stages"]), 4)
+        best["total"]["cpu_seconds"] = round(sum(best["stages"][s]["cpu_seconds"] for s in best["stages"]), 4)
+        results["sizes"][str(size)] = best
+    return results
+
+
+def measure_import(module, repeat=5):
+    """Import module in a new interpreter repeat times. Returns the fastest time in seconds and the slow
+    dependencies (HEAVY_MODULES) that it imported."""
+    code = (f"import sys, time\nstart = time.perf_counter()\nimport {module}\nprint(time.perf_counter() - start)\n"
+            f"print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))")
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([parent_dir] + [p for p in [env.get("PYTHONPATH")] if p])
+    best = None
+    heavy = []
+    for i in range(0, max(1, repeat)):
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                env=env).stdout.splitlines()
+        seconds = float(output[0])
+        if best is None or seconds < best:
+            best = seconds
+        heavy = output[1].split() if len(output) > 1 else []
+    return round(best, 4), heavy
+
+
+def run_import_benchmark(budget=DEFAULT_IMPORT_BUDGET, modules=None, repeat=5):
+    """Time importing each module, and check it against the budget and for slow dependencies."""
+    if modules is None:
+        modules = IMPORT_MODULES
+    results = {}
+    for module in modules:
+        seconds, heavy = measure_import(module, repeat)
+        results[module] = {
+            "seconds": seconds,
+            "heavy_modules": heavy,
+            "within_budget": seconds <= budget and len(heavy) == 0
+        }
+    return results
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD, stage_thresholds=None, min_seconds=DEFAULT_MIN_SECONDS):
+    """
+    Compare the wall time of each stage at each size against the baseline. Returns a row for every stage that
+    is in both, with "regression" set if it is slower by more than its threshold and min_seconds.
+    """
+    if stage_thresholds is None:
+        stage_thresholds = {}
+    rows = []
+    for size in results["sizes"]:
+        if size not in baseline["sizes"]:
+            continue
+        for stage in STAGES + ["total"]:
+            if stage == "total":
+                current = results["sizes"][size]["total"]["wall_seconds"]
+                previous = baseline["sizes"][size]["total"]["wall_seconds"]
+            elif stage in results["sizes"][size]["stages"] and stage in baseline["sizes"][size]["stages"]:
+                current = results["sizes"][size]["stages"][stage]["wall_seconds"]
+                previous = baseline["sizes"][size]["stages"][stage]["wall_seconds"]
+            else:
+                continue
+            stage_threshold = stage_thresholds.get(stage, threshold)
+            change = None
+            if previous > 0:
+                change = (current - previous) / previous
+            rows.append({
+                "size": size,
+                "stage": stage,
+                "baseline_seconds": previous,
+                "seconds": current,
+                "change": change,
+                "threshold": stage_threshold,
+                "regression": current - previous > min_seconds and current > previous * (1 + stage_threshold)
+            })
+    return rows
+
+
+def print_comparison(rows):
+    print(f"\n{'donors':>8}  {'stage':<16}  {'baseline (s)':>12}  {'current (s)':>11}  {'change':>8}")
+    for row in rows:
+        change = ""
+        if row["change"] is not None:
+            change = f"{row['change']:+.1%}"
+        line = f"{row['size']:>8}  {row['stage']:<16}  {row['baseline_seconds']:>12.4f}  {row['seconds']:>11.4f}  {change:>8}"
+        if row["regression"]:
+            print(f"{Bcolors.FAIL}{line}  regression (threshold {row['threshold']:.0%}){Bcolors.ENDC}")
+        else:
+            print(line)
+
+
+def main(args):
+    if args.imports:
+        imports = run_import_benchmark(args.import_budget)
+        for module in imports:
+            line = f"{module:<36}  {imports[module]['seconds']:>8.4f}s  {' '.join(imports[module]['heavy_modules'])}"
+            if imports[module]["within_budget"]:
+                print(line)
+            else:
+                print(f"{Bcolors.FAIL}{line}{Bcolors.ENDC}")
+        if not all(imports[module]["within_budget"] for module in imports):
+            sys.exit(f"{Bcolors.FAIL}Importing is slower than the budget of {args.import_budget}s, or imports "
+                     f"a slow dependency{Bcolors.ENDC}")
+        return
+    if args.schema is None:
+        sys.exit("Specify the schema to benchmark with --schema")
+    fanout = {}
+    for item in args.fanout:
+        name, count = item.split("=")
+        fanout[name] = int(count)
+    stage_thresholds = {}
+    for item in args.stage_threshold:
+        stage, value = item.split("=")
+        if stage not in STAGES and stage != "total":
+            sys.exit(f"Unknown stage {stage}: stages are {', '.join(STAGES)} and total")
+        stage_thresholds[stage] = float(value)
+
+    results = run_benchmark(args.schema, sizes=args.sizes, workdir=args.workdir, schema_class=args.schema_class,
+                            repeat=args.repeat, fanout=fanout, seed=args.seed)
+    output = args.output
+    if output is None:
+        output = os.path.join(args.workdir, "results.json")
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=4)
+    print(f"{Bcolors.OKGREEN}Benchmark results written to {output}{Bcolors.ENDC}")
+
+    if args.baseline is None:
+        return
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=4)
+        print(f"{Bcolors.OKGREEN}Baseline written to {args.baseline}{Bcolors.ENDC}")
+        return
+    try:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        sys.exit(f"Baseline not found at {args.baseline}: create it with --save_baseline")
+    rows = compare(results, baseline, threshold=args.threshold, stage_thresholds=stage_thresholds,
+                   min_seconds=args.min_seconds)
+    print_comparison(rows)
+    regressions = [row for row in rows if row["regression"]]
+    if len(regressions) > 0:
+        sys.exit(f"{Bcolors.FAIL}{len(regressions)} stages are slower than the baseline{Bcolors.ENDC}")
+    print(f"{Bcolors.OKGREEN}No regressions against {args.baseline}{Bcolors.ENDC}")
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import argparse
+import datetime
+import hashlib
+import importlib
+import json
+import os
+import sys
+# Include clinical_etl parent directory in the module search path.
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+from clinical_etl import mappings
+from clinical_etl.CSVConvert import Bcolors, ConversionError
+
+# separates the commands that are chained in one invocation
+CHAIN_SEPARATOR = "then"
+
+# with --schema_cache, schemas downloaded from a url are kept here, and checked for changes when they are used
+# if they were last checked more than CACHE_TTL seconds ago. Otherwise, schemas are only kept in SCHEMAS.
+CACHE_DIR = os.environ.get("CLINICAL_ETL_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "clinical_etl"))
+CACHE_INDEX = "schemas.json"
+USE_CACHE = False
+DEFAULT_CACHE_TTL = 24
+CACHE_TTL = DEFAULT_CACHE_TTL * 60 * 60
+
+# Shared by the commands that are chained in one invocation: the loaded schema objects, keyed by
+# (schema class, url or path)...
+SCHEMAS = {}
+# ...and the results of the previous commands: the "sheets" and the "input" directory they were written to by
+# redcap-split, the "map" and the "map_file" it was written to by convert or read from by validate, and the
+# "validation" results of that map.
+ARTIFACTS = {}
+
+# options of CSVConvert that need an --input on disk
+INPUT_ONLY_OPTIONS = ["index", "incremental", "checkpoint", "resume", "metrics", "profile", "trace", "memprofile"]
+
+
+def parse_args(argv=None):
+    commands = "\n".join(f"  {name:<14}{COMMANDS[name][0]}" for name in COMMANDS)
+    parser = argparse.ArgumentParser(
+        prog="clinical_etl",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="Run the clinical_etl tools. Use `clinical_etl <command> -h` for the options of each command.",
+        epilog=f"commands:\n{commands}\n\nCommands can be chained with '{CHAIN_SEPARATOR}': each command uses the "
+               f"schema and the results of the previous ones instead of reading them again, e.g.\n"
+               f"  clinical_etl redcap-split --input raw_redcap.csv {CHAIN_SEPARATOR} convert --manifest manifest.yml "
+               f"{CHAIN_SEPARATOR} completeness")
+    parser.add_argument('--schema_cache', action="store_true", help="Keep the schemas downloaded from a url in the schema cache, instead of downloading them again in every run")
+    parser.add_argument('--cache_dir', type=str, default=CACHE_DIR, help=f"Directory of the schema cache. Default is {CACHE_DIR}, or $CLINICAL_ETL_CACHE")
+    parser.add_argument('--cache_ttl', type=float, default=DEFAULT_CACHE_TTL, help=f"Check a cached schema for changes if it was last checked more than this many hours ago. Default is {DEFAULT_CACHE_TTL}")
+    parser.add_argument('command', type=str, choices=list(COMMANDS.keys()), metavar="command", help="One of the commands below")
+    parser.add_argument('arguments', nargs=argparse.REMAINDER, help="Options of the command")
+    args = parser.parse_args(argv)
+    return args
+
+
+def split_chain(command, arguments):
+    """Split the command line into a list of [command, argument, ...] for each chained command."""
+    steps = [[command]]
+    for arg in arguments:
+        if arg == CHAIN_SEPARATOR:
+            steps.append([])
+        else:
+            steps[-1].append(arg)
+    for step in steps:
+        if len(step) == 0 or step[0] not in COMMANDS:
+            raise ConversionError(f"Expected one of {', '.join(COMMANDS.keys())} after '{CHAIN_SEPARATOR}'")
+    return steps
+
+
+def read_cache_index():
+    try:
+        with open(os.path.join(CACHE_DIR, CACHE_INDEX), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_cache_index(index):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(os.path.join(CACHE_DIR, CACHE_INDEX), 'w') as f:
+        json.dump(index, f, indent=4)
+
+
+def fetch_schema(url, force=False):
+    """
+    Download the schema at url into the cache and return the path to it. If it is already cached, it is only
+    downloaded again if the server reports that it has changed since (by its ETag or Last-Modified), unless force.
+    """
+    import requests
+    index = read_cache_index()
+    entry = index.get(url)
+    if entry is not None and not os.path.isfile(os.path.join(CACHE_DIR, entry["file"])):
+        entry = None
+    headers = {}
+    if entry is not None and not force:
+        if entry.get("etag") is not None:
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified") is not None:
+            headers["If-Modified-Since"] = entry["last_modified"]
+    try:
+        resp = requests.get(url, headers=headers)
+        resp.raise_for_status()
+    except Exception as e:
+        raise ConversionError(f"Could not download the schema at {url}: {e}")
+    now = datetime.datetime.now().isoformat(timespec="seconds")
+    if resp.status_code == 304 and len(headers) > 0:
+        entry["checked"] = now
+    else:
+        path = os.path.join(CACHE_DIR, f"schema_{hashlib.sha256(url.encode()).hexdigest()[:16]}.yml")
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(resp.text)
+        entry = {"file": os.path.basename(path), "fetched": now, "checked": now,
+                 "etag": resp.headers.get("ETag"), "last_modified": resp.headers.get("Last-Modified")}
+    index[url] = entry
+    write_cache_index(index)
+    return os.path.join(CACHE_DIR, entry["file"])
+
+
+def cached_schema(url):
+    """Return the path to the cached schema for url, checking it for changes if it hasn't been checked within
+    CACHE_TTL. If it can't be checked, the cached schema is used."""
+    entry = read_cache_index().get(url)
+    if entry is None or not os.path.isfile(os.path.join(CACHE_DIR, entry["file"])):
+        return fetch_schema(url)
+    checked = datetime.datetime.fromisoformat(entry.get("checked", entry["fetched"]))
+    if (datetime.datetime.now() - checked).total_seconds() <= CACHE_TTL:
+        return os.path.join(CACHE_DIR, entry["file"])
+    try:
+        return fetch_schema(url)
+    except ConversionError as e:
+        print(f"{Bcolors.WARNING}Using the schema cached on {entry['fetched']}. {e}{Bcolors.ENDC}")
+        return os.path.join(CACHE_DIR, entry["file"])
+
+
+def load_schema(schema_class, url):
+    """Return the schema object for schema_class and the url or path, loading it the first time it is used in
+    this process. With --schema_cache, a url is read from the schema cache (see cached_schema)."""
+    key = (schema_class, url)
+    if key not in SCHEMAS:
+        path = url
+        if USE_CACHE and not os.path.isfile(url):
+            path = cached_schema(url)
+        try:
+            schema_mod = importlib.import_module(f"clinical_etl.{schema_class.lower()}")
+            schema = getattr(schema_mod, schema_class)(path)
+        except (ImportError, AttributeError):
+            raise ConversionError(f"{schema_class} is not a schema class")
+        if schema.json_schema is None:
+            raise ConversionError(f"Could not read an openapi schema at {url}")
+        # the map records where the schema came from, not where it was cached
+        schema.openapi_url = url
+        SCHEMAS[key] = schema
+    return SCHEMAS[key]
+
+
+def read_manifest(manifest_file):
+    import yaml
+    try:
+        with open(manifest_file, 'r') as f:
+            manifest = yaml.safe_load(f)
+    except FileNotFoundError:
+        raise ConversionError(f"Manifest file not found at provided path: {manifest_file}")
+    except yaml.YAMLError as e:
+        raise ConversionError(f"Manifest file isn't a valid yaml: {e}")
+    if not isinstance(manifest, dict) or "schema" not in manifest:
+        raise ConversionError("Need to specify an OpenAPI schema as 'schema' in the manifest file, "
+                              "see README for more details.")
+    return manifest
+
+
+def run_convert(argv):
+    from clinical_etl import CSVConvert
+    parser = argparse.ArgumentParser(prog="clinical_etl convert", description="Convert an xlsx file or a directory of csvs into packets. Without --input, the sheets from redcap-split are converted.")
+    CSVConvert.add_arguments(parser, input_required=False)
+    args = parser.parse_args(argv)
+    if args.fast_validation:
+        use_fast_validation()
+    manifest = read_manifest(args.manifest)
+    schema = load_schema(manifest.get("schema_class", "MoHSchemaV2"), manifest["schema"])
+
+    if args.input is not None:
+        packets, errors = CSVConvert.run(args, schema)
+        map_json = CSVConvert.build_map(schema, packets)
+        map_json["statistics"] = schema.statistics
+    else:
+        if "sheets" not in ARTIFACTS:
+            raise ConversionError("convert needs --input, unless it follows redcap-split")
+        options = [option for option in INPUT_ONLY_OPTIONS if getattr(args, option)]
+        if options:
+            raise ConversionError(f"--{', --'.join(options)} can only be used with --input")
+        mappings.VERBOSE = args.verbose
+        manifest["schema"] = schema
+        manifest = CSVConvert.parse_manifest(manifest, os.path.dirname(os.path.abspath(args.manifest)))
+        print(f"{Bcolors.OKGREEN}Converting the sheets from {ARTIFACTS['input']}...{Bcolors.ENDC}")
+        result = CSVConvert.convert(ARTIFACTS["sheets"], manifest, schema=schema, typed=args.typed,
+                                    categorical=args.categorical,
+                                    continue_on_error=args.continue_on_error, output_file=ARTIFACTS["input"],
+                                    minify=args.minify)
+        for message in result["mapping_messages"]:
+            print(message)
+        map_json = result["map"]
+        errors = len(result["validation_errors"]) > 0 or len(result["donor_errors"]) > 0
+        print(f"{Bcolors.OKGREEN}Converted file written to {mappings.OUTPUT_FILE}_map.json, with "
+              f"{len(result['validation_warnings'])} validation warnings and {len(result['validation_errors'])} "
+              f"validation errors{Bcolors.ENDC}")
+        if errors:
+            print(f"{Bcolors.WARNING}WARNING: this file cannot be ingested until all errors are fixed.{Bcolors.ENDC}")
+        else:
+            print(f"{Bcolors.OKGREEN}INFO: this file can be ingested.{Bcolors.ENDC}")
+    ARTIFACTS["map"] = map_json
+    ARTIFACTS["map_file"] = f"{mappings.OUTPUT_FILE}_map.json"
+    ARTIFACTS["validation"] = {
+        "schema": schema,
+        "errors": schema.validation_errors,
+        "warnings": schema.validation_warnings,
+        "statistics": schema.statistics
+    }
+
+
+def run_validate(argv):
+    from clinical_etl import jsonstream, validate_coverage, validation_cache
+    parser = argparse.ArgumentParser(prog="clinical_etl validate", description="Validate a _map.json file. Without --json, the map from convert is validated.")
+    parser.add_argument('--json', type=str, help="<input-file-path-name>_map.json file generated by CSVConvert.py.")
+    parser.add_argument('--verbose', '--v', action="store_true", help="Print extra information")
+    parser.add_argument('--stream', action="store_true", help="Decode and validate one packet of --json at a time instead of loading the whole file. Always used for a .ndjson map.")
+    parser.add_argument('--cache', type=str, nargs="?", const="", help="Reuse the results of packets that are unchanged since the last run with --cache, from a cache file, <map>_validation_cache.json by default.")
+    parser.add_argument('--rule_stats', action="store_true", help="Time the conditional rules of the schema and print how many times each one was evaluated and the time spent in it.")
+    parser.add_argument('--fast-validation', action="store_true", help="Validate packets against the json schema with a validator generated from it and cached with the schema, instead of with jsonschema. The errors are the same.")
+    args = parser.parse_args(argv)
+    if args.fast_validation:
+        use_fast_validation()
+    cache_path = args.cache
+    if cache_path == "":
+        cache_path = validation_cache.default_path(args.json or ARTIFACTS.get("map_file", ""))
+    if args.json is not None and (args.stream or jsonstream.is_ndjson(args.json)):
+        # the map isn't kept in memory, only the results of validating it
+        if not os.path.isfile(args.json):
+            raise ConversionError(f"JSON file not found at {args.json}")
+        header = jsonstream.map_header(args.json, required=["openapi_url"])
+        if "openapi_url" not in header:
+            raise ConversionError("No openapi_url key found in the map json, it should end with '_map.json'.")
+        schema = load_schema(header.get("schema_class", "MoHSchemaV3"), header["openapi_url"])
+        result = validate_coverage.stream_coverage(args.json, args.verbose, schema=schema, cache_path=cache_path,
+                                                   rule_stats=args.rule_stats, fast_validation=args.fast_validation)
+        ARTIFACTS.pop("map", None)
+        ARTIFACTS["map_file"] = args.json
+        ARTIFACTS["validation"] = {"schema": schema, **result}
+        validate_coverage.report(result)
+        return
+    if args.json is not None:
+        try:
+            with open(args.json) as fp:
+                ARTIFACTS["map"] = json.load(fp)
+        except FileNotFoundError:
+            raise ConversionError(f"JSON file not found at {args.json}")
+        ARTIFACTS["map_file"] = args.json
+        ARTIFACTS.pop("validation", None)
+    elif "map" not in ARTIFACTS:
+        raise ConversionError("validate needs --json, unless it follows convert")
+    map_json = ARTIFACTS["map"]
+    if "openapi_url" not in map_json:
+        raise ConversionError("No openapi_url key found in the map json, it should end with '_map.json'.")
+    schema = load_schema(map_json.get("schema_class", "MoHSchemaV3"), map_json["openapi_url"])
+
+    # the map was already validated with this schema by convert
+    previous = ARTIFACTS.get("validation")
+    if previous is not None and previous["schema"] is schema and cache_path is None and not args.rule_stats:
+        result = {key: previous[key] for key in ["errors", "warnings", "statistics"]}
+    else:
+        result = validate_coverage.validate_coverage(map_json, args.verbose, schema=schema, cache_path=cache_path,
+                                                     rule_stats=args.rule_stats,
+                                                     fast_validation=args.fast_validation)
+        ARTIFACTS["validation"] = {"schema": schema, **result}
+    validate_coverage.report(result)
+
+
+def run_completeness(argv):
+    from clinical_etl import completeness_table, jsonstream
+    parser = argparse.ArgumentParser(prog="clinical_etl completeness", description="Write the completeness table of a _map.json file to _completeness.csv. Without --input, the table of the map from convert or validate is written.")
+    parser.add_argument('--input', type=str, help="Path to input json file")
+    parser.add_argument('--fields', action="store_true", help="Also write the completeness of every field in the schema to <INPUT>_field_completeness.csv")
+    args = parser.parse_args(argv)
+    if args.input is not None:
+        schema = None
+        if args.fields:
+            header = jsonstream.map_header(args.input, required=["openapi_url"])
+            if "openapi_url" not in header:
+                raise ConversionError("No openapi_url key found in the map json, it should end with '_map.json'.")
+            schema = load_schema(header.get("schema_class", "MoHSchemaV3"), header["openapi_url"])
+        completeness_table.generate_csv(args.input, args.fields, schema=schema)
+        return
+    if "validation" not in ARTIFACTS:
+        raise ConversionError("completeness needs --input, unless it follows convert or validate")
+    output_path = completeness_table.output_path(ARTIFACTS["map_file"], "_completeness.csv")
+    print(f"Writing {output_path}")
+    completeness_table.write_csv(ARTIFACTS["validation"]["statistics"], output_path)
+    if args.fields:
+        schema = ARTIFACTS["validation"]["schema"]
+        root_schema = list(schema.validation_schema.keys())[0]
+        if "map" in ARTIFACTS:
+            packets = ARTIFACTS["map"][root_schema]
+        else:
+            packets = jsonstream.map_packets(ARTIFACTS["map_file"], root_schema)
+        counts = completeness_table.FieldCompleteness(schema)
+        for packet in packets:
+            counts.add(packet)
+        output_path = completeness_table.output_path(ARTIFACTS["map_file"], "_field_completeness.csv")
+        counts.write_csv(output_path)
+        print(f"Field completeness written to {output_path}")
+
+
+def run_template(argv):
+    from clinical_etl import generate_schema
+    args = generate_schema.parse_args(argv)
+    generate_schema.write_template(load_schema(args.schema, args.url), args.url, args.out)
+
+
+def run_redcap_split(argv):
+    from clinical_etl import split_redcap_data
+    output_dir, new_dfs = split_redcap_data.main(split_redcap_data.parse_args(argv))
+    # the same as the csvs that were written, so that convert doesn't have to read them
+    ARTIFACTS["sheets"] = {name: new_dfs[name].reset_index(drop=True) for name in new_dfs}
+    ARTIFACTS["input"] = os.path.normpath(output_dir)
+
+
+def run_bench(argv):
+    from clinical_etl import benchmark
+    benchmark.main(benchmark.parse_args(argv))
+
+
+def run_cache(argv):
+    parser = argparse.ArgumentParser(prog="clinical_etl cache", description="Manage the schemas downloaded to the cache.")
+    parser.add_argument('action', type=str, choices=["list", "fetch", "clear"], help="List the cached schemas, download them again, or remove them")
+    parser.add_argument('urls', type=str, nargs="*", help="Schema urls to fetch or clear. Default is all cached schemas")
+    args = parser.parse_args(argv)
+    index = read_cache_index()
+    urls = args.urls or list(index.keys())
+    if args.action == "list":
+        print(f"Schema cache in {CACHE_DIR}")
+        for url in urls:
+            if url in index:
+                print(f"{index[url]['fetched']}  {index[url]['file']}  {url}")
+    elif args.action == "fetch":
+        for url in urls:
+            fetch_schema(url, force=True)
+            print(f"Fetched {url}")
+    else:
+        for url in urls:
+            if url in index:
+                path = os.path.join(CACHE_DIR, index.pop(url)["file"])
+                if os.path.isfile(path):
+                    os.remove(path)
+                print(f"Removed {url}")
+        write_cache_index(index)
+        if not args.urls:
+            # the validators generated from the schemas by --fast-validation
+            for name in os.listdir(CACHE_DIR) if os.path.isdir(CACHE_DIR) else []:
+                if name.startswith("fastvalidator_"):
+                    os.remove(os.path.join(CACHE_DIR, name))
+    # the schemas loaded in this process may be out of date now
+    for key in [key for key in SCHEMAS if key[1] in urls]:
+        SCHEMAS.pop(key)
+
+
+# each command with its description and the function that runs it
+COMMANDS = {
+    "convert": ("Convert an xlsx file or a directory of csvs into packets (CSVConvert.py)", run_convert),
+    "validate": ("Validate a _map.json file (validate_coverage.py)", run_validate),
+    "completeness": ("Write the completeness table of a _map.json file (completeness_table.py)", run_completeness),
+    "template": ("Write the mapping template for a schema (generate_schema.py)", run_template),
+    "redcap-split": ("Split a REDCap export into one csv per instrument (split_redcap_data.py)", run_redcap_split),
+    "bench": ("Benchmark the conversion stages or the imports (benchmark.py)", run_bench),
+    "cache": ("List, fetch again or clear the cached schemas", run_cache)
+}
+
+
+def use_fast_validation():
+    """The validators generated by --fast-validation are cached with the schemas."""
+    from clinical_etl import fastvalidator
+    fastvalidator.CACHE_DIR = CACHE_DIR
+
+
+def main(argv=None):
+    global CACHE_DIR, USE_CACHE, CACHE_TTL
+    args = parse_args(argv)
+    CACHE_DIR = args.cache_dir
+    USE_CACHE = args.schema_cache
+    CACHE_TTL = args.cache_ttl * 60 * 60
+    ARTIFACTS.clear()
+    try:
+        steps = split_chain(args.command, args.arguments)
+        for step in steps:
+            COMMANDS[step[0]][1](step[1:])
+    except ConversionError as e:
+        sys.exit(f"{Bcolors.FAIL}{e}{Bcolors.ENDC}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,33 +1,145 @@
 import argparse
-import json
+import importlib
+import os
+import re
+import sys
+# Include clinical_etl parent directory in the module search path.
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+from clinical_etl import jsonstream
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--input", type=str, required=True, help="Path to input json file"
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "--fields", action="store_true",
+        help="Also write the completeness of every field in the schema to <INPUT>_field_completeness.csv"
+    )
+    args = parser.parse_args(argv)
     return args
 
 
-def generate_csv(input_path):
-    output_path = input_path.replace("_map.json", "_completeness.csv")
-    print(f"Converting {input_path} to {output_path}")
-    with open(input_path) as f:
-        stats_dict = json.load(f)["statistics"]
+def output_path(input_path, suffix):
+    return re.sub(r"(_map)?\.(json|ndjson|jsonl)$", "", input_path) + suffix
+
+
+class FieldCompleteness:
+    """
+    Counts how many of the objects at each path in the schema's scaffold have a value for each of their fields,
+    one packet at a time. The counts are kept in arrays indexed by field, so that a packet only has to be
+    looked at once and only the counts are held in memory.
+    """
+    def __init__(self, schema):
+        # for each field: the path of its object in the scaffold, its name, the index of its object's count,
+        # and how many times it has a value
+        self.fields = []
+        self.parents = []
+        self.present = []
+        # the number of objects seen at each path
+        self.objects = []
+        self.root = self.compile(schema.scaffold, list(schema.validation_schema.keys())[0])
+
+    def compile(self, scaffold, path):
+        """Return (object index, {field name: (field index, node of the field's object or None)}) for the
+        object at path."""
+        object_index = len(self.objects)
+        self.objects.append(0)
+        node = {}
+        for name, field in scaffold.items():
+            field_index = len(self.fields)
+            self.fields.append((path, name))
+            self.parents.append(object_index)
+            self.present.append(0)
+            if isinstance(field, list):
+                field = field[0]
+            child = None
+            if isinstance(field, dict):
+                child = self.compile(field, f"{path}.{name}")
+            node[name] = (field_index, child)
+        return object_index, node
+
+    def add(self, packet):
+        self.count(self.root, packet)
+
+    def count(self, node, obj):
+        object_index, fields = node
+        self.objects[object_index] += 1
+        for name, value in obj.items():
+            if name not in fields or value is None or value == "" or value == [] or value == {}:
+                continue
+            field_index, child = fields[name]
+            self.present[field_index] += 1
+            if child is None:
+                continue
+            if isinstance(value, dict):
+                self.count(child, value)
+            elif isinstance(value, list):
+                for item in value:
+                    if isinstance(item, dict):
+                        self.count(child, item)
+
+    def write_csv(self, output_path):
+        """Write the completeness of each field. Fields of objects that never occur have no fraction missing."""
         with open(output_path, "w") as out:
             out.write("Schema,Field,Total,Missing,Fraction_missing\n")
-            required_but_missing = stats_dict["required_but_missing"]
-            for k, v in required_but_missing.items():
-                for field, stats in v.items():
-                    total = stats["total"]
-                    missing = stats["missing"]
-                    fraction = missing / total
-                    out.write(f"{k},{field},{total},{missing},{round(fraction,2)}\n")
+            for field_index, (path, name) in enumerate(self.fields):
+                total = self.objects[self.parents[field_index]]
+                missing = total - self.present[field_index]
+                fraction = round(missing / total, 2) if total > 0 else ""
+                out.write(f"{path},{name},{total},{missing},{fraction}\n")
+
+
+def load_schema(header):
+    schema_class = header.get("schema_class", "MoHSchemaV3")
+    schema_mod = importlib.import_module(f"clinical_etl.{schema_class.lower()}")
+    return getattr(schema_mod, schema_class)(header["openapi_url"])
+
+
+def generate_csv(input_path, fields=False, schema=None):
+    """
+    Write the required_but_missing statistics of the map at input_path to <INPUT>_completeness.csv, and with
+    fields, the completeness of every field in the schema to <INPUT>_field_completeness.csv. The map is read
+    one packet at a time, in a single pass. A schema object that is already loaded can be given as schema.
+    """
+    completeness_path = output_path(input_path, "_completeness.csv")
+    print(f"Converting {input_path} to {completeness_path}")
+    if not fields:
+        stats_dict = jsonstream.map_header(input_path, required=["statistics"])["statistics"]
+        write_csv(stats_dict, completeness_path)
+        return
+    header = jsonstream.map_header(input_path, required=["openapi_url"])
+    if schema is None:
+        schema = load_schema(header)
+    counts = FieldCompleteness(schema)
+    for packet in jsonstream.map_packets(input_path, list(schema.validation_schema.keys())[0], header):
+        counts.add(packet)
+    if "statistics" in header:
+        write_csv(header["statistics"], completeness_path)
+    else:
+        print(f"{input_path} has no statistics, so only the field completeness is written")
+    field_path = output_path(input_path, "_field_completeness.csv")
+    counts.write_csv(field_path)
+    print(f"Field completeness written to {field_path}")
+
+
+def write_csv(stats_dict, output_path):
+    """Write the required_but_missing statistics of a map to output_path."""
+    with open(output_path, "w") as out:
+        out.write("Schema,Field,Total,Missing,Fraction_missing\n")
+        required_but_missing = stats_dict["required_but_missing"]
+        for k, v in required_but_missing.items():
+            for field, stats in v.items():
+                total = stats["total"]
+                missing = stats["missing"]
+                fraction = missing / total
+                out.write(f"{k},{field},{total},{missing},{round(fraction,2)}\n")
 
 
 if __name__ == "__main__":
     args = parse_args()
     input_path = args.input
-    generate_csv(input_path)
+    generate_csv(input_path, args.fields)
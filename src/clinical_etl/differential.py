@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import argparse
+import importlib
+import json
+import os
+import shutil
+import sys
+import traceback
+import yaml
+# Include clinical_etl parent directory in the module search path.
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+from clinical_etl import mappings
+from clinical_etl.CSVConvert import csv_convert, Bcolors
+from clinical_etl.generate_cohort import generate_cohort
+from clinical_etl import split_redcap_data
+
+# The repository checkout that contains tests/raw_data and sample_inputs, if clinical_etl is run from one
+REPO_DIR = os.path.dirname(parent_dir)
+
+# Each mapping engine is the set of csv_convert options that selects it. "legacy" is the reference
+# map_data_to_scaffold path: a new engine is added here and compared against it.
+ENGINES = {
+    "legacy": {},
+    "typed": {"typed": True}
+}
+
+# longest value shown in a diff
+MAX_VALUE_LENGTH = 80
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Convert the same inputs with two mapping engines and report "
+                                                 "every donor whose packet or validation results differ.")
+    parser.add_argument('--engines', type=str, nargs=2, default=["legacy", "typed"], choices=list(ENGINES.keys()), help="The reference engine and the engine to compare against it. Default is legacy typed")
+    parser.add_argument('--workdir', type=str, default="differential", help="Directory for the generated inputs and the outputs of each engine")
+    parser.add_argument('--cohorts', type=int, nargs="*", default=[100], help="Sizes of the generated cohorts to compare. Default is 100")
+    parser.add_argument('--schema', type=str, help="URL or path to the openAPI schema for the generated cohorts. Default is the schema in tests/manifest.yml")
+    parser.add_argument('--case', type=str, nargs=2, action="append", default=[], metavar=("INPUT", "MANIFEST"), help="An additional input and manifest to compare; can be repeated")
+    parser.add_argument('--no_examples', action="store_true", help="Only compare the generated cohorts and any --case inputs")
+    parser.add_argument('--max_diffs', type=int, default=10, help="Maximum number of differences reported for each donor")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the cohort generator")
+    args = parser.parse_args()
+    return args
+
+
+def split_redcap_example(output_dir):
+    """Split the sample REDCap export into one csv per instrument in output_dir."""
+    example_dir = os.path.join(REPO_DIR, "sample_inputs", "redcap_example")
+    export_path = os.path.join(example_dir, "raw_redcap.csv")
+    raw_csv_dfs = split_redcap_data.read_redcap_export(export_path)
+    new_dfs = split_redcap_data.extract_repeat_instruments(raw_csv_dfs[export_path])
+    os.makedirs(output_dir, exist_ok=True)
+    for name in new_dfs:
+        new_dfs[name].to_csv(os.path.join(output_dir, f"{name}.csv"), index=False)
+    return output_dir
+
+
+def prepare_cases(workdir, cohorts=None, schema=None, examples=True, extra_cases=None, seed=0):
+    """
+    Return a list of (name, input_path, manifest_file) to compare: tests/raw_data, the REDCap example, a cohort
+    generated from the generic example's template and generated cohorts of each size in cohorts, followed by
+    extra_cases.
+    """
+    cases = []
+    tests_manifest = os.path.join(REPO_DIR, "tests", "manifest.yml")
+    if schema is None and os.path.isfile(tests_manifest):
+        with open(tests_manifest, 'r') as f:
+            schema = yaml.safe_load(f)["schema"]
+    if examples and os.path.isdir(os.path.join(REPO_DIR, "tests", "raw_data")):
+        cases.append(("tests/raw_data", os.path.join(REPO_DIR, "tests", "raw_data"), tests_manifest))
+        redcap_dir = os.path.join(REPO_DIR, "sample_inputs", "redcap_example")
+        cases.append(("redcap_example", split_redcap_example(os.path.join(workdir, "inputs", "redcap_example")),
+                      os.path.join(redcap_dir, "manifest.yml")))
+        # the generic example is a template without data: generate a cohort for it
+        generic_dir = os.path.join(REPO_DIR, "sample_inputs", "generic_example")
+        with open(os.path.join(generic_dir, "manifest.yml"), 'r') as f:
+            generic_manifest = yaml.safe_load(f)
+        input_path, manifest_file = generate_cohort(generic_manifest["schema"],
+                                                    os.path.join(workdir, "inputs", "generic_example"),
+                                                    schema_class=generic_manifest.get("schema_class", "MoHSchemaV2"),
+                                                    template=os.path.join(generic_dir, generic_manifest["mapping"]),
+                                                    donors=20, seed=seed)
+        cases.append(("generic_example", input_path, manifest_file))
+    if cohorts is None:
+        cohorts = []
+    for size in cohorts:
+        if schema is None:
+            sys.exit("Specify --schema to generate cohorts")
+        input_path, manifest_file = generate_cohort(schema, os.path.join(workdir, "inputs", f"cohort_{size}"),
+                                                    donors=size, seed=seed)
+        cases.append((f"cohort_{size}", input_path, manifest_file))
+    if extra_cases is not None:
+        for input_path, manifest_file in extra_cases:
+            cases.append((input_path, os.path.abspath(input_path), os.path.abspath(manifest_file)))
+    return cases
+
+
+def run_engine(engine, input_path, manifest_file, output_dir):
+    """
+    Convert a copy of the input in output_dir with the engine, and return its map and validation results, or
+    the error that stopped the conversion.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    copy_path = os.path.join(output_dir, os.path.basename(input_path.rstrip(os.sep)))
+    if os.path.isdir(input_path):
+        shutil.copytree(input_path, copy_path, dirs_exist_ok=True)
+    else:
+        shutil.copy(input_path, copy_path)
+    mappings.INDEX_STACK = []
+    try:
+        csv_convert(copy_path, manifest_file, **ENGINES[engine])
+        with open(f"{mappings.OUTPUT_FILE}_map.json", 'r') as f:
+            map_json = json.load(f)
+        with open(f"{copy_path}_validation_results.json", 'r') as f:
+            validation = json.load(f)
+    except (Exception, SystemExit) as e:
+        return {"error": "".join(traceback.format_exception_only(type(e), e)).strip()}
+    return {"map": map_json, "validation": validation}
+
+
+def short_value(value):
+    result = json.dumps(value)
+    if len(result) > MAX_VALUE_LENGTH:
+        result = result[:MAX_VALUE_LENGTH - 3] + "..."
+    return result
+
+
+def structural_diff(a, b, path="", diffs=None):
+    """Return a list of {"path", "a", "b"} for every value that differs between a and b, recursing into
+    dicts and lists. A missing value is reported as "<missing>"."""
+    if diffs is None:
+        diffs = []
+    if isinstance(a, dict) and isinstance(b, dict):
+        for key in list(a.keys()) + [k for k in b.keys() if k not in a]:
+            key_path = f"{path}.{key}" if path != "" else key
+            if key not in b:
+                diffs.append({"path": key_path, "a": short_value(a[key]), "b": "<missing>"})
+            elif key not in a:
+                diffs.append({"path": key_path, "a": "<missing>", "b": short_value(b[key])})
+            else:
+                structural_diff(a[key], b[key], key_path, diffs)
+    elif isinstance(a, list) and isinstance(b, list):
+        for i in range(0, max(len(a), len(b))):
+            if i >= len(b):
+                diffs.append({"path": f"{path}[{i}]", "a": short_value(a[i]), "b": "<missing>"})
+            elif i >= len(a):
+                diffs.append({"path": f"{path}[{i}]", "a": "<missing>", "b": short_value(b[i])})
+            else:
+                structural_diff(a[i], b[i], f"{path}[{i}]", diffs)
+    elif a != b or type(a) is not type(b):
+        diffs.append({"path": path, "a": short_value(a), "b": short_value(b)})
+    return diffs
+
+
+def donor_messages(messages, donor_ids):
+    """Group validation messages by the donor they are about; messages about no known donor are grouped
+    under None."""
+    result = {}
+    for message in messages:
+        donor = message.split(":")[0].split(" > ")[0].strip()
+        if donor not in donor_ids:
+            donor = None
+        if donor not in result:
+            result[donor] = []
+        result[donor].append(message)
+    return result
+
+
+def packet_label(donor, occurrence):
+    """The name of the occurrence'th packet (from 0) with the id donor in the differences."""
+    if donor is None:
+        return f"(no id) #{occurrence + 1}"
+    if occurrence == 0:
+        return donor
+    return f"{donor} #{occurrence + 1}"
+
+
+def compare_outputs(a, b):
+    """
+    Compare the map and validation results of two engines donor by donor. Packets with the same id are compared
+    in the order they occur. Returns the number of packets and a dict of the differences for each donor that
+    differs; differences outside the donors are under None.
+    """
+    schema_class = a["map"]["schema_class"]
+    schema_mod = importlib.import_module(f"clinical_etl.{schema_class.lower()}")
+    validation_schema = getattr(schema_mod, schema_class).validation_schema
+    result_key = list(validation_schema.keys())[0]
+    id_key = validation_schema[result_key]["id"]
+
+    packets = [{}, {}]
+    for i, output in enumerate([a, b]):
+        occurrences = {}
+        for packet in output["map"][result_key]:
+            donor = packet.get(id_key)
+            occurrences[donor] = occurrences.get(donor, 0) + 1
+            packets[i][packet_label(donor, occurrences[donor] - 1)] = packet
+    labels = list(packets[0].keys()) + [d for d in packets[1].keys() if d not in packets[0]]
+    differences = {}
+    for label in labels:
+        diffs = structural_diff(packets[0].get(label), packets[1].get(label), "packet")
+        if len(diffs) > 0:
+            differences[label] = diffs
+
+    # validation messages name a donor by its id, so they are grouped by id
+    donor_ids = set()
+    for output in [a, b]:
+        donor_ids.update(packet.get(id_key) for packet in output["map"][result_key])
+    donor_ids.discard(None)
+
+    for kind in ["validation_errors", "validation_warnings"]:
+        messages = [donor_messages(a["validation"][kind], donor_ids), donor_messages(b["validation"][kind], donor_ids)]
+        for donor in list(messages[0].keys()) + [d for d in messages[1].keys() if d not in messages[0]]:
+            diffs = structural_diff(messages[0].get(donor, []), messages[1].get(donor, []), kind)
+            if len(diffs) > 0:
+                differences.setdefault(donor, []).extend(diffs)
+
+    # everything in the map and validation results apart from the donors, e.g. statistics
+    rest = [{k: v for k, v in output["map"].items() if k != result_key} for output in [a, b]]
+    rest[0]["validation"] = {k: v for k, v in a["validation"].items() if k not in ["validation_errors", "validation_warnings"]}
+    rest[1]["validation"] = {k: v for k, v in b["validation"].items() if k not in ["validation_errors", "validation_warnings"]}
+    diffs = structural_diff(rest[0], rest[1])
+    if len(diffs) > 0:
+        differences.setdefault(None, []).extend(diffs)
+    return len(labels), differences
+
+
+def run_differential(cases, engines=None, workdir="differential"):
+    """Convert every case with both engines and return a report of the differences for each case."""
+    if engines is None:
+        engines = ["legacy", "typed"]
+    report = {"engines": engines, "cases": {}}
+    for name, input_path, manifest_file in cases:
+        print(f"{Bcolors.OKGREEN}Comparing {engines[0]} and {engines[1]} on {name}{Bcolors.ENDC}")
+        outputs = []
+        for engine in engines:
+            outputs.append(run_engine(engine, input_path, manifest_file,
+                                      os.path.join(workdir, engine, name.replace(os.sep, "_"))))
+        if "error" in outputs[0] or "error" in outputs[1]:
+            # a case that can't be converted can't be compared, even if both engines fail in the same way
+            report["cases"][name] = {
+                "errors": [output.get("error") for output in outputs],
+                "identical": False
+            }
+            continue
+        donors, differences = compare_outputs(outputs[0], outputs[1])
+        report["cases"][name] = {
+            "donors": donors,
+            "differing_donors": len([d for d in differences if d is not None]),
+            "identical": len(differences) == 0,
+            "differences": {str(d): differences[d] for d in differences}
+        }
+    return report
+
+
+def print_report(report, max_diffs=10):
+    a, b = report["engines"]
+    for name in report["cases"]:
+        case = report["cases"][name]
+        if "errors" in case:
+            both = None not in case["errors"]
+            print(f"{Bcolors.FAIL}{name}: conversion failed{' with both engines' if both else ''}{Bcolors.ENDC}")
+            for engine, error in zip(report["engines"], case["errors"]):
+                if error is not None:
+                    print(f"  {engine}: {error.splitlines()[-1]}")
+            continue
+        if case["identical"]:
+            print(f"{Bcolors.OKGREEN}{name}: {case['donors']} donors, identical{Bcolors.ENDC}")
+            continue
+        print(f"{Bcolors.FAIL}{name}: {case['donors']} donors, {case['differing_donors']} differ{Bcolors.ENDC}")
+        for donor in case["differences"]:
+            diffs = case["differences"][donor]
+            label = donor if donor != "None" else "(dataset)"
+            for diff in diffs[:max_diffs]:
+                print(f"  {label}  {diff['path']}: {a}={diff['a']} {b}={diff['b']}")
+            if len(diffs) > max_diffs:
+                print(f"  {label}  ... {len(diffs) - max_diffs} more")
+
+
+def main(args):
+    os.makedirs(args.workdir, exist_ok=True)
+    cases = prepare_cases(args.workdir, cohorts=args.cohorts, schema=args.schema, examples=not args.no_examples,
+                          extra_cases=args.case, seed=args.seed)
+    report = run_differential(cases, engines=args.engines, workdir=args.workdir)
+    report_file = os.path.join(args.workdir, "differential_report.json")
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=4)
+    print_report(report, max_diffs=args.max_diffs)
+    print(f"Full report written to {report_file}")
+    if not all(case["identical"] for case in report["cases"].values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,299 @@
+"""
+Generate a Python module that validates packets against a schema's json_schema, with the same errors that
+jsonschema's Draft202012Validator.iter_errors yields, but without interpreting the schema tree for every packet.
+Each schema node becomes a function that checks its keywords in order. The keywords in SUPPORTED are
+generated; a node with any other keyword that jsonschema validates is handed to jsonschema, so the errors are
+always the ones jsonschema would report. The generated source is cached in CACHE_DIR.
+"""
+
+import hashlib
+import json
+import os
+from collections import deque
+
+CACHE_DIR = os.environ.get("CLINICAL_ETL_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "clinical_etl"))
+# changes whenever the generated code changes, so that cached validators are regenerated
+GENERATOR_VERSION = 1
+
+SUPPORTED = {"type", "enum", "required", "properties", "items", "$ref", "allOf", "anyOf", "oneOf", "maxLength",
+             "minLength", "minimum", "maximum", "format"}
+# keywords that change how references are resolved: a schema with any of them is only validated by jsonschema
+RESOLUTION_KEYWORDS = {"$id", "$anchor", "$dynamicAnchor", "$dynamicRef"}
+
+TYPE_CHECKS = {
+    "string": "isinstance(x, str)",
+    "object": "isinstance(x, dict)",
+    "array": "isinstance(x, list)",
+    "boolean": "isinstance(x, bool)",
+    "null": "x is None",
+    "number": "(isinstance(x, numbers.Number) and not isinstance(x, bool))",
+    "integer": "((isinstance(x, int) and not isinstance(x, bool)) or (isinstance(x, float) and x.is_integer()))",
+}
+
+
+class FastError:
+    """The attributes of a jsonschema ValidationError that validate_jsonschema reads."""
+    __slots__ = ("message", "instance", "schema", "path")
+
+    def __init__(self, message, instance, schema, path):
+        self.message = message
+        self.instance = instance
+        self.schema = schema
+        # path is a linked list of (parent, key) tuples, which is only made into a deque for an error
+        self.path = deque()
+        while path is not None:
+            path, key = path
+            self.path.appendleft(key)
+
+    def __str__(self):
+        return self.message
+
+
+def collect_nodes(json_schema):
+    """Return all of the dicts in json_schema, in a fixed order, so that generated code can refer to a node by
+    its index in the list."""
+    nodes = []
+    stack = [json_schema]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, dict):
+            nodes.append(node)
+            stack.extend(reversed(list(node.values())))
+        elif isinstance(node, list):
+            stack.extend(reversed(node))
+    return nodes
+
+
+class Generator:
+    def __init__(self, json_schema):
+        import jsonschema
+        self.root = json_schema
+        self.validating = set(jsonschema.Draft202012Validator.VALIDATORS)
+        self.index = {id(node): i for i, node in enumerate(collect_nodes(json_schema))}
+        # {node index: name of its function, or None if the node can't report errors}
+        self.functions = {}
+        self.lines = []
+
+    def resolve(self, ref):
+        """Return the node of a local reference like #/$defs/Name, or None."""
+        if not ref.startswith("#"):
+            return None
+        node = self.root
+        for part in ref[1:].split("/")[1:]:
+            part = part.replace("~1", "/").replace("~0", "~")
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        return node
+
+    def function(self, node):
+        """Return the name of the function that validates node, generating it the first time."""
+        if node is True or node == {}:
+            return None
+        if not isinstance(node, dict):
+            # False schemas are left to jsonschema
+            return "fallback"
+        index = self.index[id(node)]
+        if index in self.functions:
+            return self.functions[index]
+        name = f"v{index}"
+        # recursive references call the function while it is being generated
+        self.functions[index] = name
+        body = self.body(node, index)
+        if body is None:
+            body = [f"    fallback(NODES[{index}], x, p, e)"]
+        if len(body) == 0:
+            self.functions[index] = None
+            return None
+        self.lines.append(f"def {name}(x, p, e):")
+        self.lines.extend(body)
+        self.lines.append("")
+        return name
+
+    def call(self, node, x, p):
+        name = self.function(node)
+        if name is None:
+            return None
+        if name == "fallback":
+            return f"fallback({node!r}, {x}, {p}, e)"
+        return f"{name}({x}, {p}, e)"
+
+    def body(self, node, index):
+        """Return the lines of the function for node, or None if jsonschema has to validate it."""
+        for keyword in node:
+            if keyword in RESOLUTION_KEYWORDS or (keyword in self.validating and keyword not in SUPPORTED):
+                return None
+        here = f"NODES[{index}]"
+        lines = []
+        for keyword, value in node.items():
+            if keyword == "type":
+                types = value if isinstance(value, list) else [value]
+                if any(t not in TYPE_CHECKS for t in types):
+                    return None
+                reprs = ", ".join(repr(t) for t in types)
+                checks = " or ".join(TYPE_CHECKS[t] for t in types)
+                lines.append(f"    if not ({checks}):")
+                lines.append(f"        e.append(FastError(repr(x) + {' is not of type ' + reprs!r}, x, {here}, p))")
+            elif keyword == "enum":
+                if not isinstance(value, list) or any(v is not None and not isinstance(v, str) for v in value):
+                    return None
+                strings = sorted(set(v for v in value if v is not None))
+                valid = f"(isinstance(x, str) and x in {set(strings)!r})" if strings else "False"
+                if None in value:
+                    valid = f"(x is None or {valid})"
+                lines.append(f"    if not {valid}:")
+                lines.append(f"        e.append(FastError(repr(x) + {' is not one of ' + repr(value)!r}, x, {here}, p))")
+            elif keyword == "required":
+                if len(value) > 0:
+                    lines.append("    if isinstance(x, dict):")
+                    for prop in value:
+                        lines.append(f"        if {prop!r} not in x:")
+                        lines.append(f"            e.append(FastError({repr(prop) + ' is a required property'!r}, x, {here}, p))")
+            elif keyword == "properties":
+                calls = []
+                for prop, subschema in value.items():
+                    call = self.call(subschema, f"x[{prop!r}]", f"(p, {prop!r})")
+                    if call is not None:
+                        calls.append(f"        if {prop!r} in x:")
+                        calls.append(f"            {call}")
+                if calls:
+                    lines.append("    if isinstance(x, dict):")
+                    lines.extend(calls)
+            elif keyword == "items":
+                if "prefixItems" in node or value is False:
+                    return None
+                call = self.call(value, "y", "(p, i)")
+                if call is not None:
+                    lines.append("    if isinstance(x, list):")
+                    lines.append("        for i, y in enumerate(x):")
+                    lines.append(f"            {call}")
+            elif keyword == "$ref":
+                target = self.resolve(value)
+                if target is None:
+                    return None
+                call = self.call(target, "x", "p")
+                if call is not None:
+                    lines.append(f"    {call}")
+            elif keyword == "allOf":
+                for subschema in value:
+                    call = self.call(subschema, "x", "p")
+                    if call is not None:
+                        lines.append(f"    {call}")
+            elif keyword in ["anyOf", "oneOf"]:
+                names = [self.function(subschema) for subschema in value]
+                if "fallback" in names:
+                    return None
+                lines.append(f"    {keyword[0:3]}_of(({', '.join(str(n) for n in names)},), {here}[{keyword!r}], x, p, e, {here})")
+            elif keyword in ["maxLength", "minLength"]:
+                compare, message = (">", " is too long") if keyword == "maxLength" else ("<", " is too short")
+                lines.append(f"    if isinstance(x, str) and len(x) {compare} {value!r}:")
+                lines.append(f"        e.append(FastError(repr(x) + {message!r}, x, {here}, p))")
+            elif keyword in ["minimum", "maximum"]:
+                compare, message = ("<", " is less than the minimum of ") if keyword == "minimum" else \
+                    (">", " is greater than the maximum of ")
+                lines.append(f"    if {TYPE_CHECKS['number']} and x {compare} {value!r}:")
+                lines.append(f"        e.append(FastError(repr(x) + {message + repr(value)!r}, x, {here}, p))")
+        return lines
+
+    def generate(self):
+        root = self.function(self.root)
+        header = [
+            "# Generated by clinical_etl.fastvalidator from a json schema: do not edit.",
+            "import numbers",
+            "",
+        ]
+        return "\n".join(header + self.lines + [f"ROOT = {root}", ""])
+
+
+def generate(json_schema):
+    """Return the source of a module that validates json_schema."""
+    return Generator(json_schema).generate()
+
+
+# the runtime of the generated modules
+
+def valid(function, x, p):
+    if function is None:
+        return True
+    errors = []
+    function(x, p, errors)
+    return len(errors) == 0
+
+
+def any_of(functions, subschemas, x, p, e, schema):
+    for function in functions:
+        if valid(function, x, p):
+            return
+    e.append(FastError(f"{x!r} is not valid under any of the given schemas", x, schema, p))
+
+
+def one_of(functions, subschemas, x, p, e, schema):
+    first_valid = None
+    for i, function in enumerate(functions):
+        if valid(function, x, p):
+            first_valid = i
+            break
+    if first_valid is None:
+        e.append(FastError(f"{x!r} is not valid under any of the given schemas", x, schema, p))
+        return
+    more_valid = [subschemas[j] for j in range(first_valid + 1, len(functions)) if valid(functions[j], x, p)]
+    if more_valid:
+        more_valid.append(subschemas[first_valid])
+        reprs = ", ".join(repr(s) for s in more_valid)
+        e.append(FastError(f"{x!r} is valid under each of {reprs}", x, schema, p))
+
+
+class FastValidator:
+    """Validates instances of a json schema with a generated module: calling it returns the errors of an
+    instance, like jsonschema's iter_errors."""
+    def __init__(self, json_schema, source):
+        self.json_schema = json_schema
+        self.jsonschema_validator = None
+        namespace = {
+            "NODES": collect_nodes(json_schema),
+            "FastError": FastError,
+            "any_of": any_of,
+            "one_of": one_of,
+            "fallback": self.fallback,
+        }
+        exec(compile(source, "<fastvalidator>", "exec"), namespace)
+        self.root = namespace["ROOT"]
+
+    def fallback(self, node, x, p, e):
+        """Validate x against node with jsonschema, adding the path of x to the errors."""
+        if self.jsonschema_validator is None:
+            import jsonschema
+            self.jsonschema_validator = jsonschema.Draft202012Validator(self.json_schema)
+        prefix = FastError("", None, None, p).path
+        for error in self.jsonschema_validator.evolve(schema=node).iter_errors(x):
+            error.path.extendleft(reversed(prefix))
+            e.append(error)
+
+    def __call__(self, instance):
+        errors = []
+        if self.root is not None:
+            self.root(instance, None, errors)
+        return errors
+
+
+def load(json_schema, cache_dir=None):
+    """Return a FastValidator for json_schema, using the generated module in the cache if there is one."""
+    from importlib.metadata import version
+    cache_dir = cache_dir or CACHE_DIR
+    key = hashlib.sha256(f"{GENERATOR_VERSION} {version('jsonschema')} ".encode())
+    # the order of the keys is part of the key: it is the order of the nodes and of the errors
+    key.update(json.dumps(json_schema).encode())
+    path = os.path.join(cache_dir, f"fastvalidator_{key.hexdigest()[:16]}.py")
+    try:
+        with open(path) as f:
+            source = f.read()
+    except FileNotFoundError:
+        source = generate(json_schema)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(source)
+        except OSError:
+            # the validator still works, it just has to be generated again next time
+            pass
+    return FastValidator(json_schema, source)
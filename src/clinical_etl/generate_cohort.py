@@ -0,0 +1,478 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import argparse
+import datetime
+import importlib
+import os
+import random
+import re
+import sys
+import pandas
+import yaml
+# Include clinical_etl parent directory in the module search path.
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+from clinical_etl.CSVConvert import parse_mapping_function, process_mapping, read_mapping_template, \
+    split_sheet_from_field
+from clinical_etl.mohschemav3 import SMOKER_STATES
+
+# strftime formats for each manifest date_format; with --mixed_dates, every cell uses one of them at random
+DATE_STYLES = {
+    "DMY": ["%d/%m/%Y", "%d-%m-%Y", "%d %b %Y"],
+    "MDY": ["%m/%d/%Y", "%m-%d-%Y", "%b %d %Y"],
+    "YMD": ["%Y-%m-%d", "%Y/%m/%d", "%Y %b %d"]
+}
+
+# mapping functions whose input is a number, boolean, date or list, rather than a string
+INTEGER_FUNCTIONS = ["integer", "int_to_date_interval_json"]
+FLOAT_FUNCTIONS = ["floating"]
+BOOLEAN_FUNCTIONS = ["boolean"]
+DATE_FUNCTIONS = ["date", "single_date", "date_interval"]
+LIST_FUNCTIONS = ["pipe_delim", "list_val", "flat_list_val"]
+
+# number of distinct values generated for free-text columns
+TEXT_VALUES = 20
+
+# columns that are only generated when another column of the same row has one of the given values (or any value,
+# for None), and then with the given probability, so that the conditionals of the model hold. They are generated
+# after the other columns, in this order.
+DEPENDENT_COLUMNS = {
+    "cause_of_death": ("is_deceased", ["Yes"], 1.0),
+    "date_of_death": ("is_deceased", ["Yes"], 1.0),
+    "lost_to_followup_after_clinical_event_identifier": ("is_deceased", ["No", "Not available"], 0.2),
+    "lost_to_followup_reason": ("lost_to_followup_after_clinical_event_identifier", None, 0.8),
+    "date_alive_after_lost_to_followup": ("lost_to_followup_after_clinical_event_identifier", None, 0.8),
+    "laterality_of_prior_malignancy": ("prior_malignancy", ["Yes"], 0.9),
+    "tobacco_type": ("tobacco_smoking_status", SMOKER_STATES, 0.9),
+    "pack_years_smoked": ("tobacco_smoking_status", SMOKER_STATES, 0.9),
+    "prescribed_cumulative_drug_dose": ("drug_dose_units", None, 0.9),
+    "actual_cumulative_drug_dose": ("drug_dose_units", None, 0.9)
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate a synthetic cohort of input sheets, with a matching "
+                                                 "mapping template and manifest, for load testing.")
+    parser.add_argument('--schema', type=str, required=True, help="URL to the openAPI schema file (raw github link)")
+    parser.add_argument('--schema_class', type=str, default="MoHSchemaV3", help="Name of the schema class")
+    parser.add_argument('--output', type=str, required=True, help="Directory to write the cohort, template and manifest to")
+    parser.add_argument('--template', type=str, help="Mapping template to generate data for. Default is the template generated from the schema")
+    parser.add_argument('--donors', type=int, default=1000, help="Number of donors to generate")
+    parser.add_argument('--fanout', type=str, nargs="*", default=[], help="Mean number of objects per parent object for nested schemas, e.g. primary_diagnoses=2 treatments=3. Default is 1")
+    parser.add_argument('--null_rate', type=float, default=0.1, help="Fraction of values that are left empty")
+    parser.add_argument('--date_format', type=str, default="DMY", choices=list(DATE_STYLES.keys()), help="Order of the day, month and year in dates")
+    parser.add_argument('--mixed_dates', action="store_true", help="Write dates in a mix of styles, e.g. 01/02/2020 and 01 Feb 2020")
+    parser.add_argument('--xlsx', action="store_true", help="Write the sheets to a single xlsx file instead of a directory of csvs")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the random number generator")
+    args = parser.parse_args()
+    return args
+
+
+def sheet_name(sheet):
+    """Turn a template placeholder like PRIMARY_DIAGNOSES_SHEET into a sheet name like PrimaryDiagnoses."""
+    if sheet.endswith("_SHEET"):
+        return "".join(word.capitalize() for word in sheet[:-len("_SHEET")].split("_"))
+    return sheet
+
+
+def resolve_json_schema(node, json_schema):
+    """Follow $refs, and pick the first non-null alternative of allOf/anyOf/oneOf."""
+    while True:
+        if "$ref" in node:
+            node = json_schema["$defs"].get(node["$ref"].replace("#/$defs/", ""), {})
+        elif "allOf" in node or "anyOf" in node or "oneOf" in node:
+            options = node.get("allOf", node.get("anyOf", node.get("oneOf")))
+            options = [x for x in options if x.get("type") != "null"]
+            if len(options) == 0:
+                return {}
+            node = options[0]
+        else:
+            return node
+
+
+def json_schema_for_field(elems, json_schema, unwrap_arrays=True):
+    """Return the json schema for the field at the template path elems, e.g. DONOR.INDEX.gender, or {} if
+    it isn't in the schema. For arrays, the schema of the items is returned unless unwrap_arrays is False."""
+    node = json_schema
+    for elem in elems[2:]:
+        node = resolve_json_schema(node, json_schema)
+        if elem == "INDEX":
+            node = node.get("items", {})
+        else:
+            node = node.get("properties", {}).get(elem, {})
+    node = resolve_json_schema(node, json_schema)
+    if unwrap_arrays and node.get("type") == "array":
+        node = resolve_json_schema(node.get("items", {}), json_schema)
+    return node
+
+
+def default_template(schema):
+    """
+    Return the schema's generated mapping template, with each default mapping function replaced by one that
+    produces the type the schema expects: date intervals, lists and numbers, and enum values instead of booleans.
+    """
+    result = []
+    date_intervals = []
+    for line in schema.template:
+        value, elems = process_mapping(line)
+        if elems is None:
+            continue
+        path = ".".join(elems)
+        # the month_interval and day_interval of a date are calculated by date_interval
+        if any(path.startswith(f"{date}.") for date in date_intervals):
+            continue
+        method, parameters = parse_mapping_function(value)
+        if method is None or elems[-1] == "INDEX":
+            result.append(line)
+            continue
+        node = json_schema_for_field(elems, schema.json_schema, unwrap_arrays=False)
+        node_type = node.get("type")
+        new_method = method
+        if node_type == "object" and "month_interval" in node.get("properties", {}):
+            new_method = "date_interval"
+            date_intervals.append(path)
+        elif node_type == "array":
+            new_method = "pipe_delim"
+        elif node_type == "integer":
+            new_method = "integer"
+        elif node_type == "number":
+            new_method = "floating"
+        elif method == "boolean" and node_type != "boolean":
+            new_method = "single_val"
+        result.append(line.replace(f"{{{method}(", f"{{{new_method}(", 1))
+    return result
+
+
+def parse_template(template_lines, schema):
+    """
+    Find the arrays of objects (entities) in a mapping template, the sheet and column each is indexed on, and the
+    columns that are mapped into each of them. Returns the root entity; each entity is a dict with its path,
+    name, sheet, key column, id column, child entities and fields.
+    """
+    entities = []
+    fields = []
+    for line in template_lines:
+        value, elems = process_mapping(line)
+        if elems is None or value == "":
+            continue
+        method, parameters = parse_mapping_function(value)
+        if parameters is None:
+            continue
+        if method is not None:
+            method = re.sub(r"^mappings\.", "", method)
+        columns = []
+        for param in parameters:
+            column, sheet = split_sheet_from_field(param)
+            if sheet is not None:
+                columns.append((sheet_name(sheet.strip("\"'")), column.strip("\"'")))
+        if len(columns) == 0:
+            continue
+        if elems[-1] == "INDEX":
+            entities.append({
+                "path": ".".join(elems),
+                "name": elems[-2],
+                "sheet": columns[0][0],
+                "key": columns[0][1],
+                "id": None,
+                "children": [],
+                "fields": []
+            })
+        else:
+            fields.append({
+                "path": ".".join(elems),
+                "method": method,
+                "columns": columns,
+                "json_schema": json_schema_for_field(elems, schema.json_schema)
+            })
+    if len(entities) == 0:
+        return None
+
+    root = entities[0]
+    root["id"] = root["key"]
+    for entity in entities[1:]:
+        name = entity["name"].lower()
+        if f"{name}s" in schema.validation_schema:
+            name = f"{name}s"
+        if name in schema.validation_schema:
+            entity["id"] = schema.validation_schema[name]["id"]
+        parent = root
+        for other in entities:
+            if entity["path"].startswith(f"{other['path']}.") and len(other["path"]) > len(parent["path"]):
+                parent = other
+        parent["children"].append(entity)
+    for field in fields:
+        owner = root
+        for entity in entities:
+            if field["path"].startswith(f"{entity['path']}.") and len(entity["path"]) > len(owner["path"]):
+                owner = entity
+        owner["fields"].append(field)
+    return root
+
+
+def format_date(date, date_format, mixed_dates, rng):
+    styles = DATE_STYLES[date_format]
+    if mixed_dates:
+        return date.strftime(rng.choice(styles))
+    return date.strftime(styles[0])
+
+
+def value_kind(field, column):
+    """Return the kind of value generated for a column: resolution, enum, boolean, integer, number, date or text."""
+    method = field["method"]
+    types = field["json_schema"].get("type", [])
+    if not isinstance(types, list):
+        types = [types]
+    if column == "date_resolution":
+        return "resolution"
+    if any(x is not None for x in field["json_schema"].get("enum", [])):
+        return "enum"
+    if method in BOOLEAN_FUNCTIONS or "boolean" in types:
+        return "boolean"
+    if method in INTEGER_FUNCTIONS or "integer" in types:
+        return "integer"
+    if method in FLOAT_FUNCTIONS or "number" in types:
+        return "number"
+    if method in DATE_FUNCTIONS or "date" in column:
+        return "date"
+    return "text"
+
+
+def generate_value(field, column, date, options):
+    """Generate a plausible value for a column, based on its mapping function and its json schema. The dates of
+    a row are chosen together by generate_dates, and date is the one for this column."""
+    rng = options["rng"]
+    kind = value_kind(field, column)
+    if kind == "resolution":
+        return rng.choice(["month", "day"])
+    if kind == "enum":
+        enum = [x for x in field["json_schema"]["enum"] if x is not None]
+        if field["method"] in LIST_FUNCTIONS:
+            return "|".join(rng.sample(enum, rng.randint(1, min(2, len(enum)))))
+        return rng.choice(enum)
+    if kind == "boolean":
+        return rng.choice(["Yes", "No"])
+    if kind == "integer":
+        return str(rng.randint(0, 100))
+    if kind == "number":
+        return str(round(rng.uniform(0, 100), 1))
+    if kind == "date":
+        return format_date(date, options["date_format"], options["mixed_dates"], rng)
+    return f"{column}_{rng.randint(1, TEXT_VALUES)}"
+
+
+def date_rank(column):
+    """Order of the events in a row: start dates come before other dates, which come before end dates."""
+    if "start" in column:
+        return 0
+    if "end" in column:
+        return 2
+    return 1
+
+
+def generate_dates(columns, window, rng):
+    """
+    Return a date for each of the date columns of a row. A birth is decades before the window of the row's
+    events and a death is after it; the other dates are in the window, in the order of date_rank.
+    """
+    start, end = window
+    dates = {}
+    events = []
+    for column in columns:
+        if "birth" in column:
+            dates[column] = start - datetime.timedelta(days=rng.randint(30 * 365, 80 * 365))
+        elif "death" in column:
+            dates[column] = end + datetime.timedelta(days=rng.randint(0, 365))
+        else:
+            events.append(column)
+    days = sorted(rng.randint(0, (end - start).days) for column in events)
+    for column, day in zip(sorted(events, key=date_rank), days):
+        dates[column] = start + datetime.timedelta(days=day)
+    return dates
+
+
+def child_window(window, dates):
+    """The nested objects of a row happen after its first event and, if it has a start and an end, before its
+    last one; e.g. the systemic therapies of a treatment are between its start and end dates."""
+    events = [date for column, date in dates.items() if "birth" not in column and "death" not in column]
+    if len(events) == 0:
+        return window
+    if len(events) == 1:
+        return min(events), window[1]
+    return min(events), max(events)
+
+
+def generate_rows(entity, parent_row, sheets, counters, window, options):
+    """Add the rows for one parent object's instances of entity, and their nested entities, to sheets. Their
+    dates are in window, the (start, end) dates of the parent object's events."""
+    rng = options["rng"]
+    identifier = options["identifier"]
+    if parent_row is None:
+        count = 1
+    else:
+        mean = options["fanout"].get(entity["name"], 1)
+        count = rng.randint((mean + 1) // 2, mean + mean // 2)
+    for i in range(0, count):
+        row = {}
+        if parent_row is not None:
+            row[identifier] = parent_row[identifier]
+            row[entity["key"]] = parent_row.get(entity["key"])
+        if entity["id"] is not None and entity["id"] not in row:
+            counters[entity["id"]] = counters.get(entity["id"], 0) + 1
+            prefix = entity["id"].replace("submitter_", "").replace("_id", "").upper()
+            row[entity["id"]] = f"{prefix}_{counters[entity['id']]}"
+        columns = {}
+        for field in entity["fields"]:
+            for sheet, column in field["columns"]:
+                if sheet == entity["sheet"] and column not in row and column not in options["link_columns"]:
+                    columns.setdefault(column, field)
+        dates = generate_dates([column for column in columns if value_kind(columns[column], column) == "date"],
+                               window, rng)
+        order = [column for column in columns if column not in DEPENDENT_COLUMNS]
+        order.extend(column for column in DEPENDENT_COLUMNS if column in columns)
+        for column in order:
+            if column in DEPENDENT_COLUMNS:
+                other, values, rate = DEPENDENT_COLUMNS[column]
+                generated = row.get(other) is not None and (values is None or row[other] in values)
+                if not generated or rng.random() >= rate:
+                    row[column] = None
+                    continue
+            elif (entity["sheet"], column) not in options["required"] and rng.random() < options["null_rate"]:
+                row[column] = None
+                continue
+            row[column] = generate_value(columns[column], column, dates.get(column), options)
+        if entity["sheet"] not in sheets:
+            sheets[entity["sheet"]] = []
+        sheets[entity["sheet"]].append(row)
+        for child in entity["children"]:
+            generate_rows(child, row, sheets, counters, child_window(window, dates), options)
+
+
+def find_columns(entity, link_columns=None, sheet_columns=None):
+    """Return the set of columns that identify or link objects, which are only filled in with real ids, and
+    the set of (sheet, column) that are mapped."""
+    if link_columns is None:
+        link_columns = set()
+        sheet_columns = set()
+    link_columns.add(entity["key"])
+    if entity["id"] is not None:
+        link_columns.add(entity["id"])
+    for field in entity["fields"]:
+        sheet_columns.update(field["columns"])
+    for child in entity["children"]:
+        find_columns(child, link_columns, sheet_columns)
+    return link_columns, sheet_columns
+
+
+def generate_cohort(schema_url, output_dir, schema_class="MoHSchemaV3", template=None, donors=1000, fanout=None,
+                    null_rate=0.1, date_format="DMY", mixed_dates=False, xlsx=False, seed=0):
+    """
+    Write a synthetic cohort to output_dir: the input sheets (a raw_data directory of csvs, or raw_data.xlsx),
+    the mapping template (template.csv) and a manifest (manifest.yml). Returns the paths to the input and the
+    manifest.
+    """
+    if fanout is None:
+        fanout = {}
+    schema_mod = importlib.import_module(f"clinical_etl.{schema_class.lower()}")
+    schema = getattr(schema_mod, schema_class)(schema_url)
+    if schema.json_schema is None:
+        sys.exit(f"Could not read an openapi schema at {schema_url}")
+    if template is not None:
+        template_lines = read_mapping_template(template)
+    else:
+        template_lines = default_template(schema)
+    root = parse_template(template_lines, schema)
+    if root is None:
+        sys.exit("The mapping template does not have any indexed lines to generate data for.")
+    link_columns, sheet_columns = find_columns(root)
+
+    # date_interval needs a reference date: use the earliest date of diagnosis, which is never left empty
+    reference_date = None
+    required = set()
+    if any("date_interval(" in line for line in template_lines):
+        diagnosis_sheet = None
+        for sheet, column in sheet_columns:
+            if column == "date_of_diagnosis":
+                diagnosis_sheet = sheet
+        if (root["sheet"], "date_resolution") in sheet_columns and diagnosis_sheet is not None:
+            reference_date = f"earliest_date({root['sheet']}.date_resolution, {diagnosis_sheet}.date_of_diagnosis)"
+            required = {(root["sheet"], "date_resolution"), (diagnosis_sheet, "date_of_diagnosis")}
+
+    options = {
+        "rng": random.Random(seed),
+        "identifier": root["key"],
+        "fanout": fanout,
+        "null_rate": null_rate,
+        "date_format": date_format,
+        "mixed_dates": mixed_dates,
+        "link_columns": link_columns,
+        "required": required
+    }
+    sheets = {}
+    counters = {}
+    for i in range(0, donors):
+        # each donor's events happen over a few years from a random first diagnosis
+        start = datetime.date(2000, 1, 1) + datetime.timedelta(days=options["rng"].randint(0, 20 * 365))
+        end = start + datetime.timedelta(days=options["rng"].randint(365, 8 * 365))
+        generate_rows(root, None, sheets, counters, (start, end), options)
+
+    # write the sheets: every sheet has every column that the template maps from it
+    os.makedirs(output_dir, exist_ok=True)
+    dataframes = {}
+    for sheet in sheets:
+        columns = [root["key"]]
+        for row in sheets[sheet]:
+            for column in row:
+                if column not in columns:
+                    columns.append(column)
+        dataframes[sheet] = pandas.DataFrame(sheets[sheet], columns=columns)
+    if xlsx:
+        input_path = os.path.join(output_dir, "raw_data.xlsx")
+        with pandas.ExcelWriter(input_path) as writer:
+            for sheet in dataframes:
+                dataframes[sheet].to_excel(writer, sheet_name=sheet, index=False)
+    else:
+        input_path = os.path.join(output_dir, "raw_data")
+        os.makedirs(input_path, exist_ok=True)
+        for sheet in dataframes:
+            dataframes[sheet].to_csv(os.path.join(input_path, f"{sheet}.csv"), index=False)
+
+    # write the template with the sheet placeholders replaced by the sheet names
+    with open(os.path.join(output_dir, "template.csv"), 'w') as f:
+        f.write(f"## Synthetic cohort template for {schema_class} generated from {schema_url}\n")
+        f.write("## Items are comma separated: element, mapping method\n")
+        for line in template_lines:
+            f.write(re.sub(r"\b([A-Z0-9_]+_SHEET)\.", lambda m: f"{sheet_name(m.group(1))}.", line) + "\n")
+
+    manifest = {
+        "description": f"Synthetic cohort of {donors} donors",
+        "mapping": "template.csv",
+        "identifier": root["key"],
+        "schema": schema_url,
+        "schema_class": schema_class,
+        "date_format": date_format
+    }
+    if reference_date is not None:
+        manifest["reference_date"] = reference_date
+    manifest_file = os.path.join(output_dir, "manifest.yml")
+    with open(manifest_file, 'w') as f:
+        yaml.dump(manifest, f, sort_keys=False)
+    return input_path, manifest_file
+
+
+def main(args):
+    fanout = {}
+    for item in args.fanout:
+        name, count = item.split("=")
+        fanout[name] = int(count)
+    input_path, manifest_file = generate_cohort(args.schema, args.output, schema_class=args.schema_class,
+                                                template=args.template, donors=args.donors, fanout=fanout,
+                                                null_rate=args.null_rate, date_format=args.date_format,
+                                                mixed_dates=args.mixed_dates, xlsx=args.xlsx, seed=args.seed)
+    print(f"Cohort of {args.donors} donors written to {input_path}")
+    print(f"Convert it with: CSVConvert --input {input_path} --manifest {manifest_file}")
+
+
+if __name__ == '__main__':
+    main(parse_args())
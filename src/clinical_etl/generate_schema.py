@@ -5,36 +5,39 @@ from copy import deepcopy
 import importlib.util
 from importlib.metadata import files, version
 import json
-import mappings
 import os
-import pandas
 import sys
 import argparse
-from mohschemav2 import MoHSchemaV2
-from mohschemav3 import MoHSchemaV3
 import re
+# Include clinical_etl parent directory in the module search path.
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('--url', type=str, help="URL to openAPI schema file (raw github link)", default="https://raw.githubusercontent.com/CanDIG/katsu/develop/chord_metadata_service/mohpackets/docs/schema.yml")
     parser.add_argument('--schema', type=str, help="Name of schema class", default="MoHSchemaV3")
     parser.add_argument('--out', type=str, help="name of output file; csv extension will be added. Default is template", default="template")
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     return args
 
 
 def main(args):
     url = args.url
     schema_name = args.schema
-    schema_class = schema_name.lower()
-    mod = importlib.import_module(schema_class)
-    schema = eval(f'mod.{schema_name}(url)')
-    if schema is None:
+    mod = importlib.import_module(f"clinical_etl.{schema_name.lower()}")
+    schema = getattr(mod, schema_name)(url)
+    if schema.json_schema is None:
         print("Did not find an openapi schema at {}; please check link".format(url))
         return
+    write_template(schema, url, args.out)
 
-    outputfile = "{}.csv".format(args.out)
+
+def write_template(schema, url, out):
+    """Write the mapping template for a loaded schema to <out>.csv."""
+    outputfile = "{}.csv".format(out)
 
     metadata = f"## Schema generated from {url}\n"
     if schema.katsu_sha is not None:
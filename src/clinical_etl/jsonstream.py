@@ -0,0 +1,150 @@
+"""
+Read the maps written by CSVConvert one value at a time, so that memory is bounded by the largest packet instead
+of by the whole file. A map is either a _map.json file, or a newline-delimited _map.ndjson file that has the other
+keys of the map on its first line and one packet on each line after it.
+"""
+
+import json
+import re
+
+# characters read from the file at a time
+CHUNK_SIZE = 1 << 16
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+# characters that can continue a number
+NUMBER_CHARS = set("0123456789.eE+-")
+
+
+class JSONStream:
+    """
+    An incremental reader for a file that holds a json value. Objects and arrays can be read one member at a time
+    with object_keys() and array(); any other value is decoded whole with value().
+    """
+    def __init__(self, f, chunk_size=None):
+        self.f = f
+        self.chunk_size = chunk_size or CHUNK_SIZE
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def read_more(self, size=None):
+        """Drop what has been read from the buffer and add the next size characters of the file to it."""
+        if self.eof:
+            return False
+        chunk = self.f.read(size or self.chunk_size)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        if not chunk:
+            self.eof = True
+        return not self.eof
+
+    def peek(self):
+        """Skip whitespace and return the next character, or "" at the end of the file."""
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read_more():
+                return ""
+
+    def expect(self, chars):
+        """Read the next character, which has to be one of chars."""
+        char = self.peek()
+        if char == "" or char not in chars:
+            raise ValueError(f"Expected one of {chars!r} but found {char!r} in the json")
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Decode the next value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number at the end of the buffer, or cut off before its fraction or exponent, may continue in
+                # the next chunk
+                is_number = isinstance(value, (int, float)) and not isinstance(value, bool)
+                if self.eof or not (is_number and (end == len(self.buffer) or self.buffer[end] in NUMBER_CHARS)):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # read at least as much again as is buffered, so that a large value is only decoded a few times
+            self.read_more(max(self.chunk_size, len(self.buffer) - self.pos))
+
+    def object_keys(self):
+        """Yield each key of the object at the current position. The caller reads the value of the key, with
+        value(), array() or object_keys(), before asking for the next key."""
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            if self.expect(",}") == "}":
+                return
+
+    def array(self):
+        """Yield each item of the array at the current position."""
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(",]") == "]":
+                return
+
+
+def is_ndjson(path):
+    return path.endswith(".ndjson") or path.endswith(".jsonl")
+
+
+def map_header(path, required=None):
+    """
+    Return the keys of the map at path that aren't arrays of packets, without holding the packets in memory.
+    Reading stops at the first array of packets if all of the required keys have been found before it;
+    otherwise the packets are decoded and dropped one at a time to get to the keys after them.
+    """
+    header = {}
+    with open(path, 'r') as f:
+        if is_ndjson(path):
+            return json.loads(f.readline())
+        stream = JSONStream(f)
+        for key in stream.object_keys():
+            if stream.peek() != "[":
+                header[key] = stream.value()
+                continue
+            if required is not None and all(k in header for k in required):
+                return header
+            for item in stream.array():
+                pass
+    return header
+
+
+def map_packets(path, key, header=None):
+    """Yield each packet in the array under key in the map at path, decoding one at a time. If header is a dict,
+    the other keys of the map are added to it, including the ones after the packets, so that everything in the
+    map can be read in one pass."""
+    with open(path, 'r') as f:
+        if is_ndjson(path):
+            first_line = json.loads(f.readline())
+            if header is not None:
+                header.update(first_line)
+            for line in f:
+                if line.strip() != "":
+                    yield json.loads(line)
+            return
+        stream = JSONStream(f)
+        for k in stream.object_keys():
+            if k == key and stream.peek() == "[":
+                yield from stream.array()
+                if header is None:
+                    return
+            elif header is not None:
+                header[k] = stream.value()
+            else:
+                stream.value()
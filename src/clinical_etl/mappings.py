@@ -1,5 +1,5 @@
 import ast
-import dateparser
+import sys
 import json
 import datetime
 import math
@@ -14,7 +14,21 @@ INDEXED_DATA = None
 CURRENT_LINE = ""
 OUTPUT_FILE = ""
 DATE_FORMAT = None
-DEFAULT_DATE_PARSER = dateparser.DateDataParser(settings={'PREFER_DAY_OF_MONTH': 'first'})
+PROFILE = None
+# if this is a list, the warnings and information from mapping functions are added to it instead of printed
+MESSAGES = None
+# languages that dates can be written in, or None to detect them; a manifest can specify them as date_languages
+DEFAULT_DATE_LANGUAGES = None
+DATE_LANGUAGES = DEFAULT_DATE_LANGUAGES
+# dateparser.DateDataParsers for each date order and set of languages, created when they are first needed
+_DATE_PARSERS = {}
+
+
+def __getattr__(name):
+    # DEFAULT_DATE_PARSER is created when it is first used: importing dateparser and loading its language data is slow
+    if name == "DEFAULT_DATE_PARSER":
+        return _date_parser()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 class MappingError(Exception):
@@ -27,16 +41,44 @@ class MappingError(Exception):
     def __init__(self, value, field_level=3):
         self.value = value
         self.level = field_level
+        # keep track of where the error happened, for the snapshot
+        self.identifier = IDENTIFIER
+        self.line = CURRENT_LINE
+        self.index_stack = [dict(item) for item in INDEX_STACK]
+        self.snapshot_written = False
 
     def __str__(self):
-        with open(f"{OUTPUT_FILE}_indexed.json", "w") as f:
-            json.dump(INDEXED_DATA, f, indent=4)
+        if not self.snapshot_written:
+            self.write_snapshot()
         if self.level == 1:
             return repr(f"{self.value}")
         elif self.level == 2:
-            return repr(f"Check the values for {IDENTIFIER}: {self.value}")
+            return repr(f"Check the values for {self.identifier}: {self.value}")
         elif self.level == 3:
-            return repr(f"Check the values for {IDENTIFIER} in {IDENTIFIER_FIELD}: {self.value}")
+            return repr(f"Check the values for {self.identifier} in {IDENTIFIER_FIELD}: {self.value}")
+
+    def write_snapshot(self):
+        """Write the failing individual's rows from each sheet, the template line and the index stack to
+        {OUTPUT_FILE}_error_snapshot.json. The full INDEXED_DATA is only written with the --index option."""
+        if OUTPUT_FILE is None:
+            # converting in memory: there is nowhere to write the snapshot
+            self.snapshot_written = True
+            return
+        snapshot = {
+            "error": self.value,
+            "identifier_field": IDENTIFIER_FIELD,
+            "identifier": self.identifier,
+            "template_line": self.line,
+            "index_stack": self.index_stack,
+            "data": {}
+        }
+        if INDEXED_DATA is not None:
+            for sheet in INDEXED_DATA["data"]:
+                if self.identifier in INDEXED_DATA["data"][sheet]:
+                    snapshot["data"][sheet] = INDEXED_DATA["data"][sheet][self.identifier]
+        with open(f"{OUTPUT_FILE}_error_snapshot.json", "w") as f:
+            json.dump(snapshot, f, indent=4, default=str)
+        self.snapshot_written = True
 
 
 def date(data_values):
@@ -71,14 +113,15 @@ def earliest_date(data_values):
     fields = list(data_values.keys())
     date_resolution = list(data_values[fields[0]].values())[0]
     dates = list(data_values[fields[1]].values())[0]
-    earliest = DEFAULT_DATE_PARSER.get_date_data(str(datetime.date.today()))
+    parser = _date_parser()
+    earliest = parser.get_date_data(str(datetime.date.today()))
     # Ensure dates is a list, not a string, to allow non-indexed, single value entries.
     if type(dates) is not list:
         dates_list = [dates]
     else:
         dates_list = dates
     for date in dates_list:
-        d = DEFAULT_DATE_PARSER.get_date_data(date)
+        d = parser.get_date_data(date)
         if d['date_obj'] < earliest['date_obj']:
             earliest = d
     return {
@@ -101,14 +144,12 @@ def date_interval(data_values):
         reference = INDEXED_DATA["data"]["CALCULATED"][IDENTIFIER]["REFERENCE_DATE"][0]
     except KeyError:
         raise MappingError("No reference date found to calculate date_interval: is there a reference_date specified in the manifest?", field_level=1)
-    DEFAULT_DATE_PARSER = dateparser.DateDataParser(
-        settings={"PREFER_DAY_OF_MONTH": "first", "DATE_ORDER": DATE_FORMAT}
-    )
+    parser = _date_parser(DATE_FORMAT)
     endpoint = single_val(data_values)
     if endpoint is None:
         return None
-    offset = DEFAULT_DATE_PARSER.get_date_data(reference["offset"])["date_obj"]
-    date_obj = DEFAULT_DATE_PARSER.get_date_data(endpoint)["date_obj"]
+    offset = parser.get_date_data(reference["offset"])["date_obj"]
+    date_obj = parser.get_date_data(endpoint)["date_obj"]
     if date_obj is None:
         raise MappingError(f"Cannot parse date '{endpoint}'", field_level=2)
     is_neg = False
@@ -208,7 +249,7 @@ def single_val(data_values):
 
     Returns:
         A single value with any null values removed
-        None if list is empty or contains only 'nan', 'NaN', 'NAN'
+        None if list is empty or contains only null values
 
     Raises:
         MappingError if multiple values found
@@ -223,10 +264,7 @@ def single_val(data_values):
         return None
     if len(all_items) > 1:
         raise MappingError(f"More than one value was found for {list(data_values.keys())[0]} in {data_values}", field_level=3)
-    result = list(all_items)[0]
-    if result is not None and result.lower() == 'nan':
-        result = None
-    return result
+    return list(all_items)[0]
 
 
 def list_val(data_values):
@@ -330,12 +368,14 @@ def boolean(data_values):
         A boolean based on the input,
         `False` if value is in ["No", "no", "N", "n", "False", "false", "F", "f"]
         `True` if value is in ["Yes", "yes", "Y", "y", True", "true", "T", "t"]
-        None if value is in [`None`, "nan", "NaN", "NAN"]
+        None if value is null
         None otherwise
     """
     cell = single_val(data_values)
-    if cell is None or cell.lower().strip() == "nan":
+    if cell is None:
         return None
+    if type(cell) is bool:  # already converted at ingest
+        return cell
     if cell.lower().strip()[0] == "n" or cell.lower().strip()[0] == "f":
         return False
     if cell.lower().strip()[0] == "y" or cell.lower().strip()[0] == "t":
@@ -354,8 +394,10 @@ def integer(data_values):
         ValueError if int() cannot convert the input
     """
     cell = single_val(data_values)
-    if cell is None or cell.lower() == "nan":
+    if cell is None:
         return None
+    if type(cell) is int:  # already converted at ingest
+        return cell
     try:
         return int(float(cell))
     except ValueError as e:
@@ -376,8 +418,10 @@ def floating(data_values):
         ValueError by float() if it cannot convert to float.
     """
     cell = single_val(data_values)
-    if cell is None or cell.lower() == "nan":
+    if cell is None:
         return None
+    if type(cell) is float:  # already converted at ingest
+        return cell
     try:
         return float(cell)
     except ValueError as e:
@@ -466,26 +510,48 @@ def moh_indexed_on_donor_if_others_absent(data_values):
     }
 
 
+def _date_parser(date_order=None):
+    """Return the dateparser.DateDataParser for date_order (e.g. DMY) and the DATE_LANGUAGES, creating it the first
+    time it is needed. Without DATE_LANGUAGES, the parser detects the language of each date."""
+    languages = None if DATE_LANGUAGES is None else list(DATE_LANGUAGES)
+    key = (date_order, None if languages is None else tuple(languages))
+    if key not in _DATE_PARSERS:
+        import dateparser
+        settings = {"PREFER_DAY_OF_MONTH": "first"}
+        if date_order is not None:
+            settings["DATE_ORDER"] = date_order
+        _DATE_PARSERS[key] = dateparser.DateDataParser(languages=languages, settings=settings)
+    return _DATE_PARSERS[key]
+
+
+def _report(message):
+    """Prints a message for the user, or adds it to MESSAGES if that is a list."""
+    if MESSAGES is None:
+        print(message)
+    else:
+        MESSAGES.append(message)
+
+
 def _warn(message, input_values=None):
     """Warns a user when a mapping is unsuccessful with the IDENTIFIER and FIELD."""
     global IDENTIFIER
     if IDENTIFIER is not None and input_values is not None:
-        print(f"WARNING for {IDENTIFIER_FIELD}={IDENTIFIER}: {message}. Input data: {input_values}")
+        _report(f"WARNING for {IDENTIFIER_FIELD}={IDENTIFIER}: {message}. Input data: {input_values}")
     else:
-        print(f"WARNING: {message}")
+        _report(f"WARNING: {message}")
         if input_values is not None:
-            print(f"WARNING: {message}. Input data: {input_values}")
+            _report(f"WARNING: {message}. Input data: {input_values}")
 
 
 def _info(message, input_values=None):
     """Provides information to a user  when there may be an issue, along with the IDENTIFIER and FIELD."""
     global IDENTIFIER
     if IDENTIFIER is not None and input_values is not None:
-        print(f"INFO for {IDENTIFIER_FIELD}={IDENTIFIER}: {message}. Input data: {input_values}")
+        _report(f"INFO for {IDENTIFIER_FIELD}={IDENTIFIER}: {message}. Input data: {input_values}")
     else:
-        print(f"INFO: {message}")
+        _report(f"INFO: {message}")
         if input_values is not None:
-            print(f"INFO: {message}. Input data: {input_values}")
+            _report(f"INFO: {message}. Input data: {input_values}")
 
 
 def _push_to_stack(sheet, id, rownum):
@@ -521,12 +587,21 @@ def _peek_at_top_of_stack():
 
 
 def _is_null(cell):
-    """Convert nan, None, '' to boolean."""
-    if cell == 'nan' or cell is None or cell == '':
+    """Convert None, '' to boolean."""
+    if cell is None or cell == '':
         return True
     return False
 
 
+def _intern(value):
+    """Intern a mapped string (or list of strings) so that repeated values in the packets share one object."""
+    if type(value) is str:
+        return sys.intern(value)
+    if type(value) is list:
+        return [sys.intern(x) if type(x) is str else x for x in value]
+    return value
+
+
 def _single_map(mapping, field):
     """Parse the contents for the specified field from the template."""
     return single_val({field: mapping[field]})
@@ -548,7 +623,7 @@ def _parse_date(date_string):
     """
     if any(char in '0123456789' for char in date_string):
         try:
-            d = DEFAULT_DATE_PARSER.get_date_data(date_string)
+            d = _date_parser().get_date_data(date_string)
             return d['date_obj'].strftime("%Y-%m")
         except Exception as e:
             raise MappingError(f"error in date({date_string}): {type(e)} {e}", field_level=2)
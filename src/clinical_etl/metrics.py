@@ -0,0 +1,323 @@
+import csv
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+try:
+    import resource
+except ImportError:
+    # resource is not available on Windows: peak RSS is not reported there
+    resource = None
+
+# The Tracer for the current conversion, if --trace is specified
+TRACER = None
+
+
+def peak_rss_mb():
+    """Return the peak resident set size of this process so far, in MB, or None if it can't be measured."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    if sys.platform == "darwin":
+        return round(peak / (1024 * 1024), 1)
+    return round(peak / 1024, 1)
+
+
+class Metrics:
+    """
+    Records the wall time, CPU time and memory of each stage of a conversion, plus counts of the donors and rows
+    that were processed. The peak RSS of a process can only be measured since it started, so each stage reports
+    how much it raised the peak (peak_rss_increase_mb) and the peak so far at its end (peak_rss_so_far_mb).
+    """
+    def __init__(self):
+        self.stages = {}
+        self.counts = {}
+        self.started = {}
+
+    def start(self, stage):
+        self.started[stage] = (time.perf_counter(), time.process_time(), peak_rss_mb())
+
+    def end(self, stage):
+        wall_start, cpu_start, rss_start = self.started.pop(stage)
+        if stage not in self.stages:
+            self.stages[stage] = {"wall_seconds": 0.0, "cpu_seconds": 0.0, "calls": 0, "peak_rss_increase_mb": None}
+        # a stage can be run more than once, e.g. writing the map file before and after validation
+        self.stages[stage]["wall_seconds"] += time.perf_counter() - wall_start
+        self.stages[stage]["cpu_seconds"] += time.process_time() - cpu_start
+        self.stages[stage]["calls"] += 1
+        rss_end = peak_rss_mb()
+        if rss_end is not None:
+            increase = self.stages[stage]["peak_rss_increase_mb"] or 0.0
+            self.stages[stage]["peak_rss_increase_mb"] = increase + rss_end - rss_start
+        self.stages[stage]["peak_rss_so_far_mb"] = rss_end
+
+    def count(self, name, value):
+        self.counts[name] = value
+
+    def report(self):
+        """Return the stage measurements, totals and throughput as a dict."""
+        stages = {}
+        for stage in self.stages:
+            stages[stage] = {
+                "wall_seconds": round(self.stages[stage]["wall_seconds"], 4),
+                "cpu_seconds": round(self.stages[stage]["cpu_seconds"], 4),
+                "calls": self.stages[stage]["calls"],
+                "peak_rss_increase_mb": None if self.stages[stage]["peak_rss_increase_mb"] is None else
+                round(self.stages[stage]["peak_rss_increase_mb"], 1),
+                "peak_rss_so_far_mb": self.stages[stage]["peak_rss_so_far_mb"]
+            }
+        result = {
+            "stages": stages,
+            "total": {
+                "wall_seconds": round(sum(s["wall_seconds"] for s in self.stages.values()), 4),
+                "cpu_seconds": round(sum(s["cpu_seconds"] for s in self.stages.values()), 4),
+                "peak_rss_mb": peak_rss_mb()
+            },
+            "counts": dict(self.counts),
+            "throughput": {}
+        }
+        # donors/sec is measured over mapping, rows/sec over reading and indexing the input sheets
+        if "donors" in self.counts and "map_donors" in self.stages and self.stages["map_donors"]["wall_seconds"] > 0:
+            result["throughput"]["donors_per_second"] = round(
+                self.counts["donors"] / self.stages["map_donors"]["wall_seconds"], 2)
+        ingest_seconds = sum(self.stages[s]["wall_seconds"] for s in ["ingest", "process_data"] if s in self.stages)
+        if "rows" in self.counts and ingest_seconds > 0:
+            result["throughput"]["rows_per_second"] = round(self.counts["rows"] / ingest_seconds, 2)
+        return result
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=4)
+
+
+class MappingProfile:
+    """
+    Accumulates the number of calls, the time taken and the number of null results for each template line
+    and each mapping function (module.method) evaluated during a conversion.
+    """
+    def __init__(self):
+        self.lines = {}
+        self.functions = {}
+        self.function_names = {}  # the module.method of each mapping, so that it is only parsed once
+
+    def record(self, line, function, seconds, result):
+        for table, key in [(self.lines, line), (self.functions, function)]:
+            if key not in table:
+                table[key] = {"calls": 0, "seconds": 0.0, "nulls": 0}
+            table[key]["calls"] += 1
+            table[key]["seconds"] += seconds
+            if result is None:
+                table[key]["nulls"] += 1
+
+    def rows(self, kind):
+        """Return the totals for each template line (kind="line") or function (kind="function"), slowest first."""
+        table = self.lines
+        if kind == "function":
+            table = self.functions
+        result = []
+        for key in table:
+            result.append({
+                "kind": kind,
+                "name": key,
+                "calls": table[key]["calls"],
+                "total_seconds": round(table[key]["seconds"], 6),
+                "mean_seconds": round(table[key]["seconds"] / table[key]["calls"], 8),
+                "null_rate": round(table[key]["nulls"] / table[key]["calls"], 4)
+            })
+        return sorted(result, key=lambda x: x["total_seconds"], reverse=True)
+
+    def write_csv(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=["kind", "name", "calls", "total_seconds", "mean_seconds", "null_rate"])
+            writer.writeheader()
+            writer.writerows(self.rows("function") + self.rows("line"))
+
+    def print_top(self, n):
+        for kind, title in [("function", "Mapping function"), ("line", "Template line")]:
+            rows = self.rows(kind)[:n]
+            if len(rows) == 0:
+                continue
+            width = max(len(title), max(len(row["name"]) for row in rows))
+            print(f"\n{title:<{width}}  {'calls':>9}  {'total (s)':>10}  {'mean (ms)':>10}  {'null rate':>9}")
+            for row in rows:
+                print(f"{row['name']:<{width}}  {row['calls']:>9}  {row['total_seconds']:>10.4f}  "
+                      f"{row['mean_seconds'] * 1000:>10.4f}  {row['null_rate']:>9.1%}")
+
+
+class Tracer:
+    """
+    Collects spans in the Chrome trace event format, which can be viewed in Perfetto (https://ui.perfetto.dev)
+    or chrome://tracing. Per-donor spans are only kept for every `sample_every` donors.
+    """
+    def __init__(self, sample_every=1):
+        self.sample_every = max(1, sample_every)
+        self.origin = time.perf_counter()
+        self.events = [{
+            "name": "process_name",
+            "ph": "M",
+            "pid": os.getpid(),
+            "args": {"name": "clinical_etl"}
+        }]
+
+    def sampled(self, index):
+        """Return True if the span for the donor at this index should be kept."""
+        return index % self.sample_every == 0
+
+    def add(self, name, category, start, args=None):
+        """Add a span that started at start (a time.perf_counter() value) and ends now."""
+        end = time.perf_counter()
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": round((start - self.origin) * 1000000, 3),
+            "dur": round((end - start) * 1000000, 3),
+            "pid": os.getpid(),
+            "tid": threading.get_ident()
+        }
+        if args is not None:
+            event["args"] = args
+        self.events.append(event)
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+
+def deep_size(obj, seen=None):
+    """Return the approximate number of bytes used by obj and everything it contains. Objects whose ids are in
+    seen are not counted, so shared objects are only counted once."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key in obj:
+            size += deep_size(key, seen) + deep_size(obj[key], seen)
+    elif isinstance(obj, (list, tuple, set)):
+        for item in obj:
+            size += deep_size(item, seen)
+    return size
+
+
+class GrowingSize:
+    """
+    The deep size of a list or dict that only has items added to it. Each call to measure only measures the
+    items added since the previous one, so measuring it every N donors doesn't take longer as it grows.
+    """
+    def __init__(self):
+        self.size = 0
+        self.measured = set()
+        self.count = 0
+        self.seen = set()
+
+    def measure(self, container):
+        if isinstance(container, dict):
+            new = [key for key in container if key not in self.measured]
+            self.measured.update(new)
+            for key in new:
+                self.size += deep_size(key, self.seen) + deep_size(container[key], self.seen)
+        else:
+            for item in container[self.count:]:
+                self.size += deep_size(item, self.seen)
+            self.count = len(container)
+        return self.size + sys.getsizeof(container)
+
+
+class MemoryProfile:
+    """
+    Takes tracemalloc snapshots during a conversion and records the memory traced so far, the top allocation
+    sites, the allocation sites that grew the most since the previous snapshot, and the size of INDEXED_DATA,
+    its CALCULATED store and the packets. INDEXED_DATA is only measured at the end of a stage; CALCULATED and
+    the packets are measured as they grow.
+    """
+    def __init__(self, top=10):
+        self.top = top
+        self.snapshots = []
+        self.previous = None
+        self.indexed_size = None
+        self.calculated = GrowingSize()
+        self.packets = GrowingSize()
+        self.started = not tracemalloc.is_tracing()
+        if self.started:
+            tracemalloc.start()
+
+    def snapshot(self, label, indexed_data=None, packets=None, donors=None):
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>")
+        ])
+        current, peak = tracemalloc.get_traced_memory()
+        record = {
+            "label": label,
+            "donors": donors,
+            "traced_mb": round(current / (1024 * 1024), 3),
+            "peak_traced_mb": round(peak / (1024 * 1024), 3),
+            "structures_mb": {},
+            "top_allocations": [],
+            "top_growth": []
+        }
+        if indexed_data is not None:
+            calculated = indexed_data["data"].get("CALCULATED", {})
+            # the snapshots every N donors reuse the size from the end of the last stage
+            if self.indexed_size is None or donors is None:
+                self.indexed_size = deep_size(indexed_data, {id(calculated)})
+            record["structures_mb"]["INDEXED_DATA"] = round(self.indexed_size / (1024 * 1024), 3)
+            record["structures_mb"]["CALCULATED"] = round(self.calculated.measure(calculated) / (1024 * 1024), 3)
+        if packets is not None:
+            record["structures_mb"]["packets"] = round(self.packets.measure(packets) / (1024 * 1024), 3)
+        for stat in snapshot.statistics("lineno")[:self.top]:
+            frame = stat.traceback[0]
+            record["top_allocations"].append({
+                "location": f"{frame.filename}:{frame.lineno}",
+                "size_mb": round(stat.size / (1024 * 1024), 3),
+                "count": stat.count
+            })
+        if self.previous is not None:
+            for stat in snapshot.compare_to(self.previous, "lineno")[:self.top]:
+                frame = stat.traceback[0]
+                record["top_growth"].append({
+                    "location": f"{frame.filename}:{frame.lineno}",
+                    "size_diff_mb": round(stat.size_diff / (1024 * 1024), 3),
+                    "count_diff": stat.count_diff
+                })
+        self.previous = snapshot
+        self.snapshots.append(record)
+
+    def growth(self):
+        """Return the first and last size of each structure, and how much it grew per donor mapped."""
+        result = {}
+        mapped = [s for s in self.snapshots if s["donors"] is not None]
+        for name in ["INDEXED_DATA", "CALCULATED", "packets"]:
+            sizes = [s for s in self.snapshots if name in s["structures_mb"]]
+            if len(sizes) == 0:
+                continue
+            result[name] = {
+                "first_mb": sizes[0]["structures_mb"][name],
+                "last_mb": sizes[-1]["structures_mb"][name]
+            }
+            sizes = [s for s in mapped if name in s["structures_mb"]]
+            if len(sizes) > 1 and sizes[-1]["donors"] > sizes[0]["donors"]:
+                diff = sizes[-1]["structures_mb"][name] - sizes[0]["structures_mb"][name]
+                result[name]["bytes_per_donor"] = round(diff * 1024 * 1024 / (sizes[-1]["donors"] - sizes[0]["donors"]))
+        return result
+
+    def stop(self):
+        if self.started:
+            tracemalloc.stop()
+            self.started = False
+
+    def print_summary(self):
+        print(f"\n{'Snapshot':<24}  {'traced (MB)':>11}  {'INDEXED_DATA':>12}  {'CALCULATED':>10}  {'packets':>9}")
+        for s in self.snapshots:
+            sizes = [str(s["structures_mb"].get(name, "")) for name in ["INDEXED_DATA", "CALCULATED", "packets"]]
+            print(f"{s['label']:<24}  {s['traced_mb']:>11}  {sizes[0]:>12}  {sizes[1]:>10}  {sizes[2]:>9}")
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump({"snapshots": self.snapshots, "growth": self.growth()}, f, indent=4)
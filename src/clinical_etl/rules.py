@@ -0,0 +1,357 @@
+"""
+A small engine for the conditionals of a data model: fields that are required if another field has some value,
+fields that can't be submitted together, and dates that have to be in order. A schema class declares its
+conditionals as a list of rules, which are compiled once per class into a RuleSet that looks up the rules to
+evaluate on an instance of a schema by the fields that the instance has.
+"""
+
+import functools
+import time
+
+WARN = "warn"
+FAIL = "fail"
+
+
+"""
+Predicates on an instance of a schema, for the when argument of the rules
+"""
+
+def present(field):
+    """The field is submitted and isn't null."""
+    return lambda obj: obj.get(field) is not None
+
+
+def absent(field):
+    """The field isn't submitted at all."""
+    return lambda obj: field not in obj
+
+
+def equals(field, value):
+    return lambda obj: obj.get(field) == value
+
+
+def one_of(field, values):
+    values = list(values)
+    return lambda obj: obj.get(field) in values
+
+
+def truthy(field):
+    return lambda obj: bool(obj.get(field))
+
+
+def all_of(*predicates):
+    return lambda obj: all(predicate(obj) for predicate in predicates)
+
+
+def negate(predicate):
+    return lambda obj: not predicate(obj)
+
+
+# the number of distinct date strings whose ordinals are kept, across packets
+DATE_CACHE_SIZE = 1 << 16
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def date_ordinal(text):
+    """Return the proleptic Gregorian ordinal of the date in text, or None if it can't be parsed."""
+    import dateparser
+    parsed = dateparser.parse(text)
+    if parsed is None:
+        return None
+    return parsed.date().toordinal()
+
+
+def date_value(value):
+    """Return a value of a date field that can be compared to the others of the same packet: the month_interval
+    of a date that has been converted to an interval, or the ordinal of the parsed date. Empty or unparseable
+    dates are None."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, dict):
+        return value.get("month_interval")
+    return date_ordinal(value)
+
+
+def date_kind(value):
+    """Return "interval" for a date that has been converted to a month_interval and "date" for any other date:
+    values of different kinds can't be compared."""
+    return "interval" if isinstance(value, dict) else "date"
+
+
+class Dates:
+    """The date values of the fields of one object in a packet, each converted at most once, for all of the rules
+    evaluated on the object and for the checks of the objects that it is nested in, along with their kinds."""
+    def __init__(self, obj):
+        self.obj = obj
+        self.values = {}
+        self.kinds = {}
+
+    def __getitem__(self, field):
+        if field not in self.values:
+            self.values[field] = date_value(self.obj.get(field))
+            self.kinds[field] = date_kind(self.obj.get(field))
+        return self.values[field]
+
+    def kind(self, field):
+        self[field]
+        return self.kinds[field]
+
+
+def is_before(dates, field, other_dates, other_field):
+    """Return True if the date of field in dates is before the date of other_field in other_dates. A
+    month_interval is never before or after a date, because they can't be compared."""
+    value = dates[field]
+    other = other_dates[other_field]
+    if value is None or other is None or dates.kind(field) != other_dates.kind(other_field):
+        return False
+    return value < other
+
+
+"""
+Rules
+"""
+
+class Rule:
+    """
+    A conditional of schema_name, evaluated on each of its instances that has the trigger field, or on every
+    instance if trigger is None. Rules with a trigger are evaluated in the order of the fields of the instance,
+    and the ones for the same field in the order that they were declared, after the ones without a trigger.
+    The message is formatted with the fields of the instance, e.g. "{is_deceased}".
+    """
+    def __init__(self, schema_name, trigger, message=None, level=WARN, name=None):
+        self.schema_name = schema_name
+        self.trigger = trigger
+        self.message = message
+        self.level = level
+        self.name = name or f"{type(self).__name__}({trigger})"
+
+    def report(self, schema, obj, message=None, **kwargs):
+        message = message or self.message
+        if "{" in message:
+            message = message.format_map({**obj, **kwargs})
+        getattr(schema, self.level)(message)
+
+    def evaluate(self, schema, obj, dates):
+        raise NotImplementedError
+
+
+class Condition(Rule):
+    """Report the message if when is true for the instance."""
+    def __init__(self, schema_name, trigger, when, message, level=WARN, name=None):
+        super().__init__(schema_name, trigger, message, level, name)
+        self.when = when
+
+    def evaluate(self, schema, obj, dates):
+        if self.when(obj):
+            self.report(schema, obj)
+
+
+class RequiredIf(Rule):
+    """
+    Each of fields is required if when is true for the instance, or always if when is None. A field that is
+    null counts as missing unless null_is_missing is False. The message is also formatted with the "{field}".
+    """
+    def __init__(self, schema_name, trigger, fields, message, when=None, level=WARN, null_is_missing=True, name=None):
+        super().__init__(schema_name, trigger, message, level,
+                         name or f"RequiredIf({trigger}: {', '.join(fields)})")
+        self.fields = list(fields)
+        self.when = when
+        self.null_is_missing = null_is_missing
+
+    def evaluate(self, schema, obj, dates):
+        if self.when is not None and not self.when(obj):
+            return
+        for field in self.fields:
+            if field not in obj or (self.null_is_missing and obj[field] is None):
+                self.report(schema, obj, field=field)
+
+
+class ForbiddenIf(Rule):
+    """The field can't be submitted if when is true for the instance. A null field counts as not submitted
+    unless null_is_submitted is True."""
+    def __init__(self, schema_name, field, when, message, level=FAIL, null_is_submitted=False, name=None):
+        super().__init__(schema_name, field, message, level, name or f"ForbiddenIf({field})")
+        self.when = when
+        self.null_is_submitted = null_is_submitted
+
+    def evaluate(self, schema, obj, dates):
+        if (self.null_is_submitted or obj[self.trigger] is not None) and self.when(obj):
+            self.report(schema, obj)
+
+
+class RequiredForValues(Rule):
+    """For each value of the list field that is a key of requirements, which is {value: (nested, message)}, the
+    nested list has to have at least one item."""
+    def __init__(self, schema_name, field, requirements, level=WARN, name=None):
+        super().__init__(schema_name, field, level=level, name=name or f"RequiredForValues({field})")
+        self.requirements = dict(requirements)
+
+    def evaluate(self, schema, obj, dates):
+        if obj[self.trigger] is None:
+            return
+        for value in obj[self.trigger]:
+            requirement = self.requirements.get(value)
+            if requirement is not None:
+                nested, message = requirement
+                if nested not in obj or len(obj[nested]) == 0:
+                    self.report(schema, obj, message)
+
+
+class DateOrder(Rule):
+    """The date of the field earlier can't be after the date of the field later. The rule only applies if the
+    trigger and both dates are submitted, as well as all of the fields in requires."""
+    def __init__(self, schema_name, trigger, earlier, later, message, level=FAIL, requires=(), name=None):
+        super().__init__(schema_name, trigger, message, level, name or f"DateOrder({earlier} <= {later})")
+        self.earlier = earlier
+        self.later = later
+        self.requires = list(requires)
+
+    def evaluate(self, schema, obj, dates):
+        if obj[self.trigger] is None or any(obj.get(field) is None for field in self.requires):
+            return
+        if is_before(dates, self.later, dates, self.earlier):
+            self.report(schema, obj)
+
+
+class Check(Rule):
+    """A conditional that is written as a function(schema, obj, dates), for anything that can't be declared
+    with the other rules, e.g. conditionals across nested schemas."""
+    def __init__(self, schema_name, trigger, function, name=None):
+        super().__init__(schema_name, trigger, name=name or f"Check({function.__name__})")
+        self.function = function
+
+    def evaluate(self, schema, obj, dates):
+        self.function(schema, obj, dates)
+
+
+class RuleSet:
+    """
+    The rules of a schema class, indexed by schema and trigger field. The number of times that each rule is
+    evaluated is counted in the schema object's rule_counts, and with schema.profile_rules, the time spent in
+    it is added to its rule_times.
+    """
+    compiled = {}
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        # {schema name: [(index, rule)]} of the rules without a trigger
+        self.always = {}
+        # {schema name: {trigger: [(index, rule)]}}
+        self.triggered = {}
+        for index, rule in enumerate(self.rules):
+            if rule.trigger is None:
+                self.always.setdefault(rule.schema_name, []).append((index, rule))
+            else:
+                triggers = self.triggered.setdefault(rule.schema_name, {})
+                triggers.setdefault(rule.trigger, []).append((index, rule))
+
+    @classmethod
+    def for_class(cls, schema_class):
+        """Return the RuleSet of schema_class's rules, compiling it the first time."""
+        if schema_class not in cls.compiled:
+            cls.compiled[schema_class] = cls(schema_class.rules)
+        return cls.compiled[schema_class]
+
+    def evaluate(self, schema, schema_name, obj):
+        always = self.always.get(schema_name)
+        triggered = self.triggered.get(schema_name)
+        if always is None and triggered is None:
+            return
+        dates = schema.dates(obj)
+        matched = list(always or [])
+        if triggered is not None:
+            for prop in obj:
+                rules = triggered.get(prop)
+                if rules is not None:
+                    matched.extend(rules)
+        counts = schema.rule_counts
+        if not schema.profile_rules:
+            for index, rule in matched:
+                counts[index] += 1
+                rule.evaluate(schema, obj, dates)
+            return
+        times = schema.rule_times
+        for index, rule in matched:
+            start = time.perf_counter()
+            counts[index] += 1
+            rule.evaluate(schema, obj, dates)
+            times[index] += time.perf_counter() - start
+
+    def statistics(self, counts, times):
+        """Return the number of evaluations and the time spent in each rule, slowest first."""
+        result = []
+        for index, rule in enumerate(self.rules):
+            result.append({
+                "schema": rule.schema_name,
+                "rule": rule.name,
+                "evaluations": counts[index],
+                "seconds": round(times[index], 6)
+            })
+        return sorted(result, key=lambda x: (-x["seconds"], -x["evaluations"]))
+
+
+"""
+Conditionals across the nested schemas of a donor in the MoH data model, shared by MoHSchemaV2 and MoHSchemaV3
+"""
+
+def check_donor_dates(schema, donor, dates):
+    """The dates of each primary diagnosis and its treatments have to be between the donor's birth and death."""
+    diagnoses = donor["primary_diagnoses"] or []
+    if len(diagnoses) == 0:
+        return
+    diagnoses_dates = {}
+    intervals = None
+    for diagnosis in diagnoses:
+        diagnosis_id = diagnosis.get("submitter_primary_diagnosis_id")
+        diagnosis_dates = schema.dates(diagnosis)
+        diagnosis_date = diagnosis_dates["date_of_diagnosis"]
+        if diagnosis_date is not None:
+            if intervals is None:
+                # dates that have been converted to month_intervals, rather than date ordinals
+                intervals = diagnosis_dates.kind("date_of_diagnosis") == "interval" and type(diagnosis_date) is int
+            diagnoses_dates[diagnosis_id] = diagnosis_date
+            if is_before(dates, "date_of_death", diagnosis_dates, "date_of_diagnosis"):
+                schema.fail(f"{diagnosis_id}: date_of_death cannot be earlier than date_of_diagnosis")
+            if is_before(diagnosis_dates, "date_of_diagnosis", dates, "date_of_birth"):
+                schema.fail(f"{diagnosis_id}: date_of_birth cannot be later than date_of_diagnosis")
+        for treatment in diagnosis.get("treatments") or []:
+            location = f"{diagnosis_id} > {treatment.get('submitter_treatment_id')}"
+            treatment_dates = schema.dates(treatment)
+            if is_before(dates, "date_of_death", treatment_dates, "treatment_end_date"):
+                schema.fail(f"{location}: date_of_death cannot be earlier than treatment_end_date ")
+            if is_before(treatment_dates, "treatment_end_date", diagnosis_dates, "date_of_diagnosis"):
+                schema.warn(f"{location}: date_of_diagnosis should be earlier than treatment_end_date ")
+            if is_before(dates, "date_of_death", treatment_dates, "treatment_start_date"):
+                schema.fail(f"{location}: treatment_start_date cannot be after date_of_death ")
+            if is_before(treatment_dates, "treatment_start_date", dates, "date_of_birth"):
+                schema.fail(f"{location}: treatment_start_date cannot be before date_of_birth")
+            if is_before(treatment_dates, "treatment_start_date", diagnosis_dates, "date_of_diagnosis"):
+                schema.warn(f"{location}: treatment_start_date should not be before date_of_diagnosis")
+    if intervals and 0 not in diagnoses_dates.values():
+        schema.warn(f"Earliest primary_diagnosis.date_of_diagnosis.month_interval should be 0, current "
+                    f"month_intervals: {diagnoses_dates}")
+
+
+def check_biomarker_dates(schema, donor, dates):
+    """Biomarkers that are submitted directly for a donor need a test_date."""
+    for x in donor["biomarkers"] or []:
+        if "test_date" not in x or x["test_date"] is None:
+            schema.warn("test_date is required for biomarkers not associated with nested events")
+
+
+def staging_rules(schema_name, staging_type, when=None):
+    """The fields that are required for the {staging_type}_tumour_staging_system of schema_name: the t, n and m
+    categories for AJCC staging, and the stage group for any other system."""
+    system = f"{staging_type}_tumour_staging_system"
+    is_ajcc = lambda obj: obj[system] is not None and "AJCC" in obj[system]
+    not_ajcc = lambda obj: obj[system] is not None and "AJCC" not in obj[system]
+    if when is not None:
+        is_ajcc = all_of(when, is_ajcc)
+        not_ajcc = all_of(when, not_ajcc)
+    return [
+        RequiredIf(schema_name, system, [f"{staging_type}_t_category", f"{staging_type}_n_category",
+                                         f"{staging_type}_m_category"],
+                   "{field} is required if " + system + " is AJCC", when=is_ajcc),
+        RequiredIf(schema_name, system, [f"{staging_type}_stage_group"],
+                   "{field} is required for " + system + " {" + system + "}", when=not_ajcc)
+    ]
@@ -1,13 +1,16 @@
 # mappings and validation based on the mohccn schema
 
-import requests
+import os
 import yaml
 import json
 import re
+import time
 from copy import deepcopy
-import jsonschema
 from collections import Counter
-import openapi_spec_validator as osv
+from clinical_etl import metrics
+from clinical_etl.rules import Dates, RuleSet
+# requests, jsonschema and openapi_spec_validator are slow to import: they are imported when a schema is
+# loaded or validated
 
 
 class ValidationError(Exception):
@@ -17,6 +20,80 @@ class ValidationError(Exception):
     def __str__(self):
         return repr(f"Validation error: {self.value}")
 
+"""
+Statistics about the completeness of validated packets
+"""
+
+class Statistics:
+    """
+    Aggregates the required_but_missing counts, the schemas used and the cases missing data while packets are
+    validated. Schemas and cases are kept in dicts used as ordered sets, so adding one is O(1) but they are still
+    reported in the order they were first seen. Partial statistics, e.g. of one donor, can be merged, and are
+    converted to and from the statistics json that is written to _map.json.
+    """
+    def __init__(self):
+        # {schema name: {field: [total, missing]}}
+        self.required_but_missing = {}
+        self.schemas_used = {}
+        self.cases_missing_data = {}
+
+    def use_schema(self, schema_name):
+        if schema_name not in self.schemas_used:
+            self.schemas_used[schema_name] = None
+            self.required_but_missing.setdefault(schema_name, {})
+
+    def count_required(self, schema_name, field, missing, case):
+        """Count a required field of an instance of schema_name in case, which is missing or not."""
+        counts = self.required_but_missing[schema_name].get(field)
+        if counts is None:
+            counts = self.required_but_missing[schema_name][field] = [0, 0]
+        counts[0] += 1
+        if missing:
+            counts[1] += 1
+            self.cases_missing_data[case] = None
+
+    def merge(self, other):
+        """Add the statistics of other to these."""
+        for schema_name, fields in other.required_but_missing.items():
+            required = self.required_but_missing.setdefault(schema_name, {})
+            for f, counts in fields.items():
+                if f in required:
+                    required[f][0] += counts[0]
+                    required[f][1] += counts[1]
+                else:
+                    required[f] = list(counts)
+        self.schemas_used.update(other.schemas_used)
+        self.cases_missing_data.update(other.cases_missing_data)
+
+    @classmethod
+    def from_dict(cls, statistics):
+        result = cls()
+        for schema_name, fields in statistics["required_but_missing"].items():
+            result.required_but_missing[schema_name] = {f: [counts["total"], counts["missing"]]
+                                                        for f, counts in fields.items()}
+        result.schemas_used = dict.fromkeys(statistics["schemas_used"])
+        result.cases_missing_data = dict.fromkeys(statistics["cases_missing_data"])
+        return result
+
+    def to_dict(self):
+        return {
+            "required_but_missing": {schema_name: {f: {"total": counts[0], "missing": counts[1]}
+                                                   for f, counts in fields.items()}
+                                     for schema_name, fields in self.required_but_missing.items()},
+            "schemas_used": list(self.schemas_used),
+            "cases_missing_data": list(self.cases_missing_data)
+        }
+
+    def summary(self, schema_names, total_cases):
+        """Return the statistics of total_cases packets validated against schema_names, as written to _map.json."""
+        result = self.to_dict()
+        result["schemas_not_used"] = list(set(schema_names) - set(self.schemas_used))
+        result["summary_cases"] = {
+            "complete_cases": total_cases - len(self.cases_missing_data),
+            "total_cases": total_cases
+        }
+        return result
+
 """
 Convenience methods for validating openapi as jsonschema
 """
@@ -32,9 +109,9 @@ def openapi_to_jsonschema(schema_text, schema_name):
             defs_set.add(ref_match.group(2).strip('\"').strip("\'").replace("#/components/schemas/", ""))
 
     openapi_components = yaml.safe_load("\n".join(schema_text))["components"]["schemas"]
-    # populate defs for jsonschema
+    # populate defs for jsonschema, in a fixed order so that the same schema always makes the same json_schema
     defs = {}
-    for d in defs_set:
+    for d in sorted(defs_set):
         defs[d] = openapi_components[d]
 
     json_schema = deepcopy(openapi_components[schema_name])
@@ -51,7 +128,7 @@ class BaseSchema:
 
     # schema for validation beyond jsonschema checks. Each schema that is described in the model gets an entry.
     validation_schema = {
-        "examples": {             # There should be a method `validate_examples` implemented to validate conditionals
+        "examples": {             # Conditionals are declared in `rules`; a method `validate_examples` can also be implemented
             "id": "example_id",  # The id used to disambiguate instances of the schema. If None, an array index is used
             "name": "Example",   # The proper name for the schema
             "required_fields": [ # Any fields specified as required in the model (but not absolutely necessary for jsonschema)
@@ -70,26 +147,53 @@ class BaseSchema:
         }
     }
 
+    # the conditionals of the model that are checked beyond jsonschema, e.g.
+    # RequiredIf("examples", "attribute_1", ["attribute_2"], "attribute_2 is required if attribute_1 = Yes",
+    #            when=equals("attribute_1", "Yes")); see rules.py
+    rules = []
+
 
     def __init__(self, url, simple=False):
         self.validation_warnings = []
         self.validation_errors = []
         self.statistics = {}
+        # the running statistics while packets are validated; self.statistics is the result
+        self.stats = Statistics()
         self.identifiers = {}
         self.stack_location = []
+        # the number of evaluations of each of the rules and, with profile_rules, the time spent in them
+        self.rule_set = RuleSet.for_class(type(self))
+        self.rule_counts = [0] * len(self.rule_set.rules)
+        self.rule_times = [0.0] * len(self.rule_set.rules)
+        self.profile_rules = False
+        # the Dates of each object of the packet that is being validated, by id
+        self.packet_dates = {}
+        # with fast_validation, packets are checked against json_schema by a validator generated from it
+        self.fast_validation = False
+        self.json_validator = None
         self.schema = {}
         self.openapi_url = url
         self.json_schema = None
         self.template = None
         self.katsu_sha = None
         self.scaffold = None
+        self.donor_results = []
 
-        """Retrieve the schema from the supplied URL, return as dictionary."""
+        """Retrieve the schema from the supplied URL or local file, return as dictionary."""
+        import openapi_spec_validator as osv
+        import requests
         try:
-            osv.validate_url(self.openapi_url)
-            resp = requests.get(self.openapi_url)
-            resp.raise_for_status()
-            schema = yaml.safe_load(resp.text)
+            if os.path.isfile(self.openapi_url):
+                with open(self.openapi_url, 'r') as f:
+                    schema_text = f.read()
+                schema = yaml.safe_load(schema_text)
+                osv.validate(schema)
+            else:
+                osv.validate_url(self.openapi_url)
+                resp = requests.get(self.openapi_url)
+                resp.raise_for_status()
+                schema_text = resp.text
+                schema = yaml.safe_load(schema_text)
         except Exception as e:
             print("Error reading the openapi schema, please ensure you have provided a url to a valid openapi schema.")
             print(e)
@@ -104,7 +208,7 @@ class BaseSchema:
             if sha_match is not None:
                 self.katsu_sha = sha_match.group(1)
 
-        self.json_schema = openapi_to_jsonschema(resp.text, self.schema_name)
+        self.json_schema = openapi_to_jsonschema(schema_text, self.schema_name)
 
         # create the template for the schema_name schema
         self.scaffold = self.generate_schema_scaffold(self.schema[self.schema_name], list(self.validation_schema.keys())[0])
@@ -309,34 +413,122 @@ class BaseSchema:
                 result.append(x)
         return result
 
-    def validate_ingest_map(self, map_json):
-        self.statistics["required_but_missing"] = {}
-        self.statistics["schemas_used"] = []
-        self.statistics["cases_missing_data"] = []
+    def reset_validation(self):
+        """Clear the results of validating a previous map, so that the schema object can be used again."""
+        self.validation_errors = []
+        self.validation_warnings = []
+        self.identifiers = {}
+        self.statistics = {}
+        self.stats = Statistics()
+        self.rule_counts = [0] * len(self.rule_set.rules)
+        self.rule_times = [0.0] * len(self.rule_set.rules)
+
+    def rule_statistics(self):
+        """Return the number of times each of the rules was evaluated since the last reset_validation, and with
+        profile_rules, the time spent in it."""
+        return self.rule_set.statistics(self.rule_counts, self.rule_times)
+
+    def validate_ingest_map(self, map_json, reuse=None, cache=None):
+        """Validate all of the root-level packets in map_json. The result of validating each packet is also kept
+        in self.donor_results; if reuse is specified, it is a dict of {packet index: donor result} from a
+        previous run that will be used instead of revalidating those packets. If cache is a ValidationCache,
+        the results of unchanged packets are read from it and the others are added to it."""
+        root_schema = list(self.validation_schema.keys())[0]
+        self.validate_packets(map_json[root_schema], reuse=reuse, cache=cache)
+
+
+    def validate_packets(self, packets, reuse=None, keep_results=True, cache=None):
+        """Validate the root-level packets, which can be any iterable, e.g. one that decodes each packet from a
+        file as it is needed. With keep_results=False, self.donor_results is left empty, so that only the
+        running results and statistics are held in memory."""
+        self.stats = Statistics()
+        self.donor_results = []
 
         for key in self.validation_schema.keys():
             self.validation_schema[key]["extra_args"] = {
                 "index": 0
             }
-        root_schema = list(self.validation_schema.keys())[0]
-        for x in range(0, len(map_json[root_schema])):
-            self.validate_jsonschema(map_json[root_schema][x], x)
-            self.validate_schema(root_schema, map_json[root_schema][x])
+        start = time.perf_counter()
+        total = 0
+        for x, packet in enumerate(packets):
+            key = None
+            donor_result = None
+            if reuse is not None and x in reuse:
+                donor_result = reuse[x]
+            elif cache is not None:
+                key = cache.key(packet, x)
+                donor_result = cache.get(key)
+            if donor_result is None:
+                donor_start = time.perf_counter()
+                donor_result = self.validate_donor(packet, x)
+                if metrics.TRACER is not None and metrics.TRACER.sampled(x):
+                    metrics.TRACER.add("validate_donor", "validation", donor_start, {"index": x})
+                if key is not None:
+                    cache.put(key, donor_result)
+            self.add_donor_result(donor_result)
+            if keep_results:
+                self.donor_results.append(donor_result)
+            total += 1
+        # duplicated IDs are counted over the merged identifiers of all packets, whether or not they were cached
         for schema in self.identifiers:
             most_common = self.identifiers[schema].most_common()
             if most_common[0][1] > 1:
                 for x in most_common:
                     if x[1] > 1:
                         self.fail(f"Duplicated IDs: in schema {schema}, {x[0]} occurs {x[1]} times")
-        self.statistics["schemas_not_used"] = list(set(self.validation_schema.keys()) - set(self.statistics["schemas_used"]))
-        self.statistics["summary_cases"] = {
-            "complete_cases": len(map_json[root_schema]) - len(self.statistics["cases_missing_data"]),
-            "total_cases": len(map_json[root_schema])
-        }
+        self.statistics = self.stats.summary(self.validation_schema.keys(), total)
+        if metrics.TRACER is not None:
+            metrics.TRACER.add("validate_ingest_map", "stage", start, {"packets": total})
+
+
+    def validate_donor(self, map_json, index):
+        """Validate a single root-level packet on its own and return its contribution to the results:
+        its errors and warnings, the identifiers it uses and its statistics."""
+        saved = (self.validation_errors, self.validation_warnings, self.identifiers, self.stats)
+        self.validation_errors = []
+        self.validation_warnings = []
+        self.identifiers = {}
+        self.stats = Statistics()
+        try:
+            self.validate_jsonschema(map_json, index)
+            self.validate_schema(list(self.validation_schema.keys())[0], map_json)
+            return {
+                "validation_errors": self.validation_errors,
+                "validation_warnings": self.validation_warnings,
+                "identifiers": {schema: dict(self.identifiers[schema]) for schema in self.identifiers},
+                "statistics": self.stats.to_dict()
+            }
+        finally:
+            self.validation_errors, self.validation_warnings, self.identifiers, self.stats = saved
+
+
+    def add_donor_result(self, donor_result):
+        """Add the result of validate_donor to the overall validation results."""
+        self.validation_errors.extend(donor_result["validation_errors"])
+        self.validation_warnings.extend(donor_result["validation_warnings"])
+        for schema in donor_result["identifiers"]:
+            if schema not in self.identifiers:
+                self.identifiers[schema] = Counter()
+            self.identifiers[schema].update(donor_result["identifiers"][schema])
+        self.stats.merge(Statistics.from_dict(donor_result["statistics"]))
+
+
+    def jsonschema_errors(self, map_json):
+        """Return the errors of map_json against json_schema, from a validator that is made once per schema."""
+        if self.json_validator is None or self.json_validator[0] is not self.json_schema \
+                or self.json_validator[1] != self.fast_validation:
+            if self.fast_validation:
+                from clinical_etl import fastvalidator
+                validator = fastvalidator.load(self.json_schema)
+            else:
+                import jsonschema
+                validator = jsonschema.Draft202012Validator(self.json_schema).iter_errors
+            self.json_validator = (self.json_schema, self.fast_validation, validator)
+        return self.json_validator[2](map_json)
 
 
     def validate_jsonschema(self, map_json, index):
-        for error in jsonschema.Draft202012Validator(self.json_schema).iter_errors(map_json):
+        for error in self.jsonschema_errors(map_json):
             id_field = self.validation_schema[list(self.validation_schema.keys())[0]]["id"]
 
             # is this error a None where it's nullable?
@@ -373,7 +565,19 @@ class BaseSchema:
                 self.fail(message)
 
 
+    def dates(self, obj):
+        """Return the Dates of obj, an object in the packet that is being validated, so that each of its dates is
+        only converted once while the packet is validated."""
+        dates = self.packet_dates.get(id(obj))
+        if dates is None:
+            # the Dates holds on to obj, so its id can't be reused by another object while it is in packet_dates
+            dates = self.packet_dates[id(obj)] = Dates(obj)
+        return dates
+
     def validate_schema(self, schema_name, map_json):
+        if len(self.stack_location) == 0:
+            # a new packet
+            self.packet_dates = {}
         id = f"{self.validation_schema[schema_name]['name']} {self.validation_schema[schema_name]['extra_args']['index']}"
         if self.validation_schema[schema_name]["id"] is not None and self.validation_schema[schema_name]["id"] in map_json:
             id = map_json[self.validation_schema[schema_name]["id"]]
@@ -386,28 +590,21 @@ class BaseSchema:
         case = self.stack_location[0]
 
         # print(f"Validating schema {schema_name} for {self.stack_location[-1]}")
-        if schema_name not in self.statistics["required_but_missing"]:
-            self.statistics["required_but_missing"][schema_name] = {}
-        if schema_name not in self.statistics["schemas_used"]:
-            self.statistics["schemas_used"].append(schema_name)
+        self.stats.use_schema(schema_name)
 
         remove_these = []
         for f in required_fields:
-            if f not in self.statistics["required_but_missing"][schema_name]:
-                self.statistics["required_but_missing"][schema_name][f] = {
-                    "total": 0,
-                    "missing": 0
-                }
-            self.statistics["required_but_missing"][schema_name][f]["total"] += 1
-            if f not in map_json:
+            missing = f not in map_json
+            self.stats.count_required(schema_name, f, missing, case)
+            if missing:
                 # self.warn(f"{f} required for {schema_name}")
-                self.statistics["required_but_missing"][schema_name][f]["missing"] += 1
-                if case not in self.statistics["cases_missing_data"]:
-                    self.statistics["cases_missing_data"].append(case)
                 map_json[f] = None
                 remove_these.append(f)
 
-        eval(f"self.validate_{schema_name}({map_json})")
+        self.rule_set.evaluate(self, schema_name, map_json)
+        validate = getattr(self, f"validate_{schema_name}", None)
+        if validate is not None:
+            validate(map_json)
         for f in remove_these:
             map_json.pop(f)
 
@@ -420,3 +617,5 @@ class BaseSchema:
                     else:
                         self.validate_schema(ns, map_json[ns])
         self.stack_location.pop()
+        if len(self.stack_location) == 0:
+            self.packet_dates = {}
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+import argparse
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+import traceback
+import yaml
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+# Include clinical_etl parent directory in the module search path.
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+from clinical_etl import mappings
+from clinical_etl.CSVConvert import Bcolors, ConversionError, convert, parse_manifest, read_mapping_template, \
+    validate_map
+
+DEFAULT_PORT = 8765
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run a local conversion server that keeps the schema, template and "
+                                                 "mapping functions of each manifest loaded between jobs.")
+    parser.add_argument('--host', type=str, default="127.0.0.1", help="Address to listen on. Default is 127.0.0.1")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f"Port to listen on. Default is {DEFAULT_PORT}")
+    parser.add_argument('--socket', type=str, help="Listen on this Unix socket instead of a port")
+    parser.add_argument('--manifest', type=str, nargs="+", required=True,
+                        help="Manifests to load when the server starts. Jobs can only use these manifests")
+    args = parser.parse_args()
+    return args
+
+
+class ManifestNotAllowed(ConversionError):
+    pass
+
+
+class WarmManifests:
+    """
+    The loaded schema, template lines and mapping function modules for each manifest, keyed by the manifest's
+    path. Only the manifests that were allowed can be used, because a manifest names the modules to import. A
+    manifest is loaded again if it, its template or its function modules change on disk.
+    """
+    def __init__(self):
+        self.manifests = {}
+        self.allowed = set()
+
+    def allow(self, manifest_file):
+        """Load a manifest and allow jobs to use it."""
+        entry = self.load(os.path.abspath(manifest_file))
+        self.allowed.add(os.path.abspath(manifest_file))
+        return entry
+
+    def files_changed(self, entry):
+        for path in entry["mtimes"]:
+            if not os.path.isfile(path) or os.path.getmtime(path) != entry["mtimes"][path]:
+                return True
+        return False
+
+    def get(self, manifest_file):
+        manifest_file = os.path.abspath(manifest_file)
+        if manifest_file not in self.allowed:
+            raise ManifestNotAllowed(f"{manifest_file} was not loaded when the server started")
+        if manifest_file in self.manifests and not self.files_changed(self.manifests[manifest_file]):
+            return self.manifests[manifest_file]
+        return self.load(manifest_file)
+
+    def load(self, manifest_file):
+        start = time.perf_counter()
+        try:
+            with open(manifest_file, 'r') as f:
+                raw_manifest = yaml.safe_load(f)
+        except FileNotFoundError:
+            raise ConversionError(f"Manifest file not found at provided path: {manifest_file}")
+        except yaml.YAMLError as e:
+            raise ConversionError(f"Manifest file isn't a valid yaml: {e}")
+        manifest_dir = os.path.dirname(manifest_file)
+        manifest = parse_manifest(raw_manifest, manifest_dir)
+        if "mapping" not in manifest or not os.path.isfile(manifest["mapping"]):
+            raise ConversionError(f"Mapping template not found for {manifest_file}")
+        functions = []
+        mtimes = {manifest_file: os.path.getmtime(manifest_file),
+                  manifest["mapping"]: os.path.getmtime(manifest["mapping"])}
+        for mod in raw_manifest.get("functions", []):
+            module = mappings.MODULES[os.path.splitext(os.path.basename(mod))[0]]
+            functions.append(module)
+            mtimes[module.__file__] = os.path.getmtime(module.__file__)
+        # convert() is given the loaded objects instead of paths, so nothing is read from disk for a job
+        manifest["functions"] = functions
+        manifest.pop("mapping")
+        entry = {
+            "manifest": manifest,
+            "template": read_mapping_template(os.path.join(manifest_dir, raw_manifest["mapping"])),
+            "mtimes": mtimes,
+            "load_seconds": round(time.perf_counter() - start, 3)
+        }
+        self.manifests[manifest_file] = entry
+        return entry
+
+    def status(self):
+        return {path: {"schema_class": type(entry["manifest"]["schema"]).__name__,
+                       "openapi_url": entry["manifest"]["schema"].openapi_url,
+                       "load_seconds": entry["load_seconds"]} for path, entry in self.manifests.items()}
+
+
+class ConversionHandler(BaseHTTPRequestHandler):
+    """
+    POST /convert {"manifest": path, "sheets": {sheet: [row, ...]}} streams back the packets as newline-delimited
+    json, one {"packet": ...} per line as each donor is mapped, followed by a line with the validation results and
+    statistics. If the job fails after the first packet was sent, the last line is {"error": ...} instead.
+    POST /validate {"manifest": path, "packets": [...]} returns the validation results and statistics.
+    GET /status returns the manifests that are loaded.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        # a Unix socket client has no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "unix"
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+    def write_line(self, body):
+        if not self.streaming:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            self.streaming = True
+        self.write_chunk(json.dumps(body).encode() + b"\n")
+
+    def write_packets(self, packets):
+        for packet in packets:
+            self.write_line({"packet": packet})
+
+    def send_error_json(self, status, message):
+        if self.streaming:
+            # the status has already been sent
+            self.write_line({"error": message})
+            self.write_chunk(b"")
+        else:
+            self.send_json(status, {"error": message})
+
+    def do_GET(self):
+        if self.path == "/status":
+            self.send_json(200, {"manifests": self.server.warm.status()})
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path not in ["/convert", "/validate"]:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        self.streaming = False
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if "manifest" not in job:
+                raise ConversionError("The job needs the path to a manifest as 'manifest'")
+            with self.server.lock:
+                warm = self.server.warm.get(job["manifest"])
+                if self.path == "/validate":
+                    schema = warm["manifest"]["schema"]
+                    result_key = list(schema.validation_schema.keys())[0]
+                    result = validate_map(schema, {result_key: job.get("packets", [])})
+                    result["statistics"] = schema.statistics
+                else:
+                    result = convert(job.get("sheets", {}), warm["manifest"], template=warm["template"],
+                                     typed=job.get("typed", False), categorical=job.get("categorical", False),
+                                     continue_on_error=job.get("continue_on_error", False),
+                                     on_packets=self.write_packets)
+            if self.path == "/validate":
+                self.send_json(200, result)
+                return
+        except ManifestNotAllowed as e:
+            self.send_error_json(403, str(e))
+            return
+        except (ConversionError, ValueError) as e:
+            self.send_error_json(400, str(e))
+            return
+        except Exception as e:
+            self.send_error_json(500, "".join(traceback.format_exception_only(type(e), e)).strip())
+            return
+
+        self.write_line({key: result[key] for key in ["validation_errors", "validation_warnings", "statistics",
+                                                      "donor_errors", "mapping_messages"]})
+        self.write_chunk(b"")
+
+
+class ConversionServer(ThreadingHTTPServer):
+    """A local http server for conversion jobs. Each connection has its own thread, but jobs run one at a time,
+    because the mapping state in clinical_etl.mappings is global."""
+    daemon_threads = True
+
+    def __init__(self, address, warm=None):
+        super().__init__(address, ConversionHandler)
+        self.warm = warm or WarmManifests()
+        self.lock = threading.Lock()
+
+
+class UnixConversionServer(socketserver.ThreadingUnixStreamServer):
+    """ConversionServer, listening on a Unix socket."""
+    daemon_threads = True
+
+    def __init__(self, path, warm=None):
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, ConversionHandler)
+        self.warm = warm or WarmManifests()
+        self.lock = threading.Lock()
+
+    def server_bind(self):
+        super().server_bind()
+        # only the user running the server can send it jobs
+        os.chmod(self.server_address, 0o600)
+
+
+def main(args):
+    warm = WarmManifests()
+    for manifest_file in args.manifest:
+        try:
+            entry = warm.allow(manifest_file)
+        except ConversionError as e:
+            sys.exit(str(e))
+        print(f"{Bcolors.OKGREEN}Loaded {manifest_file} in {entry['load_seconds']}s{Bcolors.ENDC}")
+    if args.socket is not None:
+        server = UnixConversionServer(args.socket, warm)
+        print(f"{Bcolors.OKGREEN}Listening on {args.socket}{Bcolors.ENDC}")
+    else:
+        server = ConversionServer((args.host, args.port), warm)
+        print(f"{Bcolors.OKGREEN}Listening on http://{args.host}:{server.server_port}{Bcolors.ENDC}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -1,13 +1,15 @@
 import argparse
 import json
 import sys
-import mappings
 import importlib.util
 import os
-# Include clinical_etl parent directory in the module search path for a later import.
+# Include clinical_etl parent directory in the module search path.
 current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
 sys.path.append(parent_dir)
+from clinical_etl import mappings
+from clinical_etl import jsonstream
+from clinical_etl import validation_cache
 # from jsoncomparison import Compare
 # from copy import deepcopy
 # import yaml
@@ -17,14 +19,18 @@ sys.path.append(parent_dir)
 # import CSVConvert
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('--json', type=str, help="<input-file-path-name>_map.json file generated by CSVConvert.py.",
                         required=True)
     parser.add_argument('--verbose', '--v', action="store_true", help="Print extra information")
+    parser.add_argument('--stream', action="store_true", help="Decode and validate one packet at a time instead of loading the whole file, so that memory is bounded by the largest packet. Always used for a newline-delimited .ndjson map.")
+    parser.add_argument('--cache', type=str, nargs="?", const="", help="Reuse the results of packets that are unchanged since the last run with --cache, from a cache file, <input-file-path-name>_validation_cache.json by default.")
+    parser.add_argument('--rule_stats', action="store_true", help="Time the conditional rules of the schema and print how many times each one was evaluated and the time spent in it.")
+    parser.add_argument('--fast-validation', action="store_true", help="Validate packets against the json schema with a validator generated from it and cached with the schema, instead of with jsonschema. The errors are the same.")
     # parser.add_argument('--manifest', type=str, help="Path to a manifest file describing the mapping.", required=False)
     # parser.add_argument('--input', type=str, required=False, help="Directory to the raw clinical data used for creating the JSON file.")
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     return args
 
 
@@ -205,18 +211,25 @@ def parse_args():
 #                     missing.append(comment_match.group(2))
 #     print("\n".join(missing))
 
-def validate_coverage(map_json, verbose=False):
+def validate_coverage(map_json, verbose=False, schema=None, cache_path=None, rule_stats=False,
+                      fast_validation=False):
+    """Validate map_json against its schema. A schema object that is already loaded can be given as schema.
+    If cache_path is specified, only the packets that aren't in the validation cache at cache_path are
+    validated, and the cache is updated with the results. With rule_stats, the evaluation counts and times of
+    the schema's rules are also returned. With fast_validation, the jsonschema checks are done by a validator
+    generated from the schema (see fastvalidator.py)."""
     if verbose:
         mappings.VERBOSE = True
 
     # read the schema and generate a scaffold
     if "openapi_url" not in map_json:
         return {"message": "No openapi_url schema available"}
-    schema_class = "MoHSchemaV3"
-    if "schema_class" in map_json:
-        schema_class = map_json["schema_class"]
-    schema_mod = importlib.import_module(f"clinical_etl.{schema_class.lower()}")
-    schema = getattr(schema_mod, schema_class)(map_json["openapi_url"])
+    if schema is None:
+        schema_class = "MoHSchemaV3"
+        if "schema_class" in map_json:
+            schema_class = map_json["schema_class"]
+        schema_mod = importlib.import_module(f"clinical_etl.{schema_class.lower()}")
+        schema = getattr(schema_mod, schema_class)(map_json["openapi_url"])
 
     if schema.json_schema is None:
         sys.exit(f"Did not find an openapi schema at {map_json['openapi_url']}; please check the 'openapi_url' in the map json file.")
@@ -231,15 +244,85 @@ def validate_coverage(map_json, verbose=False):
     #     check_completeness(raw_csv_dfs, schema)
 
     print("Validating the mapped schema...")
-    schema.validate_ingest_map(map_json)
+    schema.reset_validation()
+    schema.profile_rules = rule_stats
+    schema.fast_validation = fast_validation
+    cache = open_cache(cache_path, schema)
+    schema.validate_ingest_map(map_json, cache=cache)
+    close_cache(cache)
     # print(json.dumps(schema.validation_results, indent=4))
-    return {
+    return results(schema, rule_stats)
+
+def stream_coverage(json_path, verbose=False, schema=None, cache_path=None, rule_stats=False,
+                    fast_validation=False):
+    """Validate the map at json_path like validate_coverage, but decode its packets one at a time, so that only
+    the running results, statistics and identifier counts are held in memory, along with the validation cache
+    if cache_path is specified."""
+    if verbose:
+        mappings.VERBOSE = True
+    header = jsonstream.map_header(json_path, required=["openapi_url"])
+    if "openapi_url" not in header:
+        return {"message": "No openapi_url schema available"}
+    if schema is None:
+        schema_class = header.get("schema_class", "MoHSchemaV3")
+        schema_mod = importlib.import_module(f"clinical_etl.{schema_class.lower()}")
+        schema = getattr(schema_mod, schema_class)(header["openapi_url"])
+
+    if schema.json_schema is None:
+        sys.exit(f"Did not find an openapi schema at {header['openapi_url']}; please check the 'openapi_url' in the map json file.")
+
+    print("Validating the mapped schema...")
+    schema.reset_validation()
+    schema.profile_rules = rule_stats
+    schema.fast_validation = fast_validation
+    root_schema = list(schema.validation_schema.keys())[0]
+    cache = open_cache(cache_path, schema)
+    schema.validate_packets(jsonstream.map_packets(json_path, root_schema), keep_results=False, cache=cache)
+    close_cache(cache)
+    return results(schema, rule_stats)
+
+
+def results(schema, rule_stats=False):
+    result = {
         "errors": schema.validation_errors,
         "warnings": schema.validation_warnings,
         "statistics": schema.statistics
     }
+    if rule_stats:
+        schema.profile_rules = False
+        result["rules"] = schema.rule_statistics()
+    return result
+
+
+def open_cache(cache_path, schema):
+    if cache_path is None:
+        return None
+    return validation_cache.ValidationCache(cache_path, schema)
+
+
+def close_cache(cache):
+    if cache is None:
+        return
+    cache.save()
+    print(f"Reused the cached results of {cache.hits} of {cache.hits + cache.misses} packets, "
+          f"cache written to {cache.path}")
+
 
 def main(args):
+    verbose = True if args.verbose else False
+    cache_path = args.cache
+    if cache_path == "":
+        cache_path = validation_cache.default_path(args.json)
+    if args.stream or jsonstream.is_ndjson(args.json):
+        if not os.path.isfile(args.json):
+            sys.exit("JSON file not found at provided path, please check your --json argument.")
+        result = stream_coverage(args.json, verbose, cache_path=cache_path, rule_stats=args.rule_stats,
+                                 fast_validation=args.fast_validation)
+        if "message" in result:
+            sys.exit("No 'openapi_url' key found in the provided map json, please check you are providing the right "
+                     "file and try again, it should end with '_map.json'.")
+        report(result)
+        return
     try:
         with open(args.json) as fp:
             map_json = json.load(fp)
@@ -252,8 +335,16 @@ def main(args):
                  "try again, it should end with '_map.json'.")
 
     # input_path = args.input
-    verbose = True if args.verbose else False
-    result = validate_coverage(map_json, verbose)
+    report(validate_coverage(map_json, verbose, cache_path=cache_path, rule_stats=args.rule_stats,
+                             fast_validation=args.fast_validation))
+
+
+def report(result):
+    """Print the warnings and errors returned by validate_coverage, and the rule statistics if there are any."""
+    if "rules" in result:
+        print("Schema\tRule\tEvaluations\tSeconds")
+        for rule in result["rules"]:
+            print(f"{rule['schema']}\t{rule['rule']}\t{rule['evaluations']}\t{rule['seconds']}")
     if len(result["warnings"]) > 0:
         print("Mapping has missing data:")
         for line in result["warnings"]:
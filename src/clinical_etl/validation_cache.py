@@ -0,0 +1,85 @@
+"""
+A persistent cache of the result of validating each root-level packet, so that a map can be revalidated without
+going through jsonschema and the validate_* rules again for the packets that haven't changed. A packet's result
+is keyed by a hash of its canonical json, the schema class and the katsu_sha of the schema.
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import re
+from clinical_etl import rules
+
+
+def default_path(map_path):
+    """Return the cache file that goes with the map at map_path."""
+    return re.sub(r"(_map)?\.(json|ndjson|jsonl)$", "", map_path) + "_validation_cache.json"
+
+
+def schema_fingerprint(schema):
+    """Return a hash of what a packet's validation result depends on besides the packet itself: the schema class,
+    the source of the validation rules and the schema version. If the schema doesn't say which katsu commit it is
+    based on, the json schema itself is used."""
+    fingerprint = hashlib.sha256()
+    fingerprint.update(type(schema).__name__.encode())
+    sources = [inspect.getsourcefile(cls) for cls in type(schema).__mro__ if cls is not object]
+    for source in sources + [inspect.getsourcefile(rules)]:
+        with open(source, 'rb') as f:
+            fingerprint.update(f.read())
+    if schema.katsu_sha is not None:
+        fingerprint.update(schema.katsu_sha.encode())
+    else:
+        fingerprint.update(json.dumps(schema.json_schema, sort_keys=True).encode())
+    return fingerprint.hexdigest()
+
+
+class ValidationCache:
+    """
+    The per-donor results of validate_donor, read from and written to path. Only the results used in a run are
+    written back, so the file doesn't grow with packets that are no longer in the map.
+    """
+    def __init__(self, path, schema):
+        self.path = path
+        self.fingerprint = schema_fingerprint(schema)
+        root_schema = list(schema.validation_schema.keys())[0]
+        self.id_field = schema.validation_schema[root_schema]["id"]
+        self.previous = {}
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+        try:
+            with open(path) as f:
+                cache = json.load(f)
+            self.previous = cache["results"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            pass
+
+    def key(self, packet, index):
+        """Return the key of packet. A packet without an id is reported by its index, so the index is part of
+        its key."""
+        key = hashlib.sha256(self.fingerprint.encode())
+        if self.id_field is None or self.id_field not in packet:
+            key.update(f"{index}".encode())
+        key.update(json.dumps(packet, sort_keys=True, separators=(",", ":"), default=str).encode())
+        return key.hexdigest()
+
+    def get(self, key):
+        """Return the cached result for key, or None."""
+        donor_result = self.results.get(key, self.previous.get(key))
+        if donor_result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.results[key] = donor_result
+        return donor_result
+
+    def put(self, key, donor_result):
+        self.results[key] = donor_result
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory != "":
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump({"results": self.results}, f)
@@ -3,6 +3,8 @@ import yaml
 import os
 import sys
 import json
+import csv
+import shutil
 # Include src/clinical_etl directory in the module search path.
 current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
@@ -141,3 +143,772 @@ def test_multisheet_mapping(packets):
                         assert len(s["multisheet"]["placeholder"]["submitter_specimen_id"]["Sample_Registration"]) == 0
                         assert len(s["multisheet"]["placeholder"]["extra"]["Sample_Registration"]) == 0
 
+
+
+def test_process_data_nulls():
+    raw_csv_dfs, _ = CSVConvert.ingest_raw_data(f"{REPO_DIR}/raw_data")
+    mappings.IDENTIFIER_FIELD = "submitter_donor_id"
+    indexed_data = CSVConvert.process_data(raw_csv_dfs, False)
+    donor_1 = indexed_data["data"]["Donor"]["DONOR_1"]
+    # empty cells are real nulls, not the string 'nan'
+    assert donor_1["lost_to_followup_reason"] == [None]
+    # cells and column names are stripped
+    assert donor_1["program_id"] == ["TEST_1"]
+    assert len(indexed_data["data"]["Followup"]["DONOR_1"]["submitter_follow_up_id"]) == 4
+
+
+def test_typed_ingest():
+    raw_csv_dfs, _ = CSVConvert.ingest_raw_data(f"{REPO_DIR}/raw_data")
+    mappings.IDENTIFIER_FIELD = "submitter_donor_id"
+    template_lines = CSVConvert.read_mapping_template(f"{REPO_DIR}/test2mohv3.csv")
+    column_uses = CSVConvert.infer_column_uses(template_lines)
+    assert CSVConvert.typed_mapping_function(column_uses, "SystemicTherapy", "days_per_cycle") == "integer"
+    assert CSVConvert.typed_mapping_function(column_uses, "Donor", "gender") is None
+    indexed_data = CSVConvert.process_data(raw_csv_dfs, False, column_uses=column_uses)
+    therapy = indexed_data["data"]["SystemicTherapy"]["DONOR_2"]
+    assert therapy["days_per_cycle"] == [4, 5, 6]
+    assert therapy["prescribed_cumulative_drug_dose"] == [150.0, 150.0, 197.0]
+    assert mappings.integer({"days_per_cycle": {"SystemicTherapy": 4}}) == 4
+
+    import pandas
+    # a value that doesn't fit in an Int64 leaves the column to mappings.integer, which converts it exactly
+    column = pandas.Series(["4", "1e20", None], dtype="string")
+    converted, failed = CSVConvert.convert_typed_column(column, "integer")
+    assert converted is column and failed == []
+    assert mappings.integer({"days_per_cycle": {"SystemicTherapy": converted[1]}}) == 10 ** 20
+    # booleans are stripped like in mappings.boolean, and values that aren't booleans are reported
+    column = pandas.Series([" yes", "F", "maybe", None], dtype="string")
+    converted, failed = CSVConvert.convert_typed_column(column, "boolean")
+    assert list(converted.astype(object).where(converted.notna(), None)) == [True, False, None, None]
+    assert failed == ["maybe"]
+
+
+def test_categorical_columns():
+    raw_csv_dfs, _ = CSVConvert.ingest_raw_data(f"{REPO_DIR}/raw_data")
+    biomarkers = raw_csv_dfs["Biomarker"].astype("string")
+    # few distinct values: detected with --categorical
+    assert CSVConvert.is_categorical_column(biomarkers["er_status"], "Biomarker", "er_status", detect=True)
+    assert not CSVConvert.is_categorical_column(biomarkers["psa_level"], "Biomarker", "psa_level", detect=True)
+    assert not CSVConvert.is_categorical_column(biomarkers["er_status"], "Biomarker", "er_status")
+    # declared in the manifest
+    assert CSVConvert.is_categorical_column(biomarkers["psa_level"], "Biomarker", "psa_level", ["Biomarker.psa_level"])
+    mappings.IDENTIFIER_FIELD = "submitter_donor_id"
+    indexed_data = CSVConvert.process_data(raw_csv_dfs, False, categorical_columns=["Donor.gender"])
+    donors = indexed_data["data"]["Donor"]
+    assert donors["DONOR_1"]["gender"] == ["Man"]
+    assert donors["DONOR_1"]["gender"][0] is donors["DONOR_4"]["gender"][0]
+
+
+def test_incremental_conversion(tmp_path):
+    input_path = f"{tmp_path}/raw_data"
+    shutil.copytree(f"{REPO_DIR}/raw_data", input_path)
+    manifest_file = f"{REPO_DIR}/manifest.yml"
+    mappings.INDEX_STACK = []
+    first, _ = CSVConvert.csv_convert(input_path, manifest_file, incremental=True)
+    assert os.path.exists(f"{input_path}_incremental.json")
+
+    # change one donor: only that donor's packet should change
+    with open(f"{input_path}/Donor.csv") as f:
+        donors = f.read()
+    with open(f"{input_path}/Donor.csv", "w") as f:
+        f.write(donors.replace("DONOR_3,TEST_1", "DONOR_3,TEST_2"))
+    second, _ = CSVConvert.csv_convert(input_path, manifest_file, incremental=True)
+    assert len(second) == len(first)
+    for old, new in zip(first, second):
+        if new["submitter_donor_id"] == "DONOR_3":
+            assert new["program_id"] == "TEST_2"
+        else:
+            assert new == old
+
+
+def test_resume_conversion(tmp_path, monkeypatch):
+    input_path = f"{tmp_path}/raw_data"
+    shutil.copytree(f"{REPO_DIR}/raw_data", input_path)
+    manifest_file = f"{REPO_DIR}/manifest.yml"
+    checkpoint_file = f"{input_path}_checkpoint.ndjson"
+
+    # simulate an interrupted run by keeping the checkpoint around
+    monkeypatch.setattr(CSVConvert.Checkpoint, "remove", lambda self: None)
+    mappings.INDEX_STACK = []
+    first, _ = CSVConvert.csv_convert(input_path, manifest_file, checkpoint_every=2)
+    with open(checkpoint_file) as f:
+        lines = f.readlines()
+    assert len(lines) == 1 + len({packet["submitter_donor_id"] for packet in first})
+
+    # donors in the checkpoint are not mapped again: a marker added to DONOR_1's checkpointed packet survives
+    entry = json.loads(lines[1])
+    entry["packets"][0]["program_id"] = "CHECKPOINTED"
+    lines[1] = json.dumps(entry) + "\n"
+    with open(checkpoint_file, "w") as f:
+        f.writelines(lines)
+    monkeypatch.undo()
+    second, _ = CSVConvert.csv_convert(input_path, manifest_file, resume=True)
+    assert [p["submitter_donor_id"] for p in second] == [p["submitter_donor_id"] for p in first]
+    assert second[0]["program_id"] == "CHECKPOINTED"
+    assert not os.path.exists(checkpoint_file)
+
+    # once the inputs change, the checkpoint is no longer used: the marker is mapped again
+    monkeypatch.setattr(CSVConvert.Checkpoint, "remove", lambda self: None)
+    CSVConvert.csv_convert(input_path, manifest_file, checkpoint_every=2)
+    with open(checkpoint_file, "w") as f:
+        f.writelines(lines)
+    with open(f"{input_path}/Donor.csv", "a") as f:
+        f.write("\n")
+    third, _ = CSVConvert.csv_convert(input_path, manifest_file, resume=True)
+    assert "CHECKPOINTED" not in [packet["program_id"] for packet in third]
+    assert third == first
+
+
+def test_resume_after_error(tmp_path, monkeypatch):
+    input_path = f"{tmp_path}/raw_data"
+    shutil.copytree(f"{REPO_DIR}/raw_data", input_path)
+    manifest_file = f"{REPO_DIR}/manifest.yml"
+    mappings.INDEX_STACK = []
+    first, _ = CSVConvert.csv_convert(input_path, manifest_file)
+    donors = [packet["submitter_donor_id"] for packet in first]
+
+    # a donor fails after three donors are completed, one of them not yet written by checkpoint_every=2
+    map_donor = CSVConvert.map_donor
+    mapped = []
+
+    def failing_map_donor(indiv, *args):
+        if indiv == donors[3]:
+            raise mappings.MappingError("failed")
+        mapped.append(indiv)
+        return map_donor(indiv, *args)
+    monkeypatch.setattr(CSVConvert, "map_donor", failing_map_donor)
+    with pytest.raises(mappings.MappingError):
+        CSVConvert.csv_convert(input_path, manifest_file, checkpoint_every=2)
+    assert mapped == donors[0:3]
+
+    # all three are skipped when the run is resumed
+    mapped.clear()
+    monkeypatch.setattr(CSVConvert, "map_donor", lambda indiv, *args: mapped.append(indiv) or map_donor(indiv, *args))
+    mappings.INDEX_STACK = []
+    second, _ = CSVConvert.csv_convert(input_path, manifest_file, resume=True)
+    assert mapped == donors[3:]
+    assert second == first
+
+
+def test_continue_on_error(tmp_path):
+    input_path = f"{tmp_path}/raw_data"
+    shutil.copytree(f"{REPO_DIR}/raw_data", input_path)
+    manifest_file = f"{REPO_DIR}/manifest.yml"
+    with open(f"{input_path}/Treatment.csv") as f:
+        treatments = f.read()
+    with open(f"{input_path}/Treatment.csv", "w") as f:
+        f.write(treatments.replace("TR_2,DONOR_2,PD_2,Systemic therapy,No,01/12/2021", "TR_2,DONOR_2,PD_2,Systemic therapy,No,not a date"))
+
+    mappings.INDEX_STACK = []
+    with pytest.raises(mappings.MappingError):
+        CSVConvert.csv_convert(input_path, manifest_file)
+
+    # the broken donor is recorded and left out, and the other donors are still converted
+    mappings.INDEX_STACK = []
+    packets, errors = CSVConvert.csv_convert(input_path, manifest_file, continue_on_error=True)
+    assert errors
+    donors = [packet["submitter_donor_id"] for packet in packets]
+    assert "DONOR_2" not in donors
+    assert "DONOR_1" in donors and "DONOR_3" in donors
+    with open(f"{input_path}_errors.json") as f:
+        donor_errors = json.load(f)["errors"]
+    assert len(donor_errors) == 1
+    assert donor_errors[0]["donor"] == "DONOR_2"
+    assert "not a date" in donor_errors[0]["error"]
+    assert "treatment_start_date" in donor_errors[0]["template_line"]
+
+
+def test_error_snapshot(tmp_path):
+    input_path = f"{tmp_path}/raw_data"
+    shutil.copytree(f"{REPO_DIR}/raw_data", input_path)
+    manifest_file = f"{REPO_DIR}/manifest.yml"
+    with open(f"{input_path}/Treatment.csv") as f:
+        treatments = f.read()
+    with open(f"{input_path}/Treatment.csv", "w") as f:
+        f.write(treatments.replace("TR_2,DONOR_2,PD_2,Systemic therapy,No,01/12/2021", "TR_2,DONOR_2,PD_2,Systemic therapy,No,not a date"))
+
+    mappings.INDEX_STACK = []
+    with pytest.raises(mappings.MappingError) as e:
+        CSVConvert.csv_convert(input_path, manifest_file)
+    assert "DONOR_2" in str(e.value)
+
+    # only the failing donor's data is written, not the whole indexed data
+    assert not os.path.exists(f"{input_path}_indexed.json")
+    with open(f"{input_path}_error_snapshot.json") as f:
+        snapshot = json.load(f)
+    assert snapshot["identifier"] == "DONOR_2"
+    assert "treatment_start_date" in snapshot["template_line"]
+    assert len(snapshot["index_stack"]) > 0
+    assert snapshot["data"]["Treatment"]["treatment_start_date"][0] == "not a date"
+    assert "DONOR_1" not in json.dumps(snapshot)
+
+
+def test_metrics(tmp_path, monkeypatch):
+    input_path = f"{tmp_path}/raw_data"
+    shutil.copytree(f"{REPO_DIR}/raw_data", input_path)
+    manifest_file = f"{REPO_DIR}/manifest.yml"
+    mappings.INDEX_STACK = []
+    packets, _ = CSVConvert.csv_convert(input_path, manifest_file, metrics=True)
+    with open(f"{input_path}_metrics.json") as f:
+        report = json.load(f)
+    for stage in ["load_manifest", "ingest", "process_data", "create_scaffold", "map_donors", "write_map", "validation"]:
+        assert report["stages"][stage]["wall_seconds"] >= 0
+        assert report["stages"][stage]["cpu_seconds"] >= 0
+    assert report["stages"]["write_map"]["calls"] == 2
+    assert report["counts"]["donors"] == len(mappings.INDEXED_DATA["individuals"])
+    assert report["counts"]["packets"] == len(packets)
+    assert report["throughput"]["donors_per_second"] > 0
+    assert report["throughput"]["rows_per_second"] > 0
+
+    # each stage reports how much it raised the peak RSS, not the peak of the process so far
+    from clinical_etl import metrics
+    rss = iter([100.0, 150.0, 150.0, 150.0, 150.0])
+    monkeypatch.setattr(metrics, "peak_rss_mb", lambda: next(rss))
+    run_metrics = metrics.Metrics()
+    for stage in ["first", "second"]:
+        run_metrics.start(stage)
+        run_metrics.end(stage)
+    stages = run_metrics.report()["stages"]
+    assert stages["first"]["peak_rss_increase_mb"] == 50.0 and stages["first"]["peak_rss_so_far_mb"] == 150.0
+    assert stages["second"]["peak_rss_increase_mb"] == 0.0 and stages["second"]["peak_rss_so_far_mb"] == 150.0
+
+
+def test_profile(tmp_path):
+    input_path = f"{tmp_path}/raw_data"
+    shutil.copytree(f"{REPO_DIR}/raw_data", input_path)
+    manifest_file = f"{REPO_DIR}/manifest.yml"
+    mappings.INDEX_STACK = []
+    CSVConvert.csv_convert(input_path, manifest_file, profile=True)
+    assert mappings.PROFILE is None
+    with open(f"{input_path}_profile.csv") as f:
+        rows = list(csv.DictReader(f))
+    functions = {row["name"]: row for row in rows if row["kind"] == "function"}
+    lines = {row["name"]: row for row in rows if row["kind"] == "line"}
+    assert "mappings.single_val" in functions
+    assert int(functions["mappings.single_val"]["calls"]) > 0
+    assert 0 <= float(functions["mappings.single_val"]["null_rate"]) <= 1
+    assert "DONOR.INDEX.submitter_donor_id" in lines
+    # the indexed_on lookups are counted under their INDEX lines
+    assert "mappings.indexed_on" in functions
+    assert int(lines["DONOR.INDEX"]["calls"]) > 0
+    assert "DONOR.INDEX.primary_diagnoses.INDEX" in lines
+    # every evaluated mapping is counted once per function and once per template line
+    assert sum(int(row["calls"]) for row in functions.values()) == sum(int(row["calls"]) for row in lines.values())
+
+
+def test_trace(tmp_path):
+    input_path = f"{tmp_path}/raw_data"
+    shutil.copytree(f"{REPO_DIR}/raw_data", input_path)
+    manifest_file = f"{REPO_DIR}/manifest.yml"
+    mappings.INDEX_STACK = []
+    packets, _ = CSVConvert.csv_convert(input_path, manifest_file, trace=True, trace_sample=2)
+    with open(f"{input_path}_trace.json") as f:
+        events = json.load(f)["traceEvents"]
+    spans = [event for event in events if event["ph"] == "X"]
+    names = [span["name"] for span in spans]
+    for stage in ["ingest_raw_data", "process_data", "map_donors", "validate_ingest_map"]:
+        assert names.count(stage) == 1
+    assert "read_csv Donor" in names
+    # only every second donor's spans are kept
+    donors = len(mappings.INDEXED_DATA["individuals"])
+    assert names.count("map_donor") == (donors + 1) // 2
+    assert names.count("validate_donor") == (len(packets) + 1) // 2
+    assert all(span["dur"] >= 0 for span in spans)
+
+
+def test_memprofile(tmp_path):
+    input_path = f"{tmp_path}/raw_data"
+    shutil.copytree(f"{REPO_DIR}/raw_data", input_path)
+    manifest_file = f"{REPO_DIR}/manifest.yml"
+    mappings.INDEX_STACK = []
+    CSVConvert.csv_convert(input_path, manifest_file, memprofile=2)
+    with open(f"{input_path}_memprofile.json") as f:
+        report = json.load(f)
+    labels = [snapshot["label"] for snapshot in report["snapshots"]]
+    assert labels[:4] == ["load_manifest", "ingest", "process_data", "create_scaffold"]
+    assert labels[-2:] == ["map_donors", "validation"]
+    assert "2 donors" in labels and "4 donors" in labels
+    last = report["snapshots"][-1]
+    assert last["structures_mb"]["packets"] > 0
+    assert last["structures_mb"]["CALCULATED"] > 0
+    assert len(last["top_allocations"]) > 0
+    assert "bytes_per_donor" in report["growth"]["packets"]
+    # the sizes measured as the packets grow add up to the size of all of them
+    from clinical_etl import metrics
+    packets = [{"id": i, "values": [str(i)] * i} for i in range(5)]
+    size = metrics.GrowingSize()
+    size.measure(packets[:2])
+    assert size.measure(packets) == metrics.deep_size(packets)
+
+    # tracemalloc is stopped when the conversion fails
+    import tracemalloc
+    with pytest.raises(BaseException):
+        CSVConvert.csv_convert(f"{tmp_path}/missing", manifest_file, memprofile=2)
+    assert not tracemalloc.is_tracing()
+
+
+def test_generate_cohort(tmp_path):
+    from clinical_etl.generate_cohort import generate_cohort
+    with open(f"{REPO_DIR}/manifest.yml") as f:
+        manifest = yaml.safe_load(f)
+    input_path, manifest_file = generate_cohort(manifest["schema"], f"{tmp_path}/cohort", donors=5,
+                                                fanout={"primary_diagnoses": 2}, seed=1)
+    mappings.INDEX_STACK = []
+    packets, _ = CSVConvert.csv_convert(input_path, manifest_file)
+    ids = [packet["submitter_donor_id"] for packet in packets]
+    assert len(ids) == 5
+    assert len(set(ids)) == 5
+    assert any(len(packet.get("primary_diagnoses", [])) > 1 for packet in packets)
+    # each donor's dates are in order, and the fields that depend on is_deceased agree with it
+    with open(f"{input_path}_validation_results.json") as f:
+        results = json.load(f)
+    for message in results["validation_errors"] + results["validation_warnings"]:
+        assert not any(word in message for word in ["cannot be after", "cannot be earlier", "cannot be before",
+                                                    "should not be before", "should be earlier", "is_deceased"])
+    # the same seed generates the same cohort
+    second_path, _ = generate_cohort(manifest["schema"], f"{tmp_path}/second", donors=5,
+                                     fanout={"primary_diagnoses": 2}, seed=1)
+    for sheet in os.listdir(input_path):
+        with open(f"{input_path}/{sheet}") as a, open(f"{second_path}/{sheet}") as b:
+            assert a.read() == b.read()
+
+
+def test_benchmark(tmp_path):
+    from clinical_etl import benchmark
+    with open(f"{REPO_DIR}/manifest.yml") as f:
+        manifest = yaml.safe_load(f)
+    results = benchmark.run_benchmark(manifest["schema"], sizes=[3], workdir=f"{tmp_path}/bench")
+    stages = results["sizes"]["3"]["stages"]
+    for stage in benchmark.STAGES:
+        assert stages[stage]["wall_seconds"] >= 0
+    assert results["sizes"]["3"]["counts"]["donors"] == 3
+    # the schema is only downloaded once
+    assert len([f for f in os.listdir(f"{tmp_path}/bench") if f.startswith("schema_")]) == 1
+    assert not any(row["regression"] for row in benchmark.compare(results, results))
+    baseline = json.loads(json.dumps(results))
+    baseline["sizes"]["3"]["stages"]["map_donors"]["wall_seconds"] = stages["map_donors"]["wall_seconds"] / 2
+    rows = benchmark.compare(results, baseline, min_seconds=0)
+    assert [row["stage"] for row in rows if row["regression"]] == ["map_donors"]
+    rows = benchmark.compare(results, baseline, stage_thresholds={"map_donors": 2}, min_seconds=0)
+    assert not any(row["regression"] for row in rows)
+
+
+def test_differential(tmp_path):
+    from clinical_etl import differential
+    cases = [("tests/raw_data", f"{REPO_DIR}/raw_data", f"{REPO_DIR}/manifest.yml")]
+    report = differential.run_differential(cases, engines=["legacy", "typed"], workdir=f"{tmp_path}/diff")
+    assert report["cases"]["tests/raw_data"]["identical"]
+    assert report["cases"]["tests/raw_data"]["donors"] == 6
+
+    # a changed value and a changed validation message are reported against the donor they belong to
+    with open(f"{tmp_path}/diff/legacy/tests_raw_data/raw_data_map.json") as f:
+        map_json = json.load(f)
+    with open(f"{tmp_path}/diff/legacy/tests_raw_data/raw_data_validation_results.json") as f:
+        validation = json.load(f)
+    a = {"map": map_json, "validation": validation}
+    b = json.loads(json.dumps(a))
+    b["map"]["donors"][1]["primary_diagnoses"][0]["submitter_primary_diagnosis_id"] = "PD_X"
+    b["validation"]["validation_warnings"].append("DONOR_5: a new warning")
+    donors, differences = differential.compare_outputs(a, b)
+    assert donors == 6
+    donor_2 = b["map"]["donors"][1]["submitter_donor_id"]
+    assert [d["path"] for d in differences[donor_2]] == ["packet.primary_diagnoses[0].submitter_primary_diagnosis_id"]
+    assert differences["DONOR_5"][0]["a"] == "<missing>"
+    assert None not in differences
+
+    # donors with the same id are each compared, in order
+    a["map"]["donors"].append(json.loads(json.dumps(a["map"]["donors"][1])))
+    b = json.loads(json.dumps(a))
+    b["map"]["donors"][-1]["primary_diagnoses"][0]["submitter_primary_diagnosis_id"] = "PD_X"
+    donors, differences = differential.compare_outputs(a, b)
+    assert donors == 7
+    assert list(differences.keys()) == [f"{donor_2} #2"]
+
+    # a case that fails to convert is a failure, even if it fails the same way with both engines
+    cases = [("missing", f"{REPO_DIR}/raw_data", f"{tmp_path}/missing.yml")]
+    report = differential.run_differential(cases, engines=["legacy", "typed"], workdir=f"{tmp_path}/diff")
+    assert not report["cases"]["missing"]["identical"]
+
+
+def test_convert_in_memory(tmp_path, monkeypatch, capsys, packets, schema):
+    import pandas
+    with open(f"{REPO_DIR}/manifest.yml") as f:
+        manifest = yaml.safe_load(f)
+    manifest["functions"] = [f"{REPO_DIR}/testmap"]
+    template = CSVConvert.read_mapping_template(f"{REPO_DIR}/{manifest['mapping']}")
+    sheets = {}
+    for file in os.listdir(f"{REPO_DIR}/raw_data"):
+        sheets[file.replace(".csv", "")] = pandas.read_csv(f"{REPO_DIR}/raw_data/{file}", dtype=str)
+    # nothing is written to disk
+    monkeypatch.chdir(tmp_path)
+    capsys.readouterr()
+    result = CSVConvert.convert(sheets, manifest, template=template, schema=schema)
+    assert os.listdir(tmp_path) == []
+    # nothing is printed either: the messages of the mapping functions are returned
+    assert capsys.readouterr().out == ""
+    assert isinstance(result["mapping_messages"], list)
+    assert result["packets"] == packets
+    assert result["map"]["donors"] == packets
+    assert len(result["validation_warnings"]) == 4
+    assert "schemas_used" in result["statistics"]
+
+    # sheets can also be lists of rows, and the schema object can be reused
+    rows = {sheet: sheets[sheet].astype(object).where(sheets[sheet].notna(), None).to_dict(orient="records")
+            for sheet in sheets}
+    donors = []
+    again = CSVConvert.convert(rows, manifest, template=template, schema=schema, output_file=f"{tmp_path}/out",
+                               on_packets=donors.append)
+    assert again["packets"] == packets
+    # the packets of each donor are passed on as soon as it is mapped
+    assert len(donors) == 6
+    assert [packet for donor in donors for packet in donor] == packets
+    assert again["validation_warnings"] == result["validation_warnings"]
+    with open(f"{tmp_path}/out_map.json") as f:
+        assert json.load(f)["donors"] == packets
+
+    # problems are raised instead of exiting
+    with pytest.raises(CSVConvert.ConversionError):
+        CSVConvert.convert(sheets, {k: v for k, v in manifest.items() if k != "identifier"}, template=template,
+                           schema=schema)
+    with pytest.raises(CSVConvert.ConversionError):
+        CSVConvert.convert(dict(sheets, Extra=[{"submitter_donor_id": "DONOR_1"}]), manifest, template=template,
+                           schema=schema)
+    index_line = [line for line in template if line.startswith("DONOR.INDEX")][0]
+    with pytest.raises(CSVConvert.ConversionError):
+        CSVConvert.convert(sheets, manifest, template=template + [index_line], schema=schema)
+
+
+def test_server(tmp_path, packets):
+    import http.client
+    import stat
+    import threading
+    import pandas
+    from clinical_etl import server
+    warm = server.WarmManifests()
+    warm.allow(f"{REPO_DIR}/manifest.yml")
+    conversion_server = server.ConversionServer(("127.0.0.1", 0), warm)
+    thread = threading.Thread(target=conversion_server.serve_forever)
+    thread.start()
+    try:
+        sheets = {}
+        for file in os.listdir(f"{REPO_DIR}/raw_data"):
+            df = pandas.read_csv(f"{REPO_DIR}/raw_data/{file}", dtype=str)
+            sheets[file.replace(".csv", "")] = df.astype(object).where(df.notna(), None).to_dict(orient="records")
+        connection = http.client.HTTPConnection("127.0.0.1", conversion_server.server_port)
+        for i in range(0, 2):
+            connection.request("POST", "/convert", json.dumps({"manifest": f"{REPO_DIR}/manifest.yml", "sheets": sheets}))
+            response = connection.getresponse()
+            assert response.status == 200
+            lines = [json.loads(line) for line in response.read().decode().splitlines()]
+            assert [line["packet"] for line in lines[:-1]] == packets
+            assert len(lines[-1]["validation_warnings"]) == 4
+        connection.request("POST", "/validate", json.dumps({"manifest": f"{REPO_DIR}/manifest.yml", "packets": packets}))
+        response = connection.getresponse()
+        assert response.status == 200
+        assert json.loads(response.read())["validation_warnings"] == lines[-1]["validation_warnings"]
+        connection.request("GET", "/status")
+        assert f"{REPO_DIR}/manifest.yml" in json.loads(connection.getresponse().read())["manifests"]
+        # only the manifests that the server was started with can be used
+        connection.request("POST", "/convert", json.dumps({"manifest": f"{REPO_DIR}/missing.yml", "sheets": sheets}))
+        response = connection.getresponse()
+        assert response.status == 403
+        assert "missing.yml" in json.loads(response.read())["error"]
+    finally:
+        conversion_server.shutdown()
+        conversion_server.server_close()
+        thread.join()
+
+    unix_server = server.UnixConversionServer(str(tmp_path / "server.sock"), warm)
+    try:
+        assert stat.S_IMODE(os.stat(tmp_path / "server.sock").st_mode) == 0o600
+    finally:
+        unix_server.server_close()
+
+
+def test_import_time():
+    from clinical_etl import benchmark
+    # generous budget, so that this only fails if a slow dependency is imported at the top of a module again
+    imports = benchmark.run_import_benchmark(budget=2, repeat=1)
+    for module in benchmark.IMPORT_MODULES:
+        assert imports[module]["heavy_modules"] == []
+        assert imports[module]["within_budget"]
+    # the date parser is only created when a date is parsed, for the configured languages
+    mappings.DATE_LANGUAGES = ["en"]
+    parser = mappings._date_parser()
+    assert parser is mappings._date_parser()
+    earliest = mappings.earliest_date({"date_resolution": {"Donor.date_resolution": "day"},
+                                       "dates": {"Donor.dates": ["2020-01-05", "2019-03-02"]}})
+    assert earliest["offset"] == "2019-03-02"
+    # without date_languages in the manifest, the language of each date is detected
+    mappings.DATE_LANGUAGES = mappings.DEFAULT_DATE_LANGUAGES
+    assert mappings._parse_date("15 mars 2019") == "2019-03"
+    assert mappings._parse_date("janvier 2020") == "2020-01"
+
+
+def test_cli(tmp_path, monkeypatch, packets):
+    import requests
+    from clinical_etl import cli
+    cache_dir = str(tmp_path / "cache")
+    # by default the schema is only kept in memory
+    cli.main(["--cache_dir", cache_dir, "convert", "--input", f"{REPO_DIR}/raw_data", "--manifest",
+              f"{REPO_DIR}/manifest.yml", "then", "validate", "then", "completeness"])
+    assert cli.ARTIFACTS["map"]["donors"] == packets
+    assert len(cli.ARTIFACTS["validation"]["warnings"]) == 4
+    assert os.path.isfile(f"{REPO_DIR}/raw_data_completeness.csv")
+    os.remove(f"{REPO_DIR}/raw_data_completeness.csv")
+    assert not os.path.exists(cache_dir)
+    cli.SCHEMAS.clear()
+    # with --schema_cache, the schema is downloaded once, and is used again by the next command
+    cli.main(["--schema_cache", "--cache_dir", cache_dir, "validate", "--json", f"{REPO_DIR}/raw_data_map.json"])
+    assert len(os.listdir(cache_dir)) == 2
+    schema = list(cli.SCHEMAS.values())[0]
+    cli.main(["--schema_cache", "--cache_dir", cache_dir, "validate", "--json", f"{REPO_DIR}/raw_data_map.json"])
+    assert list(cli.SCHEMAS.values()) == [schema]
+    assert len(cli.ARTIFACTS["validation"]["warnings"]) == 4
+
+    # a cached schema that hasn't been checked within the ttl is checked, and kept if it hasn't changed
+    index = cli.read_cache_index()
+    url = list(index.keys())[0]
+    index[url]["etag"] = '"v1"'
+    index[url]["checked"] = "2000-01-01T00:00:00"
+    cli.write_cache_index(index)
+    requests_made = []
+
+    class NotModified:
+        status_code = 304
+        headers = {}
+
+        def raise_for_status(self):
+            pass
+
+    def get(url, headers=None):
+        requests_made.append(headers)
+        return NotModified()
+    monkeypatch.setattr(requests, "get", get)
+    path = os.path.join(cache_dir, index[url]["file"])
+    assert cli.cached_schema(url) == path
+    assert requests_made == [{"If-None-Match": '"v1"'}]
+    assert os.path.getsize(path) > 0
+    # and it isn't checked again within the ttl
+    assert cli.cached_schema(url) == path
+    assert len(requests_made) == 1
+    monkeypatch.undo()
+
+    cli.main(["--cache_dir", cache_dir, "cache", "clear"])
+    assert cli.read_cache_index() == {} and cli.SCHEMAS == {}
+    with pytest.raises(SystemExit):
+        cli.main(["--cache_dir", cache_dir, "completeness"])
+
+
+def test_stream_coverage(tmp_path, packets, schema):
+    import io
+    from clinical_etl import jsonstream
+    from clinical_etl import validate_coverage
+    # values that are cut off at any chunk boundary are read whole, including numbers that are cut off before
+    # their fraction or exponent
+    text = json.dumps({"a": [12345, -0.5e3, 12.25, 1e21, 2.5E-7, "abc\"def", {"b": [True, None]}, []], "c": 678,
+                       "d": {"e": 12.5, "f": -3}, "g": 0})
+
+    def read(stream):
+        if stream.peek() == "{":
+            return {key: read(stream) for key in stream.object_keys()}
+        if stream.peek() == "[":
+            return list(stream.array())
+        return stream.value()
+    for chunk_size in range(1, len(text) + 1):
+        stream = jsonstream.JSONStream(io.StringIO(text), chunk_size=chunk_size)
+        assert [(key, list(stream.array()) if key == "a" else stream.value()) for key in stream.object_keys()] == \
+               list(json.loads(text).items())
+        assert read(jsonstream.JSONStream(io.StringIO(text), chunk_size=chunk_size)) == json.loads(text)
+
+    map_json = CSVConvert.build_map(schema, packets)
+    map_file = tmp_path / "raw_data_map.json"
+    with open(map_file, 'w') as f:
+        json.dump({"donors": map_json.pop("donors"), **map_json}, f, indent=4)
+    ndjson_file = tmp_path / "raw_data_map.ndjson"
+    with open(ndjson_file, 'w') as f:
+        f.write(json.dumps(map_json) + "\n")
+        for packet in packets:
+            f.write(json.dumps(packet) + "\n")
+    expected = validate_coverage.validate_coverage({**map_json, "donors": packets}, schema=schema)
+    # the schema's url is after the packets in map_file, so they are skipped to get to it
+    for path in [str(map_file), str(ndjson_file)]:
+        assert list(jsonstream.map_packets(path, "donors")) == packets
+        result = validate_coverage.stream_coverage(path, schema=schema)
+        assert result == expected
+        assert schema.donor_results == []
+
+    # the rules are timed when the packets are streamed too
+    expected = validate_coverage.validate_coverage({**map_json, "donors": packets}, schema=schema, rule_stats=True)
+    result = validate_coverage.stream_coverage(str(ndjson_file), schema=schema, rule_stats=True)
+    assert [rule["evaluations"] for rule in sorted(result["rules"], key=lambda r: (r["schema"], r["rule"]))] == \
+           [rule["evaluations"] for rule in sorted(expected["rules"], key=lambda r: (r["schema"], r["rule"]))]
+    assert sum(rule["seconds"] for rule in result["rules"]) > 0
+    assert not schema.profile_rules
+
+
+def test_field_completeness(tmp_path, monkeypatch, packets, schema):
+    from clinical_etl import completeness_table, jsonstream
+    map_json = CSVConvert.build_map(schema, packets)
+    CSVConvert.validate_map(schema, map_json)
+    map_json["statistics"] = schema.statistics
+    map_file = str(tmp_path / "raw_data_map.json")
+    with open(map_file, 'w') as f:
+        json.dump(map_json, f, indent=4)
+    completeness_table.generate_csv(map_file, fields=True, schema=schema)
+    expected_file = str(tmp_path / "expected.csv")
+    completeness_table.write_csv(schema.statistics, expected_file)
+    with open(expected_file) as expected, open(str(tmp_path / "raw_data_completeness.csv")) as actual:
+        assert actual.read() == expected.read()
+    # the map is read whole wherever its chunks end, including in the middle of a number
+    numbers_file = str(tmp_path / "numbers_map.json")
+    with open(numbers_file, 'w') as f:
+        json.dump({"seconds": 12.25, "scale": 2.5e-07, **map_json}, f, indent=4)
+    for chunk_size in [1, 2, 3, 5, 7, 11, 64]:
+        monkeypatch.setattr(jsonstream, "CHUNK_SIZE", chunk_size)
+        completeness_table.generate_csv(numbers_file, schema=schema)
+        with open(expected_file) as expected, open(str(tmp_path / "numbers_completeness.csv")) as actual:
+            assert actual.read() == expected.read()
+    monkeypatch.undo()
+    with open(str(tmp_path / "raw_data_field_completeness.csv")) as f:
+        rows = {(row["Schema"], row["Field"]): row for row in csv.DictReader(f)}
+    assert len(rows) == len(completeness_table.FieldCompleteness(schema).fields)
+    assert rows[("donors", "submitter_donor_id")]["Total"] == str(len(packets))
+    assert rows[("donors", "submitter_donor_id")]["Missing"] == "0"
+    diagnoses = [pd for packet in packets for pd in packet.get("primary_diagnoses", [])]
+    assert rows[("donors.primary_diagnoses", "clinical_stage_group")]["Total"] == str(len(diagnoses))
+    assert rows[("donors.primary_diagnoses", "clinical_stage_group")]["Missing"] == \
+           str(len([pd for pd in diagnoses if pd.get("clinical_stage_group") in [None, ""]]))
+
+
+def test_statistics(packets, schema):
+    from clinical_etl.schema import Statistics
+    CSVConvert.validate_map(schema, CSVConvert.build_map(schema, packets))
+    expected = schema.statistics
+    assert len(expected["required_but_missing"]) > 0
+    # partial statistics of each half of the donors merge to the statistics of all of them
+    halves = [Statistics(), Statistics()]
+    for i, donor_result in enumerate(schema.donor_results):
+        assert Statistics.from_dict(donor_result["statistics"]).to_dict() == donor_result["statistics"]
+        halves[i % 2].merge(Statistics.from_dict(donor_result["statistics"]))
+    halves[0].merge(halves[1])
+    result = halves[0].summary(schema.validation_schema.keys(), len(packets))
+    for key in ["required_but_missing", "summary_cases"]:
+        assert result[key] == expected[key]
+    for key in ["schemas_used", "cases_missing_data", "schemas_not_used"]:
+        assert sorted(result[key]) == sorted(expected[key])
+
+
+def test_validation_cache(tmp_path, packets, schema):
+    import copy
+    from clinical_etl import validate_coverage
+    map_json = CSVConvert.build_map(schema, copy.deepcopy(packets))
+    expected = validate_coverage.validate_coverage(copy.deepcopy(map_json), schema=schema)
+    cache_path = str(tmp_path / "raw_data_validation_cache.json")
+    for hits in [0, len(packets)]:
+        cache = validate_coverage.open_cache(cache_path, schema)
+        schema.reset_validation()
+        schema.validate_ingest_map(copy.deepcopy(map_json), cache=cache)
+        cache.save()
+        assert cache.hits == hits
+        assert (schema.validation_errors, schema.validation_warnings, schema.statistics) == \
+               (expected["errors"], expected["warnings"], expected["statistics"])
+
+    # a cached packet that occurs twice is still a duplicated ID
+    map_json["donors"].append(copy.deepcopy(map_json["donors"][0]))
+    result = validate_coverage.validate_coverage(map_json, schema=schema, cache_path=cache_path)
+    donor_id = map_json["donors"][0]["submitter_donor_id"]
+    assert f"Duplicated IDs: in schema donors, {donor_id} occurs 2 times" in result["errors"]
+
+
+def test_rules(packets, schema):
+    import copy
+    from clinical_etl import validate_coverage
+    donor = copy.deepcopy(packets[0])
+    donor_id = donor["submitter_donor_id"]
+    donor["is_deceased"] = "No"
+    donor["cause_of_death"] = "Died of cancer"
+    donor["exposures"] = [{"tobacco_smoking_status": "Never smoked", "pack_years_smoked": 3}]
+    result = validate_coverage.validate_coverage(CSVConvert.build_map(schema, [donor]), schema=schema, rule_stats=True)
+    assert f"{donor_id}: cause_of_death should only be submitted if is_deceased = Yes" in result["errors"]
+    assert (f"{donor_id} > Exposure 0: pack_years_smoked cannot be submitted for tobacco_smoking_status = Never smoked"
+            in result["errors"])
+
+    # every rule is reported, with the number of times that it was evaluated
+    assert len(result["rules"]) == len(schema.rules)
+    rules = {(rule["schema"], rule["rule"]): rule for rule in result["rules"]}
+    assert rules[("donors", "ForbiddenIf(cause_of_death)")]["evaluations"] == 1
+    assert rules[("exposures", "ForbiddenIf(pack_years_smoked)")]["evaluations"] == 1
+    assert rules[("exposures", "ForbiddenIf(tobacco_type)")]["evaluations"] == 0
+    assert not schema.profile_rules
+
+    # month_intervals and dates can't be compared, so a donor that mixes them isn't out of order
+    donor = copy.deepcopy([packet for packet in packets if any(pd.get("treatments") for pd in
+                                                               packet.get("primary_diagnoses") or [])][0])
+    donor["date_of_birth"] = "1950-02-01"
+    donor["date_of_death"] = None
+    for diagnosis in donor["primary_diagnoses"]:
+        diagnosis["date_of_diagnosis"] = {"month_interval": 0}
+        for treatment in diagnosis.get("treatments") or []:
+            treatment["treatment_start_date"] = {"month_interval": 3}
+            treatment["treatment_end_date"] = {"month_interval": 4}
+    errors = validate_coverage.validate_coverage(CSVConvert.build_map(schema, [donor]), schema=schema)["errors"]
+    assert not [e for e in errors if "cannot be later than date_of_diagnosis" in e or "before date_of_birth" in e]
+    # dates of the same kind still are
+    donor["primary_diagnoses"][0]["date_of_diagnosis"] = "1940-01-01"
+    errors = validate_coverage.validate_coverage(CSVConvert.build_map(schema, [donor]), schema=schema)["errors"]
+    diagnosis_id = donor["primary_diagnoses"][0]["submitter_primary_diagnosis_id"]
+    assert any(e.endswith(f"{diagnosis_id}: date_of_birth cannot be later than date_of_diagnosis") for e in errors)
+
+
+def test_date_cache(packets, schema):
+    from clinical_etl import rules
+    assert rules.date_value("2020-01-02") - rules.date_value("2019-12-31") == 2
+    assert rules.date_value({"month_interval": 3}) == 3
+    assert rules.date_value("") is None
+    # dates are only parsed the first time that they are seen, in any packet
+    CSVConvert.validate_map(schema, CSVConvert.build_map(schema, packets))
+    misses = rules.date_ordinal.cache_info().misses
+    CSVConvert.validate_map(schema, CSVConvert.build_map(schema, packets))
+    assert rules.date_ordinal.cache_info().misses == misses
+    assert schema.packet_dates == {}
+
+
+def test_fast_validation(tmp_path, monkeypatch, packets, schema):
+    import copy
+    import jsonschema
+    from clinical_etl import fastvalidator, validate_coverage
+    monkeypatch.setattr(fastvalidator, "CACHE_DIR", str(tmp_path))
+    donors = copy.deepcopy(packets)
+    donors[0]["gender"] = "Unknown gender"
+    donors[0]["cause_of_death"] = 5
+    donors[0].pop("submitter_donor_id")
+    donors[1]["primary_diagnoses"] = [{"cancer_type_code": None},
+                                      {"submitter_primary_diagnosis_id": "PD_X", "cancer_type_code": 7}]
+    donors[1]["is_deceased"] = None
+    map_json = CSVConvert.build_map(schema, donors)
+    expected = validate_coverage.validate_coverage(copy.deepcopy(map_json), schema=schema)
+    assert "Donor 0: 'submitter_donor_id' is a required property" in expected["errors"]
+    result = validate_coverage.validate_coverage(copy.deepcopy(map_json), schema=schema, fast_validation=True)
+    assert result == expected
+    assert len(list(tmp_path.glob("fastvalidator_*.py"))) == 1
+
+    # keywords that aren't generated are validated by jsonschema
+    json_schema = {
+        "type": "object",
+        "required": ["id"],
+        "properties": {
+            "id": {"type": "string", "maxLength": 3, "pattern": "^[A-Z]+$"},
+            "count": {"type": ["integer", "null"], "minimum": 0},
+            "kind": {"enum": ["a", "b"], "nullable": True},
+            "value": {"oneOf": [{"type": "number"}, {"type": "integer"}]},
+            "nodes": {"type": "array", "items": {"anyOf": [{"type": "string"}, {"$ref": "#/$defs/Node"}]}},
+        },
+        "$defs": {"Node": {"type": "object", "required": ["name"], "properties": {"name": {"type": "string"}}}},
+    }
+    validator = fastvalidator.load(json_schema, str(tmp_path))
+    for instance in [{"id": "ab", "count": -1, "kind": None, "value": 2, "nodes": ["x", {"name": 1}, {}]},
+                     {"id": "ABCD", "count": 1.0, "kind": "c", "value": "2", "nodes": [{"name": "n"}]}, []]:
+        errors = [(e.message, list(e.path), e.instance) for e in validator(instance)]
+        assert errors == [(e.message, list(e.path), e.instance)
+                          for e in jsonschema.Draft202012Validator(json_schema).iter_errors(instance)]